@@ -0,0 +1,125 @@
+"""
+Golden images of the CPU render backend (modules/cpu_raster.py), runs under plain CPython:
+
+    python -m benchmarks.golden --check benchmarks/golden/
+    python -m benchmarks.golden --write benchmarks/golden/    # after a change that's meant to alter the images
+
+Renders a few synthetic scenes with the final render's G-buffer passes and compares them
+pixel for pixel with the .npz files in benchmarks/golden/. Every scene is also rendered
+again on several threads with another tile size, which has to come out the same. Exits with
+1 on any difference.
+"""
+
+import argparse
+import json
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+from . import stubs
+from .run import import_addon
+
+# name -> (synthetic.Scene arguments, settings), "tilt" turns the meshes towards the camera
+# at different angles so normals, shading and outlines vary over the image
+SCENES = {
+    "default": ({"objects": 9, "materials": 3, "lights": 3, "textures": 1}, {}),
+    "no_fusion": ({"objects": 9, "materials": 3, "lights": 3, "textures": 1}, {"use_pass_fusion": False}),
+    "no_fxaa": ({"objects": 9, "materials": 3, "lights": 3}, {"use_fxaa": False, "world_color_clear": True}),
+    # more lights than fit in one light block
+    "many_lights": ({"objects": 4, "materials": 3, "lights": 70}, {"use_shadows": False}),
+    "tilted": ({"objects": 9, "materials": 3, "lights": 3, "textures": 1, "tilt": True}, {"enable_outline": True}),
+}
+
+def get_tilt(index):
+    x, z = 0.4 + 0.25 * index, 0.7 * index
+    rotate_x = ((1, 0, 0, 0), (0, math.cos(x), -math.sin(x), 0), (0, math.sin(x), math.cos(x), 0), (0, 0, 0, 1))
+    rotate_z = ((math.cos(z), -math.sin(z), 0, 0), (math.sin(z), math.cos(z), 0, 0), (0, 0, 1, 0), (0, 0, 0, 1))
+    return stubs.Matrix(rotate_z) @ stubs.Matrix(rotate_x)
+
+def render_scene(engine_module, cpu_render, name, width, height, threads, tile_size):
+    from .synthetic import Scene
+
+    scene_args, overrides = SCENES[name]
+    scene_args = dict(scene_args)
+    tilt = scene_args.pop("tilt", False)
+    settings = stubs.settings_from(engine_module.CustomRenderEngineSettings)
+    for key, value in overrides.items():
+        setattr(settings, key, value)
+    scene = Scene(resolution=8, settings=settings, **scene_args)
+    if tilt:
+        for index, object in enumerate(scene.objects):
+            if object.type == "MESH":
+                object.matrix_world = object.matrix_world @ get_tilt(index)
+    depsgraph = scene.depsgraph()
+    context = engine_module.get_camera_context(depsgraph, width, height)
+    renderer = engine_module.SceneRenderer()
+    renderer.use_shadows = settings.use_shadows
+    lights = [renderer.create_light(instance.object) for instance in depsgraph.object_instances
+        if instance.object.type == "LIGHT"]
+    readback = {}
+    pixels = cpu_render.render_frame(depsgraph, context, settings, [light for light in lights if light], readback,
+        threads=threads, tile_size=tile_size)
+    images = {"combined": pixels}
+    images.update((texture, data) for texture, (data, _, _) in readback.items())
+    return images
+
+def compare(expected, actual):
+    out = {}
+    for key in sorted(set(expected) | set(actual)):
+        if key not in expected or key not in actual or expected[key].shape != actual[key].shape:
+            out[key] = "missing or resized"
+        elif not np.array_equal(expected[key], actual[key]):
+            difference = np.abs(expected[key].astype(np.float64) - actual[key].astype(np.float64))
+            out[key] = {"pixels": int(np.count_nonzero(difference.reshape(difference.shape[0], difference.shape[1], -1).any(axis=-1))),
+                "max_difference": float(difference.max())}
+    return out
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--write", metavar="DIR", help="save the images as the new golden images")
+    group.add_argument("--check", metavar="DIR", help="compare the images with the golden images")
+    parser.add_argument("--scenes", nargs="+", choices=sorted(SCENES), default=sorted(SCENES))
+    parser.add_argument("--width", type=int, default=160)
+    parser.add_argument("--height", type=int, default=90)
+    parser.add_argument("--threads", type=int, default=4, help="threads of the second render")
+    parser.add_argument("--tile-size", type=int, default=24, help="tile size of the second render")
+    parser.add_argument("-o", "--output", help="write results as JSON to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    engine_module, _ = import_addon()
+    from modules import cpu_render
+
+    results = {}
+    failed = False
+    for name in args.scenes:
+        start = time.perf_counter()
+        images = render_scene(engine_module, cpu_render, name, args.width, args.height, 1, None)
+        serial_ms = (time.perf_counter() - start) * 1000.0
+        start = time.perf_counter()
+        parallel = render_scene(engine_module, cpu_render, name, args.width, args.height, args.threads, args.tile_size)
+        parallel_ms = (time.perf_counter() - start) * 1000.0
+        result = {"serial_ms": serial_ms, "parallel_ms": parallel_ms, "tiling_differences": compare(images, parallel)}
+        path = os.path.join(args.write or args.check or "", name + ".npz")
+        if args.write:
+            os.makedirs(args.write, exist_ok=True)
+            np.savez_compressed(path, **images)
+        elif args.check:
+            with np.load(path) as golden:
+                result["golden_differences"] = compare(dict(golden), images)
+        failed |= bool(result["tiling_differences"] or result.get("golden_differences"))
+        results[name] = result
+
+    text = json.dumps({"failed": failed, "scenes": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,181 @@
+"""
+Headless benchmarks for the render engine, runs under plain CPython.
+
+    python -m benchmarks.run --objects 200 --materials 20 --lights 8 -o bench.json
+    python -m benchmarks.run --compare bench_old.json bench.json
+
+Timings measure the Python side only (depsgraph sync, batch creation, draw
+submission), GPU work is stubbed out. Call and allocation counts come from the
+stub modules and are deterministic, so they're the best regression signal.
+Tangent generation is compared with Blender's own by tangents.py, which has to
+run inside Blender. golden.py checks the CPU render backend against saved images.
+Unit tests of the pure Python and NumPy modules are in tests/, run with pytest.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+from . import stubs
+
+ADDON_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "custom_render_engine")
+
+def import_addon():
+    stubs.install()
+    if ADDON_DIR not in sys.path:
+        sys.path.insert(0, ADDON_DIR)
+    from modules import custom_render_engine, operators
+    return custom_render_engine, operators
+
+def measure(function, repeat):
+    times = []
+    stubs.STATS.reset()
+    tracemalloc.start()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - start) * 1000.0)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    result = {
+        "repeat": repeat,
+        "min_ms": min(times),
+        "median_ms": statistics.median(times),
+        "max_ms": max(times),
+        "python_peak_bytes": peak,
+    }
+    # per iteration, so results with a different --repeat stay comparable
+    counts = stubs.STATS.as_dict()
+    for key, values in counts.items():
+        result[key] = {name: value / repeat for name, value in sorted(values.items())}
+    return result
+
+def bench_view_update(engine_module, args):
+    from .synthetic import Scene, view_context, Update
+
+    settings = stubs.settings_from(engine_module.CustomRenderEngineSettings)
+    if args.proxy_size:
+        settings.use_texture_proxies = True
+        settings.texture_proxy_size = args.proxy_size
+    scene = Scene(args.objects, args.materials, args.lights, args.instances, args.resolution, settings, args.textures)
+    context = view_context(scene, args.width, args.height)
+    results = {}
+
+    def first_sync():
+        engine = engine_module.CustomRenderEngine()
+        engine.view_update(context, scene.depsgraph())
+    results["view_update_initial"] = measure(first_sync, args.repeat)
+
+    engine = engine_module.CustomRenderEngine()
+    engine.view_update(context, scene.depsgraph())
+    changed = scene.objects[:max(1, len(scene.meshes) // 10)] if scene.meshes else []
+    updates = [Update(o, geometry=True) for o in changed if o.type == "MESH"]
+    results["view_update_geometry_10pct"] = measure(lambda: engine.view_update(context, scene.depsgraph(updates)), args.repeat)
+    transform_updates = [Update(o, transform=True) for o in changed]
+    results["view_update_transform_10pct"] = measure(lambda: engine.view_update(context, scene.depsgraph(transform_updates)), args.repeat)
+    material_updates = [Update(m, shading=True) for m in scene.materials]
+    results["view_update_materials"] = measure(lambda: engine.view_update(context, scene.depsgraph(material_updates)), args.repeat)
+
+    depsgraph = scene.depsgraph()
+    results["view_draw"] = measure(lambda: engine.view_draw(context, depsgraph), args.repeat)
+
+    # GPUBatch.draw against view_draw's shows the draw calls saved
+    settings.use_static_batching = True
+    engine = engine_module.CustomRenderEngine()
+    engine.view_update(context, scene.depsgraph())
+    results["view_draw_static_batching"] = measure(lambda: engine.view_draw(context, depsgraph), args.repeat)
+    results["view_update_transform_10pct_static_batching"] = measure(
+        lambda: engine.view_update(context, scene.depsgraph(transform_updates)), args.repeat)
+    settings.use_static_batching = False
+    return results
+
+def bench_meshes(engine_module, operators_module, args):
+    from .synthetic import FakeMesh, FakeObject
+
+    results = {}
+    shader = engine_module.MeshMaterialShader(None)
+    for resolution in args.mesh_resolutions:
+        mesh = FakeMesh(f"Grid{resolution}", resolution)
+        key = f"create_batch_{resolution}x{resolution}"
+        results[key] = measure(lambda: engine_module.BasePassRendering(mesh, shader), args.repeat)
+        results[key]["loops"] = len(mesh.loops)
+
+        # the per-loop python loop in bake_vertex_normals is slow, keep it on smaller meshes
+        if resolution <= args.bake_max_resolution:
+            object = FakeObject(f"Grid{resolution}", "MESH", mesh)
+            key = f"bake_vertex_normals_{resolution}x{resolution}"
+            results[key] = measure(lambda: operators_module.bake_vertex_normals(object, True, "X", 0.001), max(1, args.repeat // 5))
+            results[key]["loops"] = len(mesh.loops)
+    return results
+
+def compare(old_path, new_path, threshold):
+    old = json.load(open(old_path))["benchmarks"]
+    new = json.load(open(new_path))["benchmarks"]
+    regressions = 0
+    for name in sorted(set(old) & set(new)):
+        before, after = old[name]["median_ms"], new[name]["median_ms"]
+        change = (after - before) / before if before else 0.0
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"{name:40s} {before:10.3f} ms -> {after:10.3f} ms  {change * 100:+7.1f}%{flag}")
+        old_calls, new_calls = old[name].get("calls", {}), new[name].get("calls", {})
+        for call in sorted(set(old_calls) | set(new_calls)):
+            a, b = old_calls.get(call, 0), new_calls.get(call, 0)
+            if a != b:
+                print(f"    {call}: {a:g} -> {b:g}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--objects", type=int, default=100)
+    parser.add_argument("--materials", type=int, default=10)
+    parser.add_argument("--lights", type=int, default=4)
+    parser.add_argument("--instances", type=int, default=0)
+    parser.add_argument("--textures", type=int, default=2, help="images shared by the materials")
+    parser.add_argument("--proxy-size", type=int, default=0, help="enable texture proxies with this max size")
+    parser.add_argument("--resolution", type=int, default=16, help="grid resolution of scene meshes")
+    parser.add_argument("--mesh-resolutions", type=int, nargs="+", default=[64, 256, 512])
+    parser.add_argument("--bake-max-resolution", type=int, default=32)
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--only", choices=["scene", "mesh"])
+    parser.add_argument("-o", "--output", help="write results as JSON to this file instead of stdout")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative slowdown reported as a regression")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        return 1 if compare(*args.compare, args.threshold) else 0
+
+    engine_module, operators_module = import_addon()
+    benchmarks = {}
+    if args.only in (None, "scene"):
+        benchmarks.update(bench_view_update(engine_module, args))
+    if args.only in (None, "mesh"):
+        benchmarks.update(bench_meshes(engine_module, operators_module, args))
+
+    params = {k: v for k, v in vars(args).items() if k not in ("output", "compare", "threshold")}
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": params,
+        "benchmarks": benchmarks,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
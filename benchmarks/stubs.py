@@ -0,0 +1,564 @@
+"""
+Stand-ins for the Blender modules the add-on imports (bpy, gpu, gpu_extras,
+mathutils, bl_math, nodeitems_utils, bpy_extras), so the engine can be driven
+from plain CPython. Nothing is drawn; every call is counted in STATS and GPU
+allocations are tallied in bytes.
+
+install() has to run before anything from custom_render_engine is imported.
+"""
+
+import collections
+import sys
+import types
+
+import numpy as np
+
+class Stats:
+    def __init__(self):
+        self.calls = collections.Counter()
+        self.allocations = collections.Counter()
+        self.allocated_bytes = collections.Counter()
+
+    def reset(self):
+        self.calls.clear()
+        self.allocations.clear()
+        self.allocated_bytes.clear()
+
+    def call(self, name):
+        self.calls[name] += 1
+
+    def alloc(self, name, nbytes):
+        self.allocations[name] += 1
+        self.allocated_bytes[name] += nbytes
+
+    def as_dict(self):
+        return {
+            "calls": dict(self.calls),
+            "allocations": dict(self.allocations),
+            "allocated_bytes": dict(self.allocated_bytes),
+        }
+
+STATS = Stats()
+
+class Counted:
+    # Any method that isn't defined explicitly is a counted no-op, so the stubs
+    # keep working when the engine starts using more of the API.
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        qualified = f"{type(self).__name__}.{name}"
+
+        def method(*args, **kwargs):
+            STATS.call(qualified)
+        return method
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    return module
+
+# ---------------------------------------------------------------------------
+# mathutils
+
+class Vector:
+    def __init__(self, seq=(0, 0, 0)):
+        self._v = np.array(seq, dtype=np.float64)
+
+    def __len__(self):
+        return len(self._v)
+
+    def __iter__(self):
+        return iter(self._v.tolist())
+
+    def __getitem__(self, i):
+        return self._v[i]
+
+    def __setitem__(self, i, value):
+        self._v[i] = value
+
+    def __eq__(self, other):
+        return np.array_equal(self._v, np.asarray(other, dtype=np.float64))
+
+    def __add__(self, other):
+        return Vector(self._v + np.asarray(other))
+
+    def __sub__(self, other):
+        return Vector(self._v - np.asarray(other))
+
+    def __mul__(self, other):
+        return Vector(self._v * other)
+
+    def __truediv__(self, other):
+        return Vector(self._v / other)
+
+    def __neg__(self):
+        return Vector(-self._v)
+
+    def __array__(self, dtype=None, copy=None):
+        return self._v.astype(dtype) if dtype else self._v
+
+    def __matmul__(self, other):
+        if isinstance(other, Matrix):
+            return Vector(self._v @ other._m)
+        return float(self._v @ np.asarray(other))
+
+    def _component(i):
+        return property(lambda self: self._v[i], lambda self, value: self._v.__setitem__(i, value))
+
+    x = _component(0)
+    y = _component(1)
+    z = _component(2)
+    w = _component(3)
+    del _component
+
+    @property
+    def xyz(self):
+        return Vector(self._v[:3])
+
+    @xyz.setter
+    def xyz(self, value):
+        self._v[:3] = np.asarray(value)[:3]
+
+    @property
+    def length(self):
+        return float(np.linalg.norm(self._v))
+
+    def copy(self):
+        return Vector(self._v)
+
+    def normalize(self):
+        n = np.linalg.norm(self._v)
+        if n > 0:
+            self._v /= n
+
+    def normalized(self):
+        v = self.copy()
+        v.normalize()
+        return v
+
+    def dot(self, other):
+        return float(self._v @ np.asarray(other))
+
+    def cross(self, other):
+        return Vector(np.cross(self._v[:3], np.asarray(other)[:3]))
+
+    def to_4d(self):
+        return Vector((*self._v[:3], 1.0))
+
+    def to_3d(self):
+        return Vector(self._v[:3])
+
+    def rotate(self, rotation):
+        self._v[:3] = rotation.to_matrix()._m @ self._v[:3]
+
+class Quaternion:
+    def __init__(self, wxyz=(1, 0, 0, 0)):
+        self.w, self.x, self.y, self.z = wxyz
+
+    def to_matrix(self):
+        w, x, y, z = self.w, self.x, self.y, self.z
+        return Matrix((
+            (1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)),
+            (2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)),
+            (2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)),
+        ))
+
+class Matrix:
+    def __init__(self, rows=None):
+        self._m = np.identity(4) if rows is None else np.array([list(r) for r in rows], dtype=np.float64)
+
+    @classmethod
+    def Identity(cls, size):
+        return cls(np.identity(size))
+
+    @classmethod
+    def Diagonal(cls, vector):
+        return cls(np.diag(np.asarray(vector, dtype=np.float64)))
+
+    @classmethod
+    def Translation(cls, vector):
+        m = cls.Identity(4)
+        m._m[:3, 3] = np.asarray(vector)[:3]
+        return m
+
+    def __getitem__(self, i):
+        return self._m[i]
+
+    def __len__(self):
+        return len(self._m)
+
+    def __iter__(self):
+        return iter(self._m)
+
+    def __eq__(self, other):
+        return isinstance(other, Matrix) and np.array_equal(self._m, other._m)
+
+    def __array__(self, dtype=None, copy=None):
+        return self._m.astype(dtype) if dtype else self._m
+
+    def __matmul__(self, other):
+        if isinstance(other, Matrix):
+            return Matrix(self._m @ other._m)
+        v = np.asarray(other, dtype=np.float64)
+        if len(v) == len(self._m) - 1:
+            # like mathutils, a 4x4 matrix transforms a 3d vector as a point
+            v = self._m @ np.append(v, 1.0)
+            return Vector(v[:-1] / v[-1])
+        return Vector(self._m @ v)
+
+    def copy(self):
+        return Matrix(self._m)
+
+    def inverted(self):
+        return Matrix(np.linalg.inv(self._m))
+
+    def transposed(self):
+        return Matrix(self._m.T)
+
+    def to_translation(self):
+        return Vector(self._m[:3, 3])
+
+    def to_scale(self):
+        return Vector(np.linalg.norm(self._m[:3, :3], axis=0))
+
+    def to_3x3(self):
+        return Matrix(self._m[:3, :3])
+
+    def decompose(self):
+        scale = np.linalg.norm(self._m[:3, :3], axis=0)
+        rotation = self._m[:3, :3] / np.where(scale == 0, 1, scale)
+        # Shepperd's method is overkill here, the benchmarks only need something plausible
+        w = np.sqrt(max(0.0, 1 + rotation[0, 0] + rotation[1, 1] + rotation[2, 2])) / 2
+        if w > 1e-6:
+            q = (w, (rotation[2, 1] - rotation[1, 2]) / (4 * w), (rotation[0, 2] - rotation[2, 0]) / (4 * w), (rotation[1, 0] - rotation[0, 1]) / (4 * w))
+        else:
+            q = (0, 1, 0, 0)
+        return self.to_translation(), Quaternion(q), Vector(scale)
+
+mathutils = _module("mathutils", Vector=Vector, Matrix=Matrix, Quaternion=Quaternion)
+
+# ---------------------------------------------------------------------------
+# gpu
+
+_FORMAT_BYTES = {
+    "RGBA8": 4, "RGBA16": 8, "RGBA16F": 8, "RGBA32F": 16, "R8UI": 1, "R32F": 4, "RG16F": 4,
+    "R16F": 2, "R32UI": 4, "DEPTH_COMPONENT24": 4, "DEPTH_COMPONENT32F": 4, "DEPTH24_STENCIL8": 4,
+}
+
+class GPUTexture(Counted):
+    def __init__(self, size, layers=0, is_cubemap=False, format="RGBA8", data=None):
+        if isinstance(size, int):
+            size = (size, size)
+        self.size = tuple(size)
+        self.width, self.height = self.size[0], self.size[1] if len(self.size) > 1 else 1
+        self.format = format
+        STATS.call("GPUTexture")
+        STATS.alloc("texture", self.width * self.height * _FORMAT_BYTES.get(format, 4))
+
+    def clear(self, format="FLOAT", value=(0.0, 0.0, 0.0, 1.0)):
+        STATS.call("GPUTexture.clear")
+
+    def read(self):
+        STATS.call("GPUTexture.read")
+        return np.zeros((self.height, self.width, 4), dtype=np.float32)
+
+class GPUFrameBuffer(Counted):
+    def __init__(self, depth_slot=None, color_slots=None):
+        STATS.call("GPUFrameBuffer")
+        self.depth_slot = depth_slot
+        self.color_slots = color_slots
+
+    class _Bind:
+        def __enter__(self):
+            STATS.call("GPUFrameBuffer.bind")
+
+        def __exit__(self, *args):
+            return False
+
+    def bind(self):
+        return self._Bind()
+
+    def clear(self, color=None, depth=None, stencil=None):
+        STATS.call("GPUFrameBuffer.clear")
+
+    def read_color(self, x, y, w, h, channels, slot, format, data=None):
+        STATS.call("GPUFrameBuffer.read_color")
+        return np.zeros((h, w, channels), dtype=np.float32)
+
+class GPUOffScreen(Counted):
+    def __init__(self, width, height, format="RGBA8"):
+        STATS.call("GPUOffScreen")
+        self.width, self.height = width, height
+        self.texture_color = GPUTexture((width, height), format=format)
+        self._framebuffer = GPUFrameBuffer(color_slots=(self.texture_color,))
+
+    def bind(self):
+        return self._framebuffer.bind()
+
+class GPUVertFormat(Counted):
+    def attr_add(self, **kwargs):
+        STATS.call("GPUVertFormat.attr_add")
+
+class GPUVertBuf(Counted):
+    def __init__(self, format, len):
+        STATS.call("GPUVertBuf")
+        self.len = len
+
+    def attr_fill(self, id, data):
+        STATS.call("GPUVertBuf.attr_fill")
+        STATS.alloc("vertex_buffer", np.asarray(data).nbytes)
+
+class GPUIndexBuf(Counted):
+    def __init__(self, type, seq):
+        STATS.call("GPUIndexBuf")
+        STATS.alloc("index_buffer", np.asarray(seq).nbytes)
+
+class GPUBatch(Counted):
+    def __init__(self, type, buf, elem=None):
+        STATS.call("GPUBatch")
+
+    def draw(self, program=None):
+        STATS.call("GPUBatch.draw")
+
+    def draw_instanced(self, program, instance_start=0, instance_count=0):
+        STATS.call("GPUBatch.draw_instanced")
+
+class GPUUniformBuf(Counted):
+    def __init__(self, data):
+        STATS.call("GPUUniformBuf")
+        STATS.alloc("uniform_buffer", len(bytes(data)) if not hasattr(data, "nbytes") else data.nbytes)
+
+    def update(self, data):
+        STATS.call("GPUUniformBuf.update")
+
+class Buffer(Counted):
+    def __init__(self, format, dimensions, data=None):
+        STATS.call("Buffer")
+        self.data = np.asarray(data) if data is not None else None
+
+class GPUShader(Counted):
+    def __init__(self, vertexcode, fragcode, geocode=None, libcode=None, defines=None, name=None):
+        STATS.call("GPUShader")
+        STATS.alloc("shader", 0)
+
+    def bind(self):
+        STATS.call("GPUShader.bind")
+
+    def format_calc(self):
+        return GPUVertFormat()
+
+    def uniform_float(self, name, value):
+        STATS.call("GPUShader.uniform_float")
+
+    def uniform_int(self, name, value):
+        STATS.call("GPUShader.uniform_int")
+
+    def uniform_bool(self, name, value):
+        STATS.call("GPUShader.uniform_bool")
+
+    def uniform_sampler(self, name, texture):
+        STATS.call("GPUShader.uniform_sampler")
+
+    def uniform_block(self, name, ubo):
+        STATS.call("GPUShader.uniform_block")
+
+def _counted(name, result=None):
+    def function(*args, **kwargs):
+        STATS.call(name)
+        return result() if callable(result) else result
+    return function
+
+_viewport = [0, 0, 1920, 1080]
+
+def set_viewport(width, height):
+    _viewport[2], _viewport[3] = width, height
+
+def _from_image(image):
+    STATS.call("gpu.texture.from_image")
+    return GPUTexture(tuple(getattr(image, "size", (1, 1))), format="RGBA8")
+
+gpu = _module("gpu")
+gpu.types = _module("gpu.types", GPUTexture=GPUTexture, GPUFrameBuffer=GPUFrameBuffer, GPUVertFormat=GPUVertFormat,
+    GPUVertBuf=GPUVertBuf, GPUIndexBuf=GPUIndexBuf, GPUOffScreen=GPUOffScreen, GPUBatch=GPUBatch, GPUShader=GPUShader, GPUUniformBuf=GPUUniformBuf,
+    Buffer=Buffer)
+gpu.state = _module("gpu.state",
+    active_framebuffer_get=_counted("gpu.state.active_framebuffer_get", GPUFrameBuffer),
+    viewport_get=lambda: tuple(_viewport),
+    depth_test_set=_counted("gpu.state.depth_test_set"),
+    depth_mask_set=_counted("gpu.state.depth_mask_set"),
+    face_culling_set=_counted("gpu.state.face_culling_set"),
+    blend_set=_counted("gpu.state.blend_set"),
+    color_mask_set=_counted("gpu.state.color_mask_set"),
+    viewport_set=_counted("gpu.state.viewport_set"))
+gpu.texture = _module("gpu.texture", from_image=_from_image)
+gpu.platform = _module("gpu.platform", backend_type_get=lambda: "NONE")
+gpu.shader = _module("gpu.shader", from_builtin=_counted("gpu.shader.from_builtin", lambda: GPUShader("", "")))
+gpu.matrix = _module("gpu.matrix")
+
+def batch_for_shader(shader, type, content, indices=None):
+    STATS.call("batch_for_shader")
+    for data in content.values():
+        STATS.alloc("vertex_buffer", np.asarray(data).nbytes)
+    if indices is not None:
+        STATS.alloc("index_buffer", np.asarray(indices).nbytes)
+    return GPUBatch(type, None)
+
+gpu_extras = _module("gpu_extras")
+gpu_extras.batch = _module("gpu_extras.batch", batch_for_shader=batch_for_shader)
+
+# ---------------------------------------------------------------------------
+# bpy
+
+class Prop:
+    def __init__(self, kind, **kwargs):
+        self.kind = kind
+        self.kwargs = kwargs
+
+    def default(self):
+        if "default" in self.kwargs:
+            return self.kwargs["default"]
+        if self.kind == "EnumProperty":
+            items = self.kwargs.get("items")
+            return items[0][0] if items and not callable(items) else ""
+        return {"BoolProperty": False, "IntProperty": 0, "FloatProperty": 0.0, "StringProperty": ""}.get(self.kind)
+
+def _prop(kind):
+    return lambda **kwargs: Prop(kind, **kwargs)
+
+def settings_from(cls):
+    # Builds a plain object holding the defaults of a PropertyGroup's annotations
+    out = types.SimpleNamespace()
+    for klass in reversed(cls.__mro__):
+        for name, prop in getattr(klass, "__annotations__", {}).items():
+            if isinstance(prop, Prop):
+                setattr(out, name, prop.default())
+    return out
+
+class _Base:
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+
+class ID(_Base):
+    def __init__(self, name):
+        self.name = name
+
+class Object(ID):
+    pass
+
+class Mesh(ID):
+    pass
+
+class Material(ID):
+    pass
+
+class Image(ID):
+    pass
+
+class Light(ID):
+    pass
+
+class RenderPassRect:
+    def __init__(self, size):
+        self.data = np.zeros(size, dtype=np.float32)
+
+    def foreach_set(self, seq):
+        STATS.call("RenderPass.rect.foreach_set")
+        self.data[:] = seq
+
+class RenderPass:
+    def __init__(self, name, channels, size):
+        self.name = name
+        self.channels = channels
+        self.rect = RenderPassRect(size * channels)
+
+class RenderResult:
+    def __init__(self, width, height, passes):
+        self.passes = {name: RenderPass(name, channels, width * height) for name, channels in passes}
+        self.layers = [types.SimpleNamespace(passes=self.passes)]
+
+class RenderEngine(_Base):
+    is_preview = False
+
+    def register_pass(self, scene, view_layer, name, channels, chanid, type):
+        STATS.call("RenderEngine.register_pass")
+        if "_passes" not in self.__dict__:
+            self._passes = {}
+        self._passes[name] = channels
+
+    def begin_result(self, x, y, w, h, layer="", view=""):
+        STATS.call("RenderEngine.begin_result")
+        passes = self.__dict__.get("_passes") or {"Combined": 4}
+        self.result = RenderResult(w, h, passes.items())
+        return self.result
+
+    def end_result(self, result, cancel=False, highlight=False, do_merge_results=False):
+        STATS.call("RenderEngine.end_result")
+
+    def tag_redraw(self):
+        STATS.call("RenderEngine.tag_redraw")
+
+    def tag_update(self):
+        STATS.call("RenderEngine.tag_update")
+
+    def update_stats(self, stats, info):
+        STATS.call("RenderEngine.update_stats")
+
+    def report(self, type, message):
+        STATS.call("RenderEngine.report")
+
+    def test_break(self):
+        return False
+
+    def bind_display_space_shader(self, scene):
+        pass
+
+    def unbind_display_space_shader(self):
+        pass
+
+bpy = _module("bpy")
+bpy.types = _module("bpy.types", RenderEngine=RenderEngine, PropertyGroup=_Base, Panel=_Base, Operator=_Base,
+    ShaderNode=_Base, Node=_Base, NodeTree=_Base, NodeSocket=_Base, AddonPreferences=_Base,
+    ID=ID, Object=Object, Mesh=Mesh, Material=Material, Image=Image, Light=Light,
+    VIEW3D_MT_object_context_menu=Counted(), VIEW3D_HT_header=Counted())
+bpy.props = _module("bpy.props", **{kind: _prop(kind) for kind in (
+    "BoolProperty", "IntProperty", "FloatProperty", "FloatVectorProperty", "IntVectorProperty",
+    "StringProperty", "EnumProperty", "PointerProperty", "CollectionProperty")})
+bpy.utils = _module("bpy.utils", register_class=_counted("bpy.utils.register_class"),
+    unregister_class=_counted("bpy.utils.unregister_class"))
+bpy.path = _module("bpy.path", abspath=lambda path, library=None: path.replace("//", "", 1))
+bpy.data = _module("bpy.data", images={}, materials={}, objects={}, meshes={}, filepath="")
+bpy.app = _module("bpy.app", version=(3, 3, 0), background=True, timers=_module("bpy.app.timers",
+    register=_counted("bpy.app.timers.register"), unregister=_counted("bpy.app.timers.unregister"),
+    is_registered=lambda f: False), handlers=_module("bpy.app.handlers", persistent=lambda f: f))
+
+bpy_extras = _module("bpy_extras")
+class ExportHelper:
+    filepath = ""
+
+class ImportHelper:
+    filepath = ""
+
+bpy_extras.io_utils = _module("bpy_extras.io_utils", ExportHelper=ExportHelper, ImportHelper=ImportHelper)
+
+class NodeCategory(_Base):
+    def __init__(self, identifier, name, description="", items=None):
+        pass
+
+nodeitems_utils = _module("nodeitems_utils", NodeCategory=NodeCategory, NodeItem=lambda *a, **k: None,
+    register_node_categories=_counted("register_node_categories"),
+    unregister_node_categories=_counted("unregister_node_categories"))
+
+bl_math = _module("bl_math", clamp=lambda x, lo=0, hi=1: min(max(x, lo), hi), lerp=lambda a, b, t: a + (b - a) * t)
+
+MODULES = {
+    "bpy": bpy, "bpy.types": bpy.types, "bpy.props": bpy.props, "bpy.utils": bpy.utils, "bpy.data": bpy.data,
+    "bpy.app": bpy.app, "bpy.path": bpy.path, "bpy_extras": bpy_extras, "bpy_extras.io_utils": bpy_extras.io_utils,
+    "gpu": gpu, "gpu.types": gpu.types, "gpu.state": gpu.state, "gpu.texture": gpu.texture,
+    "gpu.platform": gpu.platform, "gpu.shader": gpu.shader, "gpu.matrix": gpu.matrix,
+    "gpu_extras": gpu_extras, "gpu_extras.batch": gpu_extras.batch,
+    "mathutils": mathutils, "nodeitems_utils": nodeitems_utils, "bl_math": bl_math,
+}
+
+def install():
+    for name, module in MODULES.items():
+        sys.modules.setdefault(name, module)
@@ -0,0 +1,291 @@
+"""
+Generated meshes, materials, lights and depsgraphs built on top of the stubs.
+Meshes are subdivided grids: a mesh of resolution n has n*n quads, (n+1)^2
+vertices, 4*n*n loops and 2*n*n loop triangles.
+"""
+
+import math
+import types
+
+import numpy as np
+
+from . import stubs
+
+class _Element:
+    # Single item access, as used by the per-loop python code in operators.py
+    __slots__ = ("collection", "index")
+
+    def __init__(self, collection, index):
+        self.collection = collection
+        self.index = index
+
+    def __getattr__(self, name):
+        value = self.collection.arrays[name][self.index]
+        if name in ("co", "normal"):
+            return stubs.Vector(value)
+        if value.ndim == 0:
+            return value.item()
+        return tuple(value)
+
+    def __setattr__(self, name, value):
+        if name in _Element.__slots__:
+            object.__setattr__(self, name, value)
+        else:
+            self.collection.arrays[name][self.index] = value
+
+class Collection:
+    def __init__(self, **arrays):
+        self.arrays = arrays
+
+    def __len__(self):
+        return len(next(iter(self.arrays.values())))
+
+    def __getitem__(self, index):
+        return _Element(self, index)
+
+    def foreach_get(self, name, out):
+        stubs.STATS.call("foreach_get")
+        out[...] = np.reshape(self.arrays[name], np.shape(out)).astype(out.dtype, copy=False)
+
+    def foreach_set(self, name, values):
+        stubs.STATS.call("foreach_set")
+        self.arrays[name][...] = np.reshape(values, self.arrays[name].shape)
+
+class Layer:
+    def __init__(self, data):
+        self.data = data
+
+class Layers:
+    def __init__(self, active):
+        self.active = active
+
+    def __len__(self):
+        return 1 if self.active else 0
+
+class FakeMesh(stubs.Mesh):
+    def __init__(self, name, resolution, uvs=True, colors=True):
+        super().__init__(name)
+        n = resolution
+        grid = np.linspace(-1, 1, n + 1, dtype=np.float32)
+        xs, ys = np.meshgrid(grid, grid, indexing="xy")
+        # a bit of displacement so normals aren't all the same
+        zs = 0.1 * np.sin(xs * 3) * np.cos(ys * 3)
+        coords = np.stack((xs.ravel(), ys.ravel(), zs.ravel()), axis=1).astype(np.float32)
+
+        i, j = np.meshgrid(np.arange(n), np.arange(n), indexing="xy")
+        v0 = (j * (n + 1) + i).ravel()
+        quads = np.stack((v0, v0 + 1, v0 + n + 2, v0 + n + 1), axis=1)
+        loop_vertices = quads.ravel().astype(np.int32)
+        loop_count = len(loop_vertices)
+
+        vertex_normals = np.tile(np.array((0, 0, 1), dtype=np.float32), (len(coords), 1))
+        self.vertices = Collection(co=coords, normal=vertex_normals)
+        self.loops = Collection(
+            vertex_index=loop_vertices,
+            normal=vertex_normals[loop_vertices].copy(),
+            tangent=np.zeros((loop_count, 3), dtype=np.float32),
+            bitangent=np.zeros((loop_count, 3), dtype=np.float32),
+            bitangent_sign=np.ones(loop_count, dtype=np.float32),
+        )
+        first = np.arange(0, loop_count, 4)
+        triangles = np.concatenate((
+            np.stack((first, first + 1, first + 2), axis=1),
+            np.stack((first, first + 2, first + 3), axis=1)))
+        self._triangles = triangles.astype(np.int32)
+        self.loop_triangles = Collection(loops=np.zeros((0, 3), dtype=np.int32))
+        self.polygons = Collection(loop_start=first.astype(np.int32), loop_total=np.full(len(first), 4, dtype=np.int32))
+
+        uv = coords[loop_vertices, :2] * 0.5 + 0.5
+        self.uv_layers = Layers(Layer(Collection(uv=uv)) if uvs else None)
+        color = np.ones((loop_count, 4), dtype=np.float32)
+        self.vertex_colors = Layers(Layer(Collection(color=color)) if colors else None)
+        self.shape_keys = None
+
+    def calc_loop_triangles(self):
+        stubs.STATS.call("Mesh.calc_loop_triangles")
+        self.loop_triangles = Collection(loops=self._triangles)
+
+    def calc_normals_split(self):
+        stubs.STATS.call("Mesh.calc_normals_split")
+
+    def calc_tangents(self, uvmap=""):
+        stubs.STATS.call("Mesh.calc_tangents")
+        if not self.uv_layers.active:
+            raise RuntimeError("no UV map")
+        self.loops.arrays["tangent"][:] = (1, 0, 0)
+        self.loops.arrays["bitangent"][:] = (0, 1, 0)
+
+class FakeMaterial(stubs.Material):
+    def __init__(self, name, shading_model="TOON"):
+        super().__init__(name)
+        self.diffuse_color = (0.8, 0.8, 0.8, 1.0)
+        self.custom_settings = types.SimpleNamespace(
+            tex_base_color="", tex_shadow_tint="", col_shadow_tint=(1, 1, 1),
+            shading_model=shading_model, f_sm_param=0.0)
+        self.node_tree = None
+        self.use_nodes = False
+
+class Pixels:
+    def __init__(self, size):
+        self.size = size
+
+    def __len__(self):
+        return self.size[0] * self.size[1] * 4
+
+    def foreach_get(self, out):
+        stubs.STATS.call("Image.pixels.foreach_get")
+        out[...] = 0.5
+
+class FakeImage(stubs.Image):
+    def __init__(self, name, size=(2048, 2048)):
+        super().__init__(name)
+        self.size = size
+        self.is_float = False
+        self.is_dirty = False
+        self.source = "FILE"
+        self.filepath_raw = f"//textures/{name}.png"
+        self.filepath = self.filepath_raw
+        self.original = self
+        self.packed_file = None
+        self.library = None
+        self.colorspace_settings = types.SimpleNamespace(name="sRGB")
+        self.pixels = Pixels(size)
+
+    def as_pointer(self):
+        return id(self)
+
+class FakeObject(stubs.Object):
+    def __init__(self, name, type, data, matrix_world=None, material=None):
+        super().__init__(name)
+        self.type = type
+        self.data = data
+        self.matrix_world = matrix_world if matrix_world is not None else stubs.Matrix()
+        self.active_material = material
+        self.users_collection = []
+        self.hide_viewport = False
+        self.mode = "OBJECT"
+        self.modifiers = []
+
+    def evaluated_get(self, depsgraph):
+        return self
+
+class FakeCamera(FakeObject):
+    def __init__(self, name, matrix_world):
+        super().__init__(name, "CAMERA", types.SimpleNamespace(type="PERSP", lens=50.0), matrix_world)
+
+    # same projection as view_context
+    def calc_matrix_camera(self, depsgraph, x=1, y=1, scale_x=1.0, scale_y=1.0):
+        aspect = (x * scale_x) / (y * scale_y)
+        f = 1.0 / math.tan(math.radians(50) / 2)
+        near, far = 0.1, 1000.0
+        return stubs.Matrix((
+            (f / aspect, 0, 0, 0),
+            (0, f, 0, 0),
+            (0, 0, (far + near) / (near - far), 2 * far * near / (near - far)),
+            (0, 0, -1, 0)))
+
+class FakeLight(stubs.Light):
+    def __init__(self, name, type):
+        super().__init__(name)
+        self.type = type
+        self.energy = 10.0
+        self.color = (1.0, 1.0, 1.0)
+        # like Blender's SunLight and PointLight, only spot lights have a cone
+        if type == "SPOT":
+            self.spot_size = math.pi / 4
+            self.spot_blend = 0.15
+        self.use_custom_distance = False
+        self.cutoff_distance = 40.0
+        self.shadow_soft_size = 0.25
+        self.angle = 0.01
+        self.use_shadow = True
+
+class Instance:
+    def __init__(self, object, matrix_world=None):
+        self.object = object
+        self.matrix_world = matrix_world if matrix_world is not None else object.matrix_world
+        self.is_instance = matrix_world is not None
+
+class Update:
+    def __init__(self, id, geometry=False, shading=False, transform=False):
+        self.id = id
+        self.is_updated_geometry = geometry
+        self.is_updated_shading = shading
+        self.is_updated_transform = transform
+
+class FakeDepsgraph:
+    def __init__(self, scene, ids, instances, updates=()):
+        self.scene = scene
+        self.ids = ids
+        self.object_instances = instances
+        self.updates = list(updates)
+
+    def id_type_updated(self, id_type):
+        type_map = {"OBJECT": stubs.Object, "MATERIAL": stubs.Material, "MESH": stubs.Mesh, "LIGHT": stubs.Light, "IMAGE": stubs.Image}
+        return any(isinstance(update.id, type_map.get(id_type, ())) for update in self.updates)
+
+class Scene:
+    def __init__(self, objects=100, materials=10, lights=4, instances=0, resolution=16, settings=None, textures=0):
+        self.custom_render_engine = settings
+        self.render = types.SimpleNamespace(resolution_x=1920, resolution_y=1080, resolution_percentage=100,
+            fps=24, fps_base=1.0, film_transparent=False, filepath="", pixel_aspect_x=1.0, pixel_aspect_y=1.0,
+            use_file_extension=True, frame_path=lambda frame=None: f"{self.render.filepath}{frame:04d}.png")
+        self.frame_current = 1
+        self.frame_start = 1
+        self.frame_end = 1
+        self.frame_step = 1
+        # the camera's world matrix, view_context's view matrix inverted
+        self.camera = FakeCamera("Camera", stubs.Matrix.Translation((0, 0, 30)))
+        self.materials = [FakeMaterial(f"Material.{i:03d}", ("LAMBERT", "TOON", "UNLIT")[i % 3]) for i in range(max(materials, 1))]
+        # materials share the images round robin, like a character's texture set
+        self.images = [FakeImage(f"Texture.{i:03d}") for i in range(textures)]
+        stubs.bpy.data.images.clear()
+        for image in self.images:
+            stubs.bpy.data.images[image.name] = image
+        for i, material in enumerate(self.materials):
+            if self.images:
+                material.custom_settings.tex_base_color = self.images[i % len(self.images)].name
+                material.custom_settings.tex_shadow_tint = self.images[(i + 1) % len(self.images)].name
+        self.meshes = [FakeMesh(f"Mesh.{i:03d}", resolution) for i in range(objects)]
+        self.objects = []
+        side = max(1, int(math.ceil(math.sqrt(max(objects, 1)))))
+        for i, mesh in enumerate(self.meshes):
+            matrix = stubs.Matrix.Translation((3 * (i % side), 3 * (i // side), 0))
+            self.objects.append(FakeObject(f"Object.{i:03d}", "MESH", mesh, matrix, self.materials[i % len(self.materials)]))
+        for i in range(lights):
+            light = FakeLight(f"Light.{i:03d}", ("SUN", "POINT", "SPOT")[i % 3])
+            matrix = stubs.Matrix.Translation((i, 0, 5))
+            self.objects.append(FakeObject(f"Light.{i:03d}", "LIGHT", light, matrix))
+
+        self.instances = [Instance(o) for o in self.objects]
+        for i in range(instances):
+            source = self.objects[i % objects] if objects else None
+            if source:
+                self.instances.append(Instance(source, stubs.Matrix.Translation((-3 * (i + 1), 0, 0))))
+
+    def frame_set(self, frame):
+        self.frame_current = frame
+
+    def depsgraph(self, updates=()):
+        ids = list(self.objects) + list(self.meshes) + list(self.materials) + list(self.images)
+        return FakeDepsgraph(self, ids, self.instances, updates)
+
+def view_context(scene, width=1920, height=1080):
+    stubs.set_viewport(width, height)
+    aspect = width / height
+    f = 1.0 / math.tan(math.radians(50) / 2)
+    near, far = 0.1, 1000.0
+    window = stubs.Matrix((
+        (f / aspect, 0, 0, 0),
+        (0, f, 0, 0),
+        (0, 0, (far + near) / (near - far), 2 * far * near / (near - far)),
+        (0, 0, -1, 0)))
+    view = stubs.Matrix.Translation((0, 0, -30))
+    region_data = types.SimpleNamespace(window_matrix=window, view_matrix=view, perspective_matrix=window @ view,
+        is_perspective=True, view_distance=30.0)
+    return types.SimpleNamespace(
+        region=types.SimpleNamespace(width=width, height=height),
+        space_data=types.SimpleNamespace(shading=types.SimpleNamespace(type="RENDERED")),
+        region_data=region_data,
+        scene=scene,
+        engine="CUSTOM")
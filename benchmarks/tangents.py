@@ -0,0 +1,107 @@
+"""
+Compares modules/tangents.py with Mesh.calc_tangents, needs a real Blender:
+
+    blender -b --factory-startup --python benchmarks/tangents.py -- --resolutions 256 512 1024
+
+Times both on UV spheres and subdivided grids and reports how far the tangents are apart
+(largest angle in degrees) and how many bitangent signs differ.
+"""
+
+import argparse
+import json
+import math
+import os
+import sys
+import time
+
+import bpy
+import numpy as np
+
+ADDON_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "custom_render_engine")
+
+def create_mesh(kind, resolution):
+    import bmesh
+
+    bm = bmesh.new()
+    if kind == "sphere":
+        bmesh.ops.create_uvsphere(bm, u_segments=resolution, v_segments=resolution // 2, radius=1, calc_uvs=True)
+    else:
+        bmesh.ops.create_grid(bm, x_segments=resolution, y_segments=resolution, size=1, calc_uvs=True)
+        for vert in bm.verts:
+            vert.co.z = 0.1 * math.sin(vert.co.x * 3) * math.cos(vert.co.y * 3)
+    mesh = bpy.data.meshes.new(f"{kind}{resolution}")
+    bm.to_mesh(mesh)
+    bm.free()
+    for polygon in mesh.polygons:
+        polygon.use_smooth = True
+    return mesh
+
+def extract(mesh):
+    loops = len(mesh.loops)
+    coords = np.empty((len(mesh.vertices), 3), dtype=np.float32)
+    mesh.vertices.foreach_get("co", np.reshape(coords, -1))
+    loop_vertices = np.empty(loops, dtype=np.intc)
+    mesh.loops.foreach_get("vertex_index", loop_vertices)
+    normals = np.empty((loops, 3), dtype=np.float32)
+    mesh.loops.foreach_get("normal", np.reshape(normals, -1))
+    uvs = np.empty((loops, 2), dtype=np.float32)
+    mesh.uv_layers.active.data.foreach_get("uv", np.reshape(uvs, -1))
+    triangles = np.empty((len(mesh.loop_triangles), 3), dtype=np.intc)
+    mesh.loop_triangles.foreach_get("loops", np.reshape(triangles, -1))
+    return coords[loop_vertices], normals, uvs, triangles
+
+def bench(kind, resolution, repeat):
+    from modules.tangents import calc_tangents
+
+    mesh = create_mesh(kind, resolution)
+    mesh.calc_loop_triangles()
+    mesh.calc_normals_split()
+    arrays = extract(mesh)
+
+    blender_times, numpy_times = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        mesh.calc_tangents()
+        blender_times.append((time.perf_counter() - start) * 1000.0)
+        start = time.perf_counter()
+        tangents, signs = calc_tangents(*arrays)
+        numpy_times.append((time.perf_counter() - start) * 1000.0)
+
+    loops = len(mesh.loops)
+    expected = np.empty((loops, 3), dtype=np.float32)
+    mesh.loops.foreach_get("tangent", np.reshape(expected, -1))
+    expected_signs = np.empty(loops, dtype=np.float32)
+    mesh.loops.foreach_get("bitangent_sign", expected_signs)
+    cosines = np.clip(np.sum(tangents * expected, axis=1), -1, 1)
+    result = {
+        "loops": loops,
+        "calc_tangents_ms": min(blender_times),
+        "numpy_ms": min(numpy_times),
+        "max_angle_deg": float(np.degrees(np.arccos(cosines.min()))),
+        "sign_mismatches": int(np.count_nonzero(signs != expected_signs)),
+    }
+    bpy.data.meshes.remove(mesh)
+    return result
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--resolutions", type=int, nargs="+", default=[64, 256, 512])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("-o", "--output", help="write results as JSON to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    if ADDON_DIR not in sys.path:
+        sys.path.insert(0, ADDON_DIR)
+    results = {}
+    for kind in ("grid", "sphere"):
+        for resolution in args.resolutions:
+            results[f"{kind}_{resolution}"] = bench(kind, resolution, args.repeat)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main(sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else [])
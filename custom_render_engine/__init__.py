@@ -8,31 +8,27 @@ bl_info = {
     "category": "Render",
 }
 
-import os, sys
-
-if os.name == 'nt':
-    delimiter = '\\'
-if os.name == 'posix':
-    delimiter = '/'
-if not delimiter:
-    raise RuntimeError("Platform not supported")
-names = __file__.split(delimiter)
-path = delimiter.join(names[:len(names)-1])
-
-sys.path.append(path)
-os.chdir(path)
-
-from modules import custom_render_engine, operators, material
+if __package__:
+    from .modules import custom_render_engine, operators, material, profiler, final_render
+else:
+    # run as a script (launch_blender.js passes this file to --python)
+    import os, sys
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    from modules import custom_render_engine, operators, material, profiler, final_render
 
 def register():
     custom_render_engine.register()
     operators.register()
     material.register()
+    profiler.register()
+    final_render.register()
 
 def unregister():
     custom_render_engine.unregister()
     operators.unregister()
     material.unregister()
+    profiler.unregister()
+    final_render.unregister()
 
 if __name__ == "__main__":
     register()
\ No newline at end of file
@@ -0,0 +1,604 @@
+import numpy as np
+
+# The final frame in NumPy, for render nodes without a GPU and as a reference to compare
+# renders against. It's the GPU pipeline stage by stage: the G-buffer of BasePassPixelShader.glsl
+# (outline shells included), shadow maps, the lights of DeferredLightPixelShader.glsl and
+# FXAA311.glsl at quality preset 12, with the same formats (16 bit unorm color targets,
+# 24 bit depth) so the same values come out. Only the rasterizer's sub-pixel precision and
+# the texture filtering hardware can't be matched exactly.
+#
+# Images are rendered in independent tiles, every pixel only depends on the scene and never
+# on the tile it's in, so any tile size and thread count gives the same image. Scenes are
+# plain dicts of arrays made by cpu_render.py. This module doesn't import bpy or anything
+# from the add-on, so it can be tested and used on its own.
+
+# same values as material.py and light_buffer.py, which can't be imported here
+SHADINGMODEL_UNLIT = 0
+SHADINGMODEL_LAMBERT = 1
+SHADINGMODEL_TOON = 2
+LIGHT_SUN = 0
+LIGHT_POINT = 1
+LIGHT_SPOT = 2
+
+# the constants of DeferredLightPixelShader.glsl
+PI = 3.1416
+SHADOW_BIAS = 0.0005
+SHADOW_NORMAL_OFFSET = 0.02
+LUMA = (0.3, 0.59, 0.11)
+
+TILE_SIZE = 128
+# fragments rasterized at once, bounds the memory a tile takes
+MAX_FRAGMENTS = 1 << 22
+# window coordinates are snapped to 1/256 of a pixel like GPUs do, which also makes the edge
+# functions exact in double precision
+SUBPIXEL = 256
+DEPTH_MAX = (1 << 24) - 1
+
+# FXAA quality preset 12 and the arguments PIXEL_FXAA passes to FxaaPixelShader
+FXAA_STEPS = (1.0, 1.5, 2.0, 4.0, 12.0)
+FXAA_SUBPIX = 0.5
+FXAA_EDGE_THRESHOLD = 0.125
+FXAA_EDGE_THRESHOLD_MIN = 0.0312
+# how far FXAA reads from the pixel it filters: the edge search, half a pixel across the
+# edge and the bilinear footprint. Tiles are filtered with this much of the image around them.
+FXAA_APRON = 24
+
+def get_tiles(width, height, tile_size=TILE_SIZE):
+    return [(x, y, min(x + tile_size, width), min(y + tile_size, height))
+        for y in range(0, height, tile_size) for x in range(0, width, tile_size)]
+
+# Render targets store 16 bit unorm (RGBA16) and 24 bit depth
+def store_unorm16(x):
+    return np.round(np.clip(x, 0, 1) * 65535) / 65535
+
+def store_half(x):
+    return x.astype(np.float16).astype(np.float32)
+
+def get_luma(rgb):
+    return rgb @ np.array(LUMA)
+
+def transform(matrix, points):
+    points = np.asarray(points)
+    homogeneous = np.concatenate((points, np.ones(points.shape[:-1] + (1,), dtype=points.dtype)), axis=-1)
+    return homogeneous @ np.asarray(matrix, dtype=points.dtype).T
+
+# Clips (n, 3, 4) clip space triangles against the near plane. Returns the clipped triangles,
+# the barycentrics of their corners in the triangle they came from (n, 3, 3) and its index.
+# Corners stay in order, so the winding doesn't change.
+def clip_near(clip):
+    d = clip[..., 2] + clip[..., 3]
+    inside = d >= 0
+    count = inside.sum(axis=1)
+    eye = np.eye(3)
+    keep = np.nonzero(count == 3)[0]
+    out_clip = [clip[keep]]
+    out_bary = [np.broadcast_to(eye, (len(keep), 3, 3))]
+    out_source = [keep]
+    for inside_count in (1, 2):
+        triangles = np.nonzero(count == inside_count)[0]
+        if not len(triangles):
+            continue
+        # rotate the corner that's alone on its side of the plane to the front
+        alone = inside[triangles] if inside_count == 1 else ~inside[triangles]
+        order = (np.argmax(alone, axis=1)[:, None] + np.arange(3)) % 3
+        c = np.take_along_axis(clip[triangles], order[..., None], axis=1)
+        dd = np.take_along_axis(d[triangles], order, axis=1)
+        b = eye[order]
+
+        def cut(i, j):
+            t = (dd[:, i] / (dd[:, i] - dd[:, j]))[:, None]
+            return c[:, i] + (c[:, j] - c[:, i]) * t, b[:, i] + (b[:, j] - b[:, i]) * t
+
+        if inside_count == 1:
+            c01, b01 = cut(0, 1)
+            c02, b02 = cut(0, 2)
+            out_clip.append(np.stack((c[:, 0], c01, c02), axis=1))
+            out_bary.append(np.stack((b[:, 0], b01, b02), axis=1))
+            out_source.append(triangles)
+        else:
+            # the quad left of the triangle, as two triangles
+            c01, b01 = cut(0, 1)
+            c20, b20 = cut(2, 0)
+            out_clip += [np.stack((c01, c[:, 1], c[:, 2]), axis=1), np.stack((c01, c[:, 2], c20), axis=1)]
+            out_bary += [np.stack((b01, b[:, 1], b[:, 2]), axis=1), np.stack((b01, b[:, 2], b20), axis=1)]
+            out_source += [triangles, triangles]
+    return np.concatenate(out_clip), np.concatenate(out_bary), np.concatenate(out_source)
+
+# Triangle setup for a target of size (width, height): clipping, perspective divide, the
+# viewport transform and culling (counter-clockwise is front, like GL). Without culling, back
+# faces are turned around so every triangle is counter-clockwise. Rows are bottom to top.
+def setup_triangles(clip, size, cull=True):
+    width, height = size
+    clip, bary, source = clip_near(np.asarray(clip, dtype=np.float64))
+    w = clip[..., 3]
+    valid = np.all(w > 0, axis=1)
+    clip, bary, source, w = clip[valid], bary[valid], source[valid], w[valid]
+    inv_w = 1 / w
+    ndc = clip[..., :3] * inv_w[..., None]
+    x = np.round((ndc[..., 0] * 0.5 + 0.5) * width * SUBPIXEL) / SUBPIXEL
+    y = np.round((ndc[..., 1] * 0.5 + 0.5) * height * SUBPIXEL) / SUBPIXEL
+    z = ndc[..., 2] * 0.5 + 0.5
+    area = (x[:, 1] - x[:, 0]) * (y[:, 2] - y[:, 0]) - (x[:, 2] - x[:, 0]) * (y[:, 1] - y[:, 0])
+
+    if cull:
+        keep = area > 0
+    else:
+        keep = area != 0
+        flip = np.nonzero(area < 0)[0]
+        for a in (x, y, z, inv_w, bary):
+            a[flip, 1], a[flip, 2] = a[flip, 2].copy(), a[flip, 1].copy()
+        area = np.abs(area)
+    x, y, z, inv_w, bary, source, area = x[keep], y[keep], z[keep], inv_w[keep], bary[keep], source[keep], area[keep]
+
+    # pixels whose center is inside the bounds
+    bbox = np.stack((
+        np.ceil(x.min(axis=1) - 0.5), np.ceil(y.min(axis=1) - 0.5),
+        np.floor(x.max(axis=1) - 0.5), np.floor(y.max(axis=1) - 0.5)), axis=1)
+    bbox = np.clip(bbox, 0, (width - 1, height - 1, width - 1, height - 1)).astype(np.int64)
+    keep = (bbox[:, 0] <= bbox[:, 2]) & (bbox[:, 1] <= bbox[:, 3])
+    return {
+        "x": x[keep], "y": y[keep], "z": z[keep], "inv_w": inv_w[keep], "bary": bary[keep],
+        "source": source[keep], "area": area[keep], "bbox": bbox[keep],
+    }
+
+# The fragments of triangles inside rect (x0, y0, x1, y1), one chunk of at most
+# MAX_FRAGMENTS candidate pixels at a time
+def iter_fragments(triangles, rect):
+    x0, y0, x1, y1 = rect
+    bbox = triangles["bbox"]
+    selected = np.nonzero((bbox[:, 0] < x1) & (bbox[:, 2] >= x0) & (bbox[:, 1] < y1) & (bbox[:, 3] >= y0))[0]
+    if not len(selected):
+        return
+    lo = np.maximum(bbox[selected, :2], (x0, y0))
+    hi = np.minimum(bbox[selected, 2:], (x1 - 1, y1 - 1))
+    extent = hi - lo + 1
+    counts = extent[:, 0] * extent[:, 1]
+    ends = np.cumsum(counts)
+    start = 0
+    while start < len(selected):
+        base = ends[start - 1] if start else 0
+        # a triangle covers at most the tile, so every chunk makes progress
+        stop = max(start + 1, int(np.searchsorted(ends, base + MAX_FRAGMENTS, side="right")))
+        chunk = slice(start, stop)
+        chunk_counts = counts[chunk]
+        index = np.repeat(np.arange(start, stop), chunk_counts)
+        local = np.arange(int(chunk_counts.sum())) - np.repeat(np.cumsum(chunk_counts) - chunk_counts, chunk_counts)
+        px = lo[index, 0] + local % extent[index, 0]
+        py = lo[index, 1] + local // extent[index, 0]
+        yield selected[index], px, py
+        start = stop
+
+# Fragments of the triangles covering pixel centers inside rect that pass the depth range,
+# as (triangle, px, py, depth, barycentrics). Depth is 24 bit, barycentrics are perspective
+# correct and relative to the unclipped triangle. Edges follow the top-left rule, so pixels
+# on an edge shared by two triangles are drawn once.
+def rasterize(triangles, rect):
+    for index, px, py in iter_fragments(triangles, rect):
+        x, y = triangles["x"][index], triangles["y"][index]
+        cx, cy = px + 0.5, py + 0.5
+        inside = np.ones(len(index), dtype=bool)
+        weights = []
+        # the weight of corner k is the edge function of the edge opposite to it
+        for k, (a, b) in enumerate(((1, 2), (2, 0), (0, 1))):
+            dx = x[:, b] - x[:, a]
+            dy = y[:, b] - y[:, a]
+            e = dx * (cy - y[:, a]) - dy * (cx - x[:, a])
+            top_left = (dy < 0) | ((dy == 0) & (dx < 0))
+            inside &= (e > 0) | ((e == 0) & top_left)
+            weights.append(e)
+        weights = np.stack(weights, axis=1)[inside]
+        index, px, py = index[inside], px[inside], py[inside]
+        weights /= triangles["area"][index, None]
+
+        depth = np.round(np.sum(weights * triangles["z"][index], axis=1) * DEPTH_MAX)
+        # in front of the far plane and nearer than the cleared depth
+        visible = (depth >= 0) & (depth < DEPTH_MAX)
+        index, px, py, depth, weights = index[visible], px[visible], py[visible], depth[visible], weights[visible]
+
+        perspective = weights * triangles["inv_w"][index]
+        perspective /= perspective.sum(axis=1, keepdims=True)
+        bary = np.einsum("fk,fkj->fj", perspective, triangles["bary"][index])
+        yield index, px, py, depth.astype(np.int64), bary
+
+# Nearest fragment of every pixel (depth test LESS), ties go to the lower order, the one
+# drawn first. Returns the indices of the fragments that were kept.
+def resolve(pixel, depth, order):
+    sort = np.lexsort((order, depth, pixel))
+    first = np.ones(len(sort), dtype=bool)
+    first[1:] = pixel[sort[1:]] != pixel[sort[:-1]]
+    return sort[first]
+
+# Depth of the triangles inside rect, cleared to 1 (no culling, like the shadow pass)
+def rasterize_depth(triangles, rect):
+    x0, y0, x1, y1 = rect
+    depth = np.full((y1 - y0) * (x1 - x0), DEPTH_MAX, dtype=np.int64)
+    for _, px, py, fragment_depth, _ in rasterize(triangles, rect):
+        np.minimum.at(depth, (py - y0) * (x1 - x0) + (px - x0), fragment_depth)
+    return depth.reshape(y1 - y0, x1 - x0) / DEPTH_MAX
+
+def mix_texels(image, ix0, ix1, iy0, iy1, fx, fy):
+    fx = fx[:, None]
+    fy = fy[:, None]
+    top = image[iy1, ix0] * (1 - fx) + image[iy1, ix1] * fx
+    bottom = image[iy0, ix0] * (1 - fx) + image[iy0, ix1] * fx
+    return bottom * (1 - fy) + top * fy
+
+# Bilinear sample of a (height, width, channels) image at repeating texture coordinates (n, 2)
+def sample_bilinear(image, uv):
+    height, width = image.shape[:2]
+    x = uv[:, 0] * width - 0.5
+    y = uv[:, 1] * height - 0.5
+    ix = np.floor(x).astype(np.int64)
+    iy = np.floor(y).astype(np.int64)
+    return mix_texels(image, ix % width, (ix + 1) % width, iy % height, (iy + 1) % height, x - ix, y - iy)
+
+# Bilinear sample clamped to the edge, at offsets (dx, dy) in pixels from the centers of pixels
+# (px, py). Offsets are kept relative so the arithmetic doesn't depend on where the pixel is.
+def sample_offset(image, px, py, dx, dy):
+    height, width = image.shape[:2]
+    ix = np.floor(dx).astype(np.int64)
+    iy = np.floor(dy).astype(np.int64)
+    x = px + ix
+    y = py + iy
+    return mix_texels(image, np.clip(x, 0, width - 1), np.clip(x + 1, 0, width - 1),
+        np.clip(y, 0, height - 1), np.clip(y + 1, 0, height - 1), dx - ix, dy - iy)
+
+# The G-buffer of rect, what the base pass writes: basecolor, shadowcolor, normal (rgba),
+# shadingmodel and depth, (height, width, ...) arrays
+def draw_gbuffer(scene, rect):
+    x0, y0, x1, y1 = rect
+    width, height = x1 - x0, y1 - y0
+    triangles = scene["triangles"]
+    primitive_order = scene["primitive_order"]
+
+    # nearest fragment per chunk, then over the chunks
+    kept = []
+    for index, px, py, depth, bary in rasterize(triangles, rect):
+        pixel = (py - y0) * width + (px - x0)
+        primitive = triangles["source"][index]
+        best = resolve(pixel, depth, primitive_order[primitive])
+        kept.append((pixel[best], depth[best], primitive[best], bary[best]))
+    if kept:
+        pixel, depth, primitive, bary = (np.concatenate(a) for a in zip(*kept))
+        best = resolve(pixel, depth, primitive_order[primitive])
+        pixel, depth, primitive, bary = pixel[best], depth[best], primitive[best], bary[best]
+    else:
+        pixel = primitive = depth = np.zeros(0, dtype=np.int64)
+        bary = np.zeros((0, 3))
+
+    basecolor = np.zeros((height * width, 4))
+    shadowcolor = np.zeros((height * width, 4))
+    normal = np.zeros((height * width, 4))
+    shadingmodel = np.zeros(height * width, dtype=np.uint8)
+    out_depth = np.ones(height * width)
+
+    normal[pixel, :3] = np.einsum("fk,fkj->fj", bary, scene["primitive_normal"][primitive])
+    normal[pixel, 3] = 1
+    out_depth[pixel] = depth / DEPTH_MAX
+
+    material = scene["primitive_material"][primitive]
+    # outline shells
+    outline = pixel[material < 0]
+    basecolor[outline] = scene["outline_color"]
+    shadowcolor[outline] = (0, 0, 0, 1)
+    for m in np.unique(material[material >= 0]):
+        selected = material == m
+        where = pixel[selected]
+        uv = np.einsum("fk,fkj->fj", bary[selected], scene["primitive_uv"][primitive[selected]])
+        texture = scene["tex_basecolor"][m]
+        color = sample_bilinear(texture, uv)[:, :3] if texture is not None else np.ones((len(uv), 3))
+        basecolor[where, :3] = color * scene["col_basecolor"][m]
+        basecolor[where, 3] = 1
+        texture = scene["tex_shadowtint"][m]
+        tint = sample_bilinear(texture, uv)[:, :3] if texture is not None else np.zeros((len(uv), 3))
+        shadowcolor[where, :3] = basecolor[where, :3] * tint
+        shadowcolor[where, 3] = 1
+        shadingmodel[where] = scene["shadingmodel"][m]
+
+    shape = (height, width)
+    return {
+        "basecolor": store_unorm16(basecolor).reshape(shape + (4,)),
+        "shadowcolor": store_unorm16(shadowcolor).reshape(shape + (4,)),
+        # RGBA32F
+        "normal": normal.astype(np.float32).astype(np.float64).reshape(shape + (4,)),
+        "shadingmodel": shadingmodel.reshape(shape),
+        "depth": out_depth.reshape(shape),
+    }
+
+# GLSL smoothstep, edge0 == edge1 is a step at edge1
+def smoothstep(edge0, edge1, x):
+    if edge1 == edge0:
+        return (x >= edge1).astype(np.float64)
+    t = np.clip((x - edge0) / (edge1 - edge0), 0, 1)
+    return t * t * (3 - 2 * t)
+
+# SampleShadow, 3x3 PCF inside the tile, points outside the tile's frustum are lit
+def sample_shadow(scene, block, tile, world_pos):
+    atlas_size = scene["atlas_size"]
+    p = transform(block["shadow_matrix"][tile].T.astype(np.float64), world_pos)
+    p = p[:, :3] / p[:, 3:] * 0.5 + 0.5
+    lit = np.ones(len(p))
+    inside = np.all((p >= 0) & (p <= 1), axis=1)
+    if not inside.any():
+        return lit
+    p = p[inside]
+    rect = block["shadow_rect"][tile].astype(np.float64)
+    origin = np.round(rect[:2] * atlas_size).astype(np.int64)
+    depth = scene["shadow_depth"][tuple(origin)]
+    texel = 1.0 / atlas_size
+    center = rect[:2] + p[:, :2] * rect[2:]
+    lo = rect[:2] + texel * 0.5
+    hi = rect[:2] + rect[2:] - texel * 0.5
+    total = np.zeros(len(p))
+    for x in (-1, 0, 1):
+        for y in (-1, 0, 1):
+            coords = np.clip(center + np.array((x, y)) * texel, lo, hi)
+            texels = np.clip(np.floor(coords * atlas_size).astype(np.int64) - origin, 0, depth.shape[0] - 1)
+            total += np.where(p[:, 2] - SHADOW_BIAS > depth[texels[:, 1], texels[:, 0]], 0.0, 1.0)
+    lit[inside] = total / 9
+    return lit
+
+# GetShadow, point lights pick the cube face from the major axis of the light to surface vector
+def get_shadow(scene, block, index, world_pos, normal, L):
+    tile_count = int(block["light_shadow"][index][1])
+    if tile_count == 0:
+        return np.ones(len(world_pos))
+    tile = int(block["light_shadow"][index][0])
+    world_pos = world_pos + normal * SHADOW_NORMAL_OFFSET
+    if tile_count != 6:
+        return sample_shadow(scene, block, tile, world_pos)
+    D = -L
+    A = np.abs(D)
+    face = np.where((A[:, 0] >= A[:, 1]) & (A[:, 0] >= A[:, 2]), np.where(D[:, 0] > 0, 0, 1),
+        np.where(A[:, 1] >= A[:, 2], np.where(D[:, 1] > 0, 2, 3), np.where(D[:, 2] > 0, 4, 5)))
+    shadow = np.ones(len(world_pos))
+    for f in np.unique(face):
+        selected = face == f
+        shadow[selected] = sample_shadow(scene, block, tile + f, world_pos[selected])
+    return shadow
+
+# GetLighting for the lights of one packed light block, on lit pixels
+def get_lighting(scene, block, gbuffer):
+    base, shadow_color, N, P, shadingmodel = gbuffer
+    lighting = np.zeros((len(P), 3))
+    for i in range(int(block["light_count"][0])):
+        position = block["light_position"][i].astype(np.float64)
+        color = block["light_color"][i].astype(np.float64)
+        light_type = int(position[3])
+        if light_type == LIGHT_SUN:
+            L = np.broadcast_to(position[:3], P.shape)
+            falloff = np.ones(len(P))
+        else:
+            to_light = position[:3] - P
+            dist = np.sqrt(np.sum(to_light * to_light, axis=1))
+            L = to_light / dist[:, None]
+            falloff = 1 / (dist * dist)
+            if light_type == LIGHT_SPOT:
+                spot = block["light_spot"][i].astype(np.float64)
+                cone = -1 * np.cos(color[3] * PI / 2) + 1
+                # MapRange(1 - dot(L, spot), cone, 0, 0, 1)
+                cone_falloff = np.clip((1 - L @ spot[:3] - cone) / (0 - cone), 0, 1)
+                falloff *= smoothstep(0, spot[3], cone_falloff)
+        final_color = color[:3] * falloff[:, None]
+        if scene["use_shadow"]:
+            shadow = get_shadow(scene, block, i, P, N, L)
+        else:
+            shadow = np.ones(len(P))
+        NdotL = np.sum(N * L, axis=1)
+        lambert = base * (np.clip(NdotL, 0, 1) * shadow)[:, None] * final_color
+        toon_factor = (np.clip(np.ceil(NdotL), 0, 1) * shadow)[:, None]
+        toon = (shadow_color + (base - shadow_color) * toon_factor) * final_color
+        lighting += np.where((shadingmodel == SHADINGMODEL_LAMBERT)[:, None], lambert,
+            np.where((shadingmodel == SHADINGMODEL_TOON)[:, None], toon, 0))
+    return lighting
+
+# ScreenToWorldPos of every pixel of rect
+def get_world_pos(scene, rect, depth):
+    x0, y0, x1, y1 = rect
+    width, height = scene["size"]
+    py, px = np.mgrid[y0:y1, x0:x1]
+    ndc = np.stack(((px + 0.5) / width * 2 - 1, (py + 0.5) / height * 2 - 1, depth * 2 - 1), axis=-1)
+    pos = transform(scene["inverse_view_projection"], ndc.reshape(-1, 3))
+    return pos[:, :3] / pos[:, 3:]
+
+# GetSceneColor, the world color on lit pixels and the background
+def get_scene_color(scene, basecolor, shadingmodel):
+    scene_color = np.asarray(scene["scene_color"][:3], dtype=np.float64)
+    background = scene_color if scene["background"] else np.full(3, 0.05)
+    unlit = basecolor[:, :3] + (background - basecolor[:, :3]) * (1 - basecolor[:, 3:])
+    return np.where((shadingmodel != SHADINGMODEL_UNLIT)[:, None], basecolor[:, :3] * scene_color, unlit)
+
+# The lighting passes over the G-buffer of rect: the scene color, then every light block
+# added on top. Each pass writes rgb and luma, blended additively into the 16 bit unorm target.
+# With pass fusion the first block is applied in the same pass as the scene color, without
+# it FXAA reads the luma of the final color (the rgbl pass).
+def draw_lighting(scene, rect, gbuffer):
+    basecolor = gbuffer["basecolor"].reshape(-1, 4)
+    shadingmodel = gbuffer["shadingmodel"].ravel()
+    lit = np.nonzero(shadingmodel != SHADINGMODEL_UNLIT)[0]
+    world_pos = get_world_pos(scene, rect, gbuffer["depth"])[lit]
+    inputs = (basecolor[lit, :3], gbuffer["shadowcolor"].reshape(-1, 4)[lit, :3],
+        gbuffer["normal"].reshape(-1, 4)[lit, :3], world_pos, shadingmodel[lit])
+
+    def add_pass(color, rgb):
+        source = np.concatenate((rgb, get_luma(rgb)[:, None]), axis=1)
+        return store_unorm16(source if color is None else color + source)
+
+    blocks = scene["blocks"]
+    rgb = get_scene_color(scene, basecolor, shadingmodel)
+    if scene["use_pass_fusion"]:
+        rgb[lit] += get_lighting(scene, blocks[0], inputs)
+        blocks = blocks[1:]
+    color = add_pass(None, rgb)
+    for block in blocks:
+        rgb = np.zeros((len(color), 3))
+        rgb[lit] = get_lighting(scene, block, inputs)
+        color = add_pass(color, rgb)
+    if scene["use_fxaa"] and not scene["use_pass_fusion"]:
+        color[:, 3] = store_unorm16(get_luma(color[:, :3]))
+    x0, y0, x1, y1 = rect
+    return color.reshape(y1 - y0, x1 - x0, 4)
+
+# FxaaPixelShader (quality, preset 12) on the pixels of rect inside image. Positions are in
+# pixels from the filtered pixel's center, luma is read from alpha and samples outside the
+# image are clamped to its edge.
+def fxaa(image, rect):
+    x0, y0, x1, y1 = rect
+    height, width = image.shape[:2]
+    py, px = np.mgrid[y0:y1, x0:x1]
+    px, py = px.ravel(), py.ravel()
+    out = image[py, px].copy()
+
+    def luma_at(ox, oy, where):
+        return image[np.clip(py[where] + oy, 0, height - 1), np.clip(px[where] + ox, 0, width - 1), 3]
+
+    def luma_top(pos, where):
+        return sample_offset(image, px[edge[where]], py[edge[where]], pos[where, 0], pos[where, 1])[:, 3]
+
+    everything = slice(None)
+    lumaM = out[:, 3]
+    lumaS = luma_at(0, 1, everything)
+    lumaE = luma_at(1, 0, everything)
+    lumaN = luma_at(0, -1, everything)
+    lumaW = luma_at(-1, 0, everything)
+    rangeMax = np.maximum(np.maximum(lumaN, lumaW), np.maximum(lumaE, np.maximum(lumaS, lumaM)))
+    rangeMin = np.minimum(np.minimum(lumaN, lumaW), np.minimum(lumaE, np.minimum(lumaS, lumaM)))
+    range_ = rangeMax - rangeMin
+    edge = np.nonzero(range_ >= np.maximum(FXAA_EDGE_THRESHOLD_MIN, rangeMax * FXAA_EDGE_THRESHOLD))[0]
+    if not len(edge):
+        return out.reshape(y1 - y0, x1 - x0, 4)
+
+    lumaM, lumaS, lumaE, lumaN, lumaW, range_ = (a[edge] for a in (lumaM, lumaS, lumaE, lumaN, lumaW, range_))
+    lumaNW = luma_at(-1, -1, edge)
+    lumaSE = luma_at(1, 1, edge)
+    lumaNE = luma_at(1, -1, edge)
+    lumaSW = luma_at(-1, 1, edge)
+
+    lumaNS = lumaN + lumaS
+    lumaWE = lumaW + lumaE
+    subpixRcpRange = 1.0 / range_
+    subpixNSWE = lumaNS + lumaWE
+    edgeHorz1 = -2.0 * lumaM + lumaNS
+    edgeVert1 = -2.0 * lumaM + lumaWE
+    lumaNESE = lumaNE + lumaSE
+    lumaNWNE = lumaNW + lumaNE
+    edgeHorz2 = -2.0 * lumaE + lumaNESE
+    edgeVert2 = -2.0 * lumaN + lumaNWNE
+    lumaNWSW = lumaNW + lumaSW
+    lumaSWSE = lumaSW + lumaSE
+    edgeHorz4 = np.abs(edgeHorz1) * 2.0 + np.abs(edgeHorz2)
+    edgeVert4 = np.abs(edgeVert1) * 2.0 + np.abs(edgeVert2)
+    edgeHorz3 = -2.0 * lumaW + lumaNWSW
+    edgeVert3 = -2.0 * lumaS + lumaSWSE
+    edgeHorz = np.abs(edgeHorz3) + edgeHorz4
+    edgeVert = np.abs(edgeVert3) + edgeVert4
+
+    subpixNWSWNESE = lumaNWSW + lumaNESE
+    horzSpan = edgeHorz >= edgeVert
+    subpixA = subpixNSWE * 2.0 + subpixNWSWNESE
+    lumaN = np.where(horzSpan, lumaN, lumaW)
+    lumaS = np.where(horzSpan, lumaS, lumaE)
+    # one pixel either way
+    lengthSign = np.ones(len(edge))
+    subpixB = subpixA * (1.0 / 12.0) - lumaM
+
+    gradientN = lumaN - lumaM
+    gradientS = lumaS - lumaM
+    lumaNN = lumaN + lumaM
+    lumaSS = lumaS + lumaM
+    pairN = np.abs(gradientN) >= np.abs(gradientS)
+    gradient = np.maximum(np.abs(gradientN), np.abs(gradientS))
+    lengthSign = np.where(pairN, -lengthSign, lengthSign)
+    subpixC = np.clip(np.abs(subpixB) * subpixRcpRange, 0, 1)
+
+    posM = np.zeros((len(edge), 2))
+    posB = posM.copy()
+    offNP = np.stack((np.where(horzSpan, 1.0, 0.0), np.where(horzSpan, 0.0, 1.0)), axis=1)
+    posB[:, 0] += np.where(horzSpan, 0, lengthSign * 0.5)
+    posB[:, 1] += np.where(horzSpan, lengthSign * 0.5, 0)
+
+    posN = posB - offNP * FXAA_STEPS[0]
+    posP = posB + offNP * FXAA_STEPS[0]
+    subpixD = -2.0 * subpixC + 3.0
+    lumaEndN = luma_top(posN, everything)
+    subpixE = subpixC * subpixC
+    lumaEndP = luma_top(posP, everything)
+
+    lumaNN = np.where(pairN, lumaNN, lumaSS)
+    gradientScaled = gradient * 1.0 / 4.0
+    lumaMM = lumaM - lumaNN * 0.5
+    subpixF = subpixD * subpixE
+    lumaMLTZero = lumaMM < 0.0
+
+    lumaEndN -= lumaNN * 0.5
+    lumaEndP -= lumaNN * 0.5
+    doneN = np.abs(lumaEndN) >= gradientScaled
+    doneP = np.abs(lumaEndP) >= gradientScaled
+    posN -= offNP * (FXAA_STEPS[1] * ~doneN)[:, None]
+    posP += offNP * (FXAA_STEPS[1] * ~doneP)[:, None]
+    doneNP = ~doneN | ~doneP
+    # the nested search steps, pixels drop out once both ends are found
+    for step in FXAA_STEPS[2:]:
+        searchN = np.nonzero(doneNP & ~doneN)[0]
+        searchP = np.nonzero(doneNP & ~doneP)[0]
+        lumaEndN[searchN] = luma_top(posN, searchN) - lumaNN[searchN] * 0.5
+        lumaEndP[searchP] = luma_top(posP, searchP) - lumaNN[searchP] * 0.5
+        doneN = np.where(doneNP, np.abs(lumaEndN) >= gradientScaled, doneN)
+        doneP = np.where(doneNP, np.abs(lumaEndP) >= gradientScaled, doneP)
+        posN -= offNP * (step * (doneNP & ~doneN))[:, None]
+        posP += offNP * (step * (doneNP & ~doneP))[:, None]
+        doneNP = doneNP & (~doneN | ~doneP)
+
+    dstN = np.where(horzSpan, posM[:, 0] - posN[:, 0], posM[:, 1] - posN[:, 1])
+    dstP = np.where(horzSpan, posP[:, 0] - posM[:, 0], posP[:, 1] - posM[:, 1])
+    goodSpanN = (lumaEndN < 0.0) != lumaMLTZero
+    spanLength = dstP + dstN
+    goodSpanP = (lumaEndP < 0.0) != lumaMLTZero
+    spanLengthRcp = 1.0 / spanLength
+    directionN = dstN < dstP
+    dstMin = np.minimum(dstN, dstP)
+    goodSpan = np.where(directionN, goodSpanN, goodSpanP)
+    subpixG = subpixF * subpixF
+    pixelOffset = dstMin * -spanLengthRcp + 0.5
+    subpixH = subpixG * FXAA_SUBPIX
+    pixelOffsetGood = np.where(goodSpan, pixelOffset, 0.0)
+    pixelOffsetSubpix = np.maximum(pixelOffsetGood, subpixH)
+    posM[:, 0] += np.where(horzSpan, 0, pixelOffsetSubpix * lengthSign)
+    posM[:, 1] += np.where(horzSpan, pixelOffsetSubpix * lengthSign, 0)
+    out[edge] = sample_offset(image, px[edge], py[edge], posM[:, 0], posM[:, 1])
+    return out.reshape(y1 - y0, x1 - x0, 4)
+
+# Tasks of the thread pool, every one only reads the scene and returns its own arrays
+
+# Depth of one shadow map tile, of the casters in its light's bounds
+def render_shadow_tile(scene, task):
+    origin, view_projection, objects = task
+
+    size = scene["tile_size"]
+    selected = np.isin(scene["caster_object"], objects)
+    clip = transform(view_projection, scene["caster_positions"][selected])
+    triangles = setup_triangles(clip, (size, size), cull=False)
+    return origin, rasterize_depth(triangles, (0, 0, size, size))
+
+# G-buffer and lighting of one image tile
+def render_tile(scene, rect):
+    gbuffer = draw_gbuffer(scene, rect)
+    lit = draw_lighting(scene, rect, gbuffer)
+    if not scene["keep_gbuffer"]:
+        return rect, {"lit": lit}
+    gbuffer["lit"] = lit
+    return rect, gbuffer
+
+# FXAA of one tile, from the part of the lit image around it
+def fxaa_tile(task):
+    rect, image, origin = task
+    x0, y0, x1, y1 = rect
+    ox, oy = origin
+    return rect, fxaa(image, (x0 - ox, y0 - oy, x1 - ox, y1 - oy))
+
+def get_fxaa_task(image, rect):
+    height, width = image.shape[:2]
+    x0, y0, x1, y1 = rect
+    ax0, ay0 = max(0, x0 - FXAA_APRON), max(0, y0 - FXAA_APRON)
+    ax1, ay1 = min(width, x1 + FXAA_APRON), min(height, y1 + FXAA_APRON)
+    return rect, image[ay0:ay1, ax0:ax1], (ax0, ay0)
@@ -0,0 +1,307 @@
+import concurrent.futures
+import functools
+import math
+import os
+import types
+
+import bpy
+import mathutils
+import numpy as np
+
+from . import cpu_raster
+from .light_buffer import pack_lights
+from .material import CustomRenderEngineMaterialSettings
+from .profiler import PROFILER
+from .shadow_cache import ShadowCache, spheres_intersect
+from .tangents import calc_tangents
+from .texture_proxy import srgb_to_linear
+
+# Final frames without a GPU: the depsgraph is turned into arrays here and drawn by
+# cpu_raster.py, on image tiles spread over a pool of threads. Everything the GPU path
+# reads from Blender is read the same way (loop triangles, split normals, tangents, the
+# active material, packed lights, shadow map projections from a ShadowCache), so the two
+# render the same frame.
+
+# GeometryShader.glsl's OFFSET_SCALE
+OUTLINE_OFFSET_SCALE = 0.01
+
+# out buffers cpu_raster can present, the others render the lit image
+OUT_BUFFERS = ("SCENELIT", "BASECOLOR", "SHADOWCOLOR", "NORMAL", "DEPTH", "POSITION")
+
+def get_thread_count(settings):
+    return settings.cpu_threads or os.cpu_count() or 1
+
+def normalize(vectors):
+    length = np.sqrt(np.sum(vectors * vectors, axis=-1, keepdims=True))
+    return np.divide(vectors, length, out=np.zeros_like(vectors), where=length > 0)
+
+# The loop attributes MeshDraw.build_batch uploads, with bounds like MeshDraw's
+def extract_mesh(mesh):
+    mesh.calc_loop_triangles()
+    mesh.calc_normals_split()
+    loops = len(mesh.loops)
+    color = np.full((loops, 4), [0.5, 0.5, 1, 1], dtype=np.float32)
+    uvs = np.zeros((loops, 2), dtype=np.float32)
+    triangles = np.empty((len(mesh.loop_triangles), 3), dtype=np.intc)
+    if mesh.uv_layers.active:
+        mesh.uv_layers.active.data.foreach_get("uv", np.reshape(uvs, loops * 2))
+    if mesh.vertex_colors.active:
+        mesh.vertex_colors.active.data.foreach_get("color", np.reshape(color, loops * 4))
+    mesh.loop_triangles.foreach_get("loops", np.reshape(triangles, len(mesh.loop_triangles) * 3))
+
+    coords = np.empty((len(mesh.vertices), 3), dtype=np.float32)
+    mesh.vertices.foreach_get("co", np.reshape(coords, len(mesh.vertices) * 3))
+    loop_vertices = np.empty(loops, dtype=np.intc)
+    mesh.loops.foreach_get("vertex_index", loop_vertices)
+    positions = coords[loop_vertices]
+    normals = np.empty((loops, 3), dtype=np.float32)
+    mesh.loops.foreach_get("normal", np.reshape(normals, loops * 3))
+    tangents, signs = calc_tangents(positions, normals, uvs if mesh.uv_layers.active else None, triangles)
+
+    if loops:
+        lo = positions.min(axis=0)
+        hi = positions.max(axis=0)
+        center = (lo + hi) / 2
+        bounds_center = mathutils.Vector(center.tolist())
+        bounds_radius = float(np.linalg.norm(hi - center))
+    else:
+        bounds_center = mathutils.Vector((0, 0, 0))
+        bounds_radius = 0.0
+    return types.SimpleNamespace(positions=positions, normals=normals, tangents=tangents,
+        bitangent_signs=np.negative(signs), uvs=uvs, color=color, triangles=triangles.astype(np.intp),
+        bounds_center=bounds_center, bounds_radius=bounds_radius)
+
+# VertexShader.glsl: world positions, and normals and tangents normalized after the transform
+def to_world(mesh, matrix_world):
+    matrix = np.array(matrix_world, dtype=np.float32)
+    rotation = matrix[:3, :3].T
+    return (mesh.positions @ rotation + matrix[:3, 3],
+        normalize(mesh.normals @ rotation), normalize(mesh.tangents @ rotation))
+
+# offset_vertex of GeometryShader.glsl, the outline shell's corners
+def get_outline_positions(positions, normals, tangents, mesh, view_location, settings):
+    offset_normals = normals
+    if settings.use_vertexcolor_rgb:
+        bitangents = normalize(np.cross(normals, tangents) * mesh.bitangent_signs[:, None])
+        local = mesh.color[:, :3] * 2 - 1
+        offset_normals = tangents * local[:, 0:1] + bitangents * local[:, 1:2] + normals * local[:, 2:3]
+    view_distance = np.linalg.norm(positions - view_location, axis=1) ** settings.outline_depth_exponent
+    vertex_offset_scale = mesh.color[:, 3] if settings.use_vertexcolor_alpha else 1
+    offset = OUTLINE_OFFSET_SCALE * vertex_offset_scale * settings.outline_width * view_distance
+    return positions + offset_normals * offset[:, None].astype(np.float32)
+
+# linear pixels, like the GPU sees them after the sRGB decode
+def load_texture(image):
+    width, height = image.size
+    pixels = np.empty(width * height * 4, dtype=np.float32)
+    image.pixels.foreach_get(pixels)
+    pixels = pixels.reshape(height, width, 4)
+    if not image.is_float and image.colorspace_settings.name == "sRGB":
+        pixels[..., :3] = srgb_to_linear(pixels[..., :3])
+    return pixels
+
+# MeshMaterialShader's flat properties, node trees aren't evaluated
+def get_material_parameters(materials):
+    textures = {}
+
+    def get_texture(material, prop):
+        try:
+            image = bpy.data.images[getattr(material.custom_settings, prop)]
+        except (AttributeError, KeyError):
+            return None
+        if image.name not in textures:
+            textures[image.name] = load_texture(image)
+        return textures[image.name]
+
+    col_basecolor, shadingmodel, tex_basecolor, tex_shadowtint = [], [], [], []
+    for material in materials:
+        if material:
+            col_basecolor.append(tuple(material.diffuse_color[:3]))
+            shadingmodel.append(CustomRenderEngineMaterialSettings.get_shadingmodel_value(
+                material.custom_settings.shading_model))
+        else:
+            col_basecolor.append((1, 1, 1))
+            shadingmodel.append(CustomRenderEngineMaterialSettings.get_shadingmodel_value("LAMBERT"))
+        tex_basecolor.append(get_texture(material, "tex_base_color"))
+        tex_shadowtint.append(get_texture(material, "tex_shadow_tint"))
+    return {
+        "col_basecolor": np.array(col_basecolor, dtype=np.float32).reshape(-1, 3).astype(np.float64),
+        "shadingmodel": np.array(shadingmodel, dtype=np.uint8),
+        "tex_basecolor": tex_basecolor,
+        "tex_shadowtint": tex_shadowtint,
+    }
+
+# Runs function over tasks on a pool of threads, on this one for a single thread. Threads
+# rather than processes: worker processes would start another Blender (or fork its GL and
+# bpy state), and the tiles spend their time in NumPy, which releases the GIL.
+def map_tasks(function, tasks, threads):
+    if threads <= 1 or len(tasks) <= 1:
+        return [function(task) for task in tasks]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(threads, len(tasks))) as executor:
+        return list(executor.map(function, tasks))
+
+# Draws the frame of context (from get_camera_context) with lights (LightRendering). Returns
+# the presented pixels, (height, width, 4) bottom row first like GPU readbacks. readback, if
+# given, is filled with the G-buffer of RENDER_PASSES as (pixels, width, height).
+def render_frame(depsgraph, context, settings, lights, readback=None, threads=None, tile_size=None):
+    threads = threads or get_thread_count(settings)
+    tile_size = tile_size or cpu_raster.TILE_SIZE
+    width, height = context.region.width, context.region.height
+    fb_size = (math.floor(width * settings.backbuffer_scale), math.floor(height * settings.backbuffer_scale))
+    region_data = context.region_data
+    view_projection = region_data.window_matrix @ region_data.view_matrix
+    # the others are reported by CustomRenderEngine.render_cpu
+    out_buffer = settings.out_buffer if settings.out_buffer in OUT_BUFFERS else "SCENELIT"
+
+    with PROFILER.span("cpu:extract"):
+        objects = []
+        names = set()
+        for instance in depsgraph.object_instances:
+            object = instance.object
+            if object.type == 'MESH' and object.name not in names:
+                names.add(object.name)
+                objects.append((object, extract_mesh(object.data)))
+        # front to back like get_opaque_draws, it decides which of two equally deep fragments is kept
+        view_matrix = region_data.view_matrix
+        objects.sort(key=lambda entry: -(view_matrix @ (entry[0].matrix_world @ entry[1].bounds_center)).z)
+
+        materials = []
+        material_indices = {}
+        inverse_view_projection = np.linalg.inv(np.array(view_projection, dtype=np.float64))
+        view_location = inverse_view_projection[:3, 3] / inverse_view_projection[3, 3]
+        positions, normals, uvs, outlines, outline_normals, triangle_material, triangle_object = [], [], [], [], [], [], []
+        casters = {}
+        for index, (object, mesh) in enumerate(objects):
+            material = object.active_material
+            key = material.name if material else None
+            if key not in material_indices:
+                material_indices[key] = len(materials)
+                materials.append(material)
+            world, world_normals, world_tangents = to_world(mesh, object.matrix_world)
+            triangles = mesh.triangles
+            positions.append(world[triangles])
+            normals.append(world_normals[triangles])
+            uvs.append(mesh.uvs[triangles])
+            triangle_material.append(np.full(len(triangles), material_indices[key]))
+            triangle_object.append(np.full(len(triangles), index))
+            if settings.enable_outline:
+                shell = get_outline_positions(world, world_normals, world_tangents, mesh, view_location, settings)
+                # emitted 2, 1, 0, every corner ends up with the normal of the last one
+                outlines.append(shell[triangles[:, ::-1]])
+                outline_normals.append(np.repeat(world_normals[triangles[:, 2]][:, None], 3, axis=1))
+            matrix_world = object.matrix_world
+            casters[object.name] = (matrix_world @ mesh.bounds_center, mesh.bounds_radius * max(matrix_world.to_scale()))
+
+        def concatenate(arrays, shape):
+            return np.concatenate(arrays) if arrays else np.zeros((0,) + shape)
+
+        positions = concatenate(positions, (3, 3)).astype(np.float32)
+        triangle_count = len(positions)
+        primitive_positions = positions
+        primitive_normals = concatenate(normals, (3, 3))
+        primitive_uvs = concatenate(uvs, (3, 2))
+        primitive_material = concatenate(triangle_material, ()).astype(np.int64)
+        # the order the GPU rasterizes them in: every triangle, then its outline
+        primitive_order = np.arange(triangle_count) * 2
+        if settings.enable_outline:
+            primitive_positions = np.concatenate((positions, concatenate(outlines, (3, 3)).astype(np.float32)))
+            primitive_normals = np.concatenate((primitive_normals, concatenate(outline_normals, (3, 3))))
+            primitive_uvs = np.concatenate((primitive_uvs, np.zeros_like(primitive_uvs)))
+            primitive_material = np.concatenate((primitive_material, np.full(triangle_count, -1)))
+            primitive_order = np.concatenate((primitive_order, primitive_order + 1))
+
+    with PROFILER.span("cpu:setup"):
+        clip = cpu_raster.transform(np.array(view_projection, dtype=np.float32), primitive_positions)
+        triangles = cpu_raster.setup_triangles(clip, fb_size)
+    PROFILER.count("cpu_triangles", len(triangles["source"]))
+
+    shadow_depth = {}
+    shadows = ShadowCache()
+    shadow_lights = [light.object for light in lights if light.use_shadow]
+    shadow_maps = {}
+    if shadow_lights:
+        shadows.configure(settings.shadow_budget, settings.shadow_resolution)
+        shadows.update_casters(casters)
+        shadow_maps = shadows.allocate(shadow_lights)
+        tasks = []
+        for entry in shadow_maps.values():
+            objects_in_bounds = [index for index, (object, _) in enumerate(objects)
+                if spheres_intersect(entry.bounds, casters[object.name])]
+            for tile, view_projection_tile in zip(entry.tiles, entry.view_projections):
+                tasks.append((tile, np.array(view_projection_tile, dtype=np.float32), objects_in_bounds))
+        shadow_scene = {
+            "tile_size": shadows.tile_size,
+            "caster_positions": positions,
+            "caster_object": concatenate(triangle_object, ()).astype(np.int64),
+        }
+        with PROFILER.span("cpu:shadows"):
+            shadow_depth = dict(map_tasks(functools.partial(cpu_raster.render_shadow_tile, shadow_scene), tasks, threads))
+        PROFILER.count("shadow_maps", len(shadow_maps))
+
+    # FXAA even with TAA on, a single frame has no history to resolve against
+    use_fxaa = out_buffer == "SCENELIT" and settings.use_fxaa
+    scene = {
+        "size": fb_size,
+        "triangles": triangles,
+        "primitive_order": primitive_order,
+        "primitive_normal": primitive_normals,
+        "primitive_uv": primitive_uvs,
+        "primitive_material": primitive_material,
+        "outline_color": tuple(settings.outline_color),
+        "inverse_view_projection": inverse_view_projection,
+        "blocks": pack_lights(lights, shadow_maps),
+        "use_shadow": bool(shadow_maps),
+        "shadow_depth": shadow_depth,
+        "atlas_size": shadows.atlas_size,
+        "scene_color": tuple(settings.world_color),
+        "background": settings.world_color_clear,
+        "use_pass_fusion": settings.use_pass_fusion,
+        "use_fxaa": use_fxaa,
+        "keep_gbuffer": readback is not None or out_buffer != "SCENELIT",
+    }
+    scene.update(get_material_parameters(materials))
+
+    tiles = cpu_raster.get_tiles(*fb_size, tile_size)
+    with PROFILER.span("cpu:tiles"):
+        results = map_tasks(functools.partial(cpu_raster.render_tile, scene), tiles, threads)
+    buffers = {}
+    for (x0, y0, x1, y1), result in results:
+        for name, pixels in result.items():
+            if name not in buffers:
+                buffers[name] = np.zeros((fb_size[1], fb_size[0]) + pixels.shape[2:], dtype=pixels.dtype)
+            buffers[name][y0:y1, x0:x1] = pixels
+
+    if readback is not None:
+        for name in ("scenelit", "basecolor", "shadowcolor", "normal", "depth", "shadingmodel"):
+            readback[name] = (buffers["lit" if name == "scenelit" else name], *fb_size)
+
+    match out_buffer:
+        case "SCENELIT":
+            lit = buffers["lit"]
+            if use_fxaa:
+                with PROFILER.span("cpu:fxaa"):
+                    tasks = [cpu_raster.get_fxaa_task(lit, rect) for rect in tiles]
+                    pixels = np.zeros_like(lit)
+                    for (x0, y0, x1, y1), filtered in map_tasks(cpu_raster.fxaa_tile, tasks, threads):
+                        pixels[y0:y1, x0:x1] = filtered
+            else:
+                pixels = lit.copy()
+            pixels[..., 3] = 1
+        case "BASECOLOR" | "SHADOWCOLOR":
+            pixels = buffers[out_buffer.lower()]
+        case "NORMAL":
+            pixels = buffers["normal"] * 0.5 + 0.5
+        case "DEPTH":
+            z = buffers["depth"] ** 256
+            pixels = np.stack((z, z, z, np.ones_like(z)), axis=-1)
+        case "POSITION":
+            world_pos = cpu_raster.get_world_pos(scene, (0, 0, *fb_size), buffers["depth"])
+            pixels = np.concatenate((np.mod(world_pos, 1), np.ones((len(world_pos), 1))), axis=1)
+            pixels = pixels.reshape(fb_size[1], fb_size[0], 4)
+
+    if fb_size != (width, height):
+        rows = ((np.arange(height) + 0.5) * fb_size[1] / height).astype(np.intp)
+        columns = ((np.arange(width) + 0.5) * fb_size[0] / width).astype(np.intp)
+        pixels = pixels[rows[:, None], columns]
+    # the RGBA16F offscreen target
+    return cpu_raster.store_half(pixels)
@@ -3,22 +3,34 @@ Simple Render Engine
 ++++++++++++++++++++
 """
 
+import collections
 import math
+import sys
+import types
 import typing
 
 import bpy
 import gpu
-from gpu_extras.batch import batch_for_shader
 import mathutils
-import numpy as np
 
 from .material import CustomRenderEngineMaterialSettings
+from .resources import get_shader_source
+from .temporal_aa import TemporalAA
+from .profiler import PROFILER, draw_profiler
+from .shader_cache import SHADERS
+from .texture_cache import TEXTURES, image_key, texture_key
+from .frame_graph import FrameGraph, TexturePool
+from .shadow_cache import ShadowCache, look_at, perspective
+from .scene_cache import SCENE, SceneHandles
+from .gpu_memory import GPU_MEMORY
+from .light_tiles import (LightTiles, VERTEX_TILES, TILE_CLASS_NONE, get_tile_count, get_tile_classes,
+    get_tile_defines, compile_classify_shader)
+from .lighting_upsample import LIGHTING_SCALES, get_low_size, get_upsample_defines, get_depth_linearize
+# The subsystems that need numpy or start threads (lod, light_buffer, image_io, material_preview,
+# node_compiler, cpu_render, tangents, static_batching) are imported where they're first used,
+# registering the add-on only loads what the panels and settings need.
 # print(material.__name__, flush=True)
 
-VERTEX_SHADER = open("shaders/VertexShader.glsl").read()
-GEOMETRY_SHADER = open("shaders/GeometryShader.glsl").read()
-PIXEL_SHADER = open("shaders/PixelShader.glsl").read()
-
 VERTEX_2D = """
     in vec2 pos;
     out vec2 uv;
@@ -147,6 +159,35 @@ PIXEL_SHADINGMODEL = """
     }
 """
 
+PIXEL_LIGHT_TILES = """
+    uniform usampler2D image;
+    in vec2 uv;
+    out vec4 color;
+
+    void main()
+    {
+        uint shading = texture(image, uv).r;
+        uint lit = shading & uint(LIT_SHADINGMODELS);
+        if (lit == 0u)
+        {
+            // skipped by the light passes, background and unlit geometry alike
+            color = vec4(0, 0, 0, 1);
+        }
+        else if (shading == (1u << SHADINGMODEL_LAMBERT))
+        {
+            color = vec4(1, 0, 0, 1);
+        }
+        else if (shading == (1u << SHADINGMODEL_TOON))
+        {
+            color = vec4(0, 1, 0, 1);
+        }
+        else
+        {
+            color = vec4(1, 1, 0, 1);
+        }
+    }
+"""
+
 # PIXEL_AVG = """
 #     uniform sampler2D image;
 #     uniform sampler2D depth;
@@ -208,73 +249,323 @@ PIXEL_SCENE_LIGHTING = """
             color.rgb = mix(tex.rgb, vec3(.05), 1 - tex.a);
         #endif
         }
-        color.a = 1;
+        color.a = dot(color.rgb, vec3(0.3, 0.59, 0.11));
     }
 """
 
-class CustomRenderEngine(bpy.types.RenderEngine):
-    # These three members are used by blender to set up the
-    # RenderEngine; define its internal name, visible name and capabilities.
-    bl_idname = "CUSTOM"
-    bl_label = "Custom"
-    bl_use_preview = True
+# Depth pre-pass, from the position-only vertex stream. gl_Position is the same expression
+# on the same inputs as in VertexShader.glsl, whose geometry shader passes it through
+# untouched, so the base pass lands on exactly the depth tested against.
+VERTEX_DEPTH = """
+    in vec3 position;
+    uniform mat4 matrix_world;
+    uniform mat4 mat_view_projection;
 
-    # Hides Cycles node trees in the node editor.
-    bl_use_shading_nodes_custom = False
+    invariant gl_Position;
+
+    void main()
+    {
+        vec4 world = matrix_world * vec4(position, 1);
+        gl_Position = mat_view_projection * world;
+    }
+"""
+
+PIXEL_DEPTH = """
+    void main()
+    {
+    }
+"""
+
+# every base pass fragment adds one, drawn with the base pass' vertex and geometry shaders
+PIXEL_OVERDRAW = """
+    out vec4 color;
+
+    void main()
+    {
+        color = vec4(1);
+    }
+"""
 
+FULLSCREEN_QUAD = ((0, 0), (1, 0), (1, 1), (0, 1))
+
+_fullscreen_batch = None
+
+# shared by every fullscreen pass, only depends on the "pos" attribute of VERTEX_2D
+def get_fullscreen_batch():
+    global _fullscreen_batch
+    if _fullscreen_batch is None:
+        fmt = gpu.types.GPUVertFormat()
+        fmt.attr_add(id="pos", comp_type='F32', len=2, fetch_mode="FLOAT")
+        vbo = gpu.types.GPUVertBuf(len=4, format=fmt)
+        vbo.attr_fill(id="pos", data=FULLSCREEN_QUAD)
+        _fullscreen_batch = gpu.types.GPUBatch(type="TRI_FAN", buf=vbo)
+    return _fullscreen_batch
+
+def draw_fullscreen(shader):
+    PROFILER.count("fullscreen_passes")
+    get_fullscreen_batch().draw(shader)
+
+def compile_base_pass_shader():
+    with PROFILER.span("compile:base_pass"):
+        return gpu.types.GPUShader(
+            get_shader_source("VertexShader.glsl"),
+            get_shader_source("BasePassPixelShader.glsl"),
+            geocode=get_shader_source("GeometryShader.glsl"))
+
+# the base pass with EvaluateMaterial() generated from a node tree
+def compile_node_base_pass_shader(source):
+    with PROFILER.span("compile:node_tree"):
+        return gpu.types.GPUShader(
+            get_shader_source("VertexShader.glsl"),
+            get_shader_source("BasePassPixelShader.glsl").replace("// NODE_TREE_FUNCTIONS", source),
+            geocode=get_shader_source("GeometryShader.glsl"),
+            defines="\n#define USE_NODE_TREE 1\n")
+
+def compile_depth_prepass_shader():
+    with PROFILER.span("compile:depth_prepass"):
+        return gpu.types.GPUShader(VERTEX_DEPTH, PIXEL_DEPTH)
+
+def compile_overdraw_shader():
+    with PROFILER.span("compile:overdraw"):
+        return gpu.types.GPUShader(
+            get_shader_source("VertexShader.glsl"),
+            PIXEL_OVERDRAW,
+            geocode=get_shader_source("GeometryShader.glsl"))
+
+def compile_fullscreen_shader(name, pixel_shader_source):
+    with PROFILER.span("compile:" + name):
+        return gpu.types.GPUShader(VERTEX_2D, pixel_shader_source)
+
+def get_present_shader_source(out_buffer, use_fxaa):
+    present_pixel_shader = PIXEL_2D
+    pixel_shader_prefix = """
+        vec4 finalize_color(vec4 incolor) { return incolor; }
+    """
+    match out_buffer:
+        case "SCENELIT":
+            # the lit buffer carries luma in alpha
+            pixel_shader_prefix = """
+                vec4 finalize_color(vec4 incolor) { return vec4(incolor.rgb, 1); }
+            """
+            if use_fxaa:
+                pixel_shader_prefix = """
+                    #define FXAA_GLSL_130 1
+                    #define FXAA_PC 1
+                    //#define FXAA_QUALITY__PRESET 29
+                    #define USE_FXAA 1
+                """
+                present_pixel_shader = PIXEL_FXAA.replace("FXAA_HEADER", get_shader_source("FXAA311.glsl"))
+        case "NORMAL":
+            pixel_shader_prefix = """
+                vec4 finalize_color(vec4 incolor) { return incolor * 0.5 + 0.5; }
+            """
+        case "DEPTH":
+            pixel_shader_prefix = """
+                vec4 finalize_color(vec4 incolor)
+                {
+                    float z = pow(incolor.x, 256);
+                    return vec4(z, z, z, 1);
+                }
+            """
+        case "POSITION":
+            present_pixel_shader = PIXEL_DEFERRED_WORLDPOS
+            pixel_shader_prefix = ""
+        case "SHADINGMODEL":
+            present_pixel_shader = PIXEL_SHADINGMODEL
+            pixel_shader_prefix = CustomRenderEngineMaterialSettings.get_shadingmodels_define()
+        case "OVERDRAW":
+            # fragments per pixel, blue (1) through green and yellow to red (4 and more)
+            pixel_shader_prefix = """
+                vec4 finalize_color(vec4 incolor)
+                {
+                    float n = incolor.r;
+                    if (n < 0.5)
+                    {
+                        return vec4(0, 0, 0, 1);
+                    }
+                    vec3 heat = n < 2 ? mix(vec3(0, 0, 1), vec3(0, 1, 0), n - 1)
+                        : n < 3 ? mix(vec3(0, 1, 0), vec3(1, 1, 0), n - 2)
+                        : mix(vec3(1, 1, 0), vec3(1, 0, 0), min(n - 3, 1));
+                    return vec4(heat, 1);
+                }
+            """
+        case "LIGHTTILES":
+            present_pixel_shader = PIXEL_LIGHT_TILES
+            pixel_shader_prefix = CustomRenderEngineMaterialSettings.get_shadingmodels_define() + get_tile_defines()
+    return pixel_shader_prefix + present_pixel_shader
+
+def get_lighting_shader_key(background, use_shadow, tile_class=None, scale=1, upsample=False):
+    return ("lighting", background, use_shadow, tile_class, scale, upsample)
+
+# tile_class is None for the fullscreen program, otherwise the program drawn on the tiles of that class.
+# With a scale above 1 it's either the program lighting the low resolution target or (upsample)
+# the one upsampling it and lighting the edges.
+def compile_lighting_shader(background, use_shadow, tile_class=None, scale=1, upsample=False):
+    from .light_buffer import get_block_defines
+
+    defines = CustomRenderEngineMaterialSettings.get_shadingmodels_define() + get_block_defines()
+    if use_shadow:
+        defines += "\n#define USE_SHADOW 1\n"
+    if background is not None:
+        defines += "\n#define APPLY_SCENE_COLOR 1\n#define BACKGROUND_COLOR " + ("1" if background else "0") + "\n"
+    vertex_shader_source = VERTEX_2D
+    if tile_class is not None:
+        defines += get_tile_defines(tile_class)
+        vertex_shader_source = VERTEX_TILES
+    if scale > 1:
+        defines += get_upsample_defines(scale, upsample)
+    pixel_shader_source = get_shader_source("DeferredLightPixelShader.glsl")
+    with PROFILER.span("compile:lighting"):
+        return gpu.types.GPUShader(vertex_shader_source, pixel_shader_source, defines=defines)
+
+def get_present_shader_key(out_buffer, use_fxaa):
+    return ("present", out_buffer, use_fxaa and out_buffer == "SCENELIT")
+
+def compile_rgbl_shader():
+    return compile_fullscreen_shader("rgbl", PIXEL_RGBL)
+
+def compile_present_shader(out_buffer, use_fxaa):
+    return compile_fullscreen_shader("present", get_present_shader_source(out_buffer, use_fxaa))
+
+# AOVs for compositing, read back from the G-buffer of the final render as
+# (pass name, frame graph texture, channels, channel ids, type)
+RENDER_PASSES = (
+    ("Lit", "scenelit", 4, "RGBA", 'COLOR'),
+    ("Base Color", "basecolor", 3, "RGB", 'COLOR'),
+    ("Shadow Color", "shadowcolor", 3, "RGB", 'COLOR'),
+    ("Normal", "normal", 3, "XYZ", 'VECTOR'),
+    ("Depth", "depth", 1, "Z", 'VALUE'),
+    ("Shading Model", "shadingmodel", 1, "X", 'VALUE'),
+)
+
+def get_render_size(scene):
+    scale = scene.render.resolution_percentage / 100.0
+    return int(scene.render.resolution_x * scale), int(scene.render.resolution_y * scale)
+
+# Stands in for the viewport context when drawing from the scene camera
+def get_camera_context(depsgraph, width, height):
+    scene = depsgraph.scene
+    camera = scene.camera.evaluated_get(depsgraph)
+    window_matrix = camera.calc_matrix_camera(depsgraph, x=width, y=height,
+        scale_x=scene.render.pixel_aspect_x, scale_y=scene.render.pixel_aspect_y)
+    view_matrix = camera.matrix_world.inverted()
+    region_data = types.SimpleNamespace(window_matrix=window_matrix, view_matrix=view_matrix,
+        perspective_matrix=window_matrix @ view_matrix, is_perspective=camera.data.type != "ORTHO")
+    return types.SimpleNamespace(region=types.SimpleNamespace(width=width, height=height),
+        space_data=None, region_data=region_data, scene=scene)
+
+# Every preview is the sphere seen from the front, lit by one sun
+PREVIEW_CAMERA_LOCATION = (0, -4.5, 1.5)
+PREVIEW_LIGHT_DIRECTION = (0.5, -0.6, 0.62)
+
+def get_preview_context(width, height):
+    direction = tuple(-c for c in PREVIEW_CAMERA_LOCATION)
+    view_matrix = look_at(PREVIEW_CAMERA_LOCATION, direction, (0, 0, 1))
+    window_matrix = perspective(math.radians(30), 0.1, 100)
+    # perspective() is square
+    window_matrix[0][0] *= height / width
+    region_data = types.SimpleNamespace(window_matrix=window_matrix, view_matrix=view_matrix,
+        perspective_matrix=window_matrix @ view_matrix, is_perspective=True)
+    return types.SimpleNamespace(region=types.SimpleNamespace(width=width, height=height),
+        space_data=None, region_data=region_data, scene=None)
+
+# The collections Blender shows in the preview scene for material previews (see
+# set_preview_visibility in render_preview.cc), light, world and texture previews show others
+MATERIAL_PREVIEW_COLLECTIONS = {"Flat", "Sphere", "Cube", "Shader Ball", "Cloth", "Fluid", "Hair"}
+
+# the preview scene's instances of the previewed shape, none unless it's a material preview
+def get_material_preview_instances(depsgraph):
+    return [instance for instance in depsgraph.object_instances
+        if any(collection.name in MATERIAL_PREVIEW_COLLECTIONS for collection in instance.object.users_collection)]
+
+# The previewed shape is at the origin, floors and backdrops are around it
+def get_preview_material(instances):
+    material = None
+    nearest = math.inf
+    for instance in instances:
+        object = instance.object
+        if object.type == 'MESH' and object.active_material:
+            distance = instance.matrix_world.to_translation().length
+            if distance < nearest:
+                nearest = distance
+                material = object.active_material
+    return material
+
+# modifiers and shape keys can move the mesh from one frame to the next
+def can_deform(object):
+    return len(object.modifiers) > 0 or object.data.shape_keys is not None
+
+# Scene sync and the frame graph, shared by the RenderEngine below and the animation
+# pipeline in final_render.py. Anything in here that calls tag_redraw or update_stats
+# gets them from the RenderEngine, or from OfflineRenderer outside of one.
+class SceneRenderer:
     # Init is called whenever a new render engine instance is created. Multiple
     # instances may exist at the same time, for example for a viewport and final
     # render.
     def __init__(self):
+        from .light_buffer import LightBuffer
+        from .static_batching import StaticBatcher
+
         self.scene_data = None
         self.draw_data = None
         self.draw_calls = {}
         self.lights = []
         self.mesh_objects = []
         self.material_shaders = dict()
-
-    # When the render engine instance is destroy, this is called. Clean up any
-    # render engine data here, for example stopping running render threads.
-    def __del__(self):
-        pass
+        self.texture_max_size = None
+        self.lod_levels = 0
+        self.temporal_aa = TemporalAA()
+        # render targets for the frame graph, reused across redraws
+        self.render_targets = TexturePool()
+        self.shadows = ShadowCache()
+        self.shadow_maps = {}
+        self.light_buffer = LightBuffer()
+        self.light_tiles = LightTiles()
+        self.use_shadows = False
+        self.static_batches = StaticBatcher()
+        # meshes and materials are shared with the engines of other viewports, everything
+        # else here depends on the view
+        self.scene_handles = SceneHandles()
+        GPU_MEMORY.add_renderer(self)
+
+    def free(self):
+        GPU_MEMORY.remove_renderer(self)
+        self.static_batches.clear()
+        self.scene_handles.release_all()
+        if not SCENE.entries:
+            # last viewport closed
+            TEXTURES.clear()
 
     def get_settings(self, context):
         return context.scene.custom_render_engine
     
-    # This is the method called by Blender for both final renders (F12) and
-    # small preview for materials, world and lights.
-    def render(self, depsgraph):
-        scene = depsgraph.scene
-        scale = scene.render.resolution_percentage / 100.0
-        self.size_x = int(scene.render.resolution_x * scale)
-        self.size_y = int(scene.render.resolution_y * scale)
-
-        # Fill the render result with a flat color. The framebuffer is
-        # defined as a list of pixels, each pixel itself being a list of
-        # R,G,B,A values.
-        if self.is_preview:
-            color = [0.1, 0.2, 0.1, 1.0]
-        else:
-            color = [0.2, 0.1, 0.1, 1.0]
-
-        pixel_count = self.size_x * self.size_y
-        rect = [color] * pixel_count
-
-        # Here we write the pixel values to the RenderResult
-        result = self.begin_result(0, 0, self.size_x, self.size_y)
-        layer = result.layers[0].passes["Combined"]
-        layer.rect = rect
-        self.end_result(result)
-
     def create_mesh_draw(self, mesh):
         material_shader = self.default_material_shader
         if mesh.active_material:
-            try:
-                material_shader = self.material_shaders[mesh.active_material.name]
-            except KeyError:
-                self.material_shaders[mesh.active_material.name] = MeshMaterialShader(mesh.active_material)
-                material_shader = self.material_shaders[mesh.active_material.name]
-        return BasePassRendering(mesh.data, material_shader)
+            material_shader = self.get_material_shader(mesh.active_material)
+        return BasePassRendering(mesh.data, material_shader, self.lod_levels)
+
+    def get_material_shader(self, material):
+        material_shader = self.scene_handles.acquire(("material", material.name),
+            lambda: MeshMaterialShader(material, self.texture_max_size), free=MeshMaterialShader.release_textures)
+        self.material_shaders[material.name] = material_shader
+        return material_shader
+
+    def update_material_shader(self, material):
+        def update(material_shader):
+            material_shader.update()
+            return material_shader
+        material_shader = self.scene_handles.update(("material", material.name),
+            lambda: MeshMaterialShader(material, self.texture_max_size), update, free=MeshMaterialShader.release_textures)
+        self.material_shaders[material.name] = material_shader
+
+    # deform tries the fast path for deformation, keeping the topology and static attributes
+    def update_mesh_draw(self, object, deform=False):
+        def update(draw):
+            if deform and draw.update_deformed(object.data):
+                return draw
+            return self.create_mesh_draw(object)
+        self.draw_calls[object.name] = self.scene_handles.update(("mesh", object.name), lambda: self.create_mesh_draw(object), update)
     
     def add_material_user(self, mesh, material):
         if not material.name in self.materials_users:
@@ -288,11 +579,37 @@ class CustomRenderEngine(bpy.types.RenderEngine):
     def get_material_users(self, material):
         return self.materials_users[material.name]
 
-    # For viewport renders, this method gets called once at the start and
-    # whenever the scene or 3D viewport changes. This method is where data
-    # should be read from Blender in the same thread. Typically a render
-    # thread will be started to do the work while keeping Blender responsive.
-    def view_update(self, context, depsgraph):
+    # Queues the programs the scene is going to need, view_draw compiles them a few per frame.
+    # Light variants are queued when the lights are created.
+    def request_shader_variants(self, settings):
+        SHADERS.request(("base_pass",), compile_base_pass_shader, priority=True)
+        if settings.use_fxaa:
+            SHADERS.request(get_present_shader_key("SCENELIT", True), lambda: compile_present_shader("SCENELIT", True))
+        if settings.use_taa:
+            self.temporal_aa.request_shader()
+        if settings.use_light_tiles:
+            SHADERS.request(("classify_tiles",), compile_classify_shader)
+        for background in (settings.world_color_clear, None):
+            self.get_light_passes(background, settings.use_shadows, settings.use_light_tiles)
+        self.get_upsample_passes(settings, settings.use_shadows)
+
+    def compile_shader_variants(self, settings):
+        if SHADERS.is_ready():
+            return
+        with PROFILER.span("shader_warmup"):
+            pending = SHADERS.compile_pending(settings.shader_compile_budget)
+        if pending:
+            ready, total = SHADERS.progress()
+            self.update_stats("", f"Compiling shaders ({ready}/{total})")
+            self.tag_redraw()
+        else:
+            self.update_stats("", "")
+            SHADERS.reset_progress()
+
+    # final frames get no depsgraph updates (nothing is kept between F12 renders, and the
+    # animation pipeline only changes the frame), so objects and lights are gathered again
+    # and meshes that can deform are extracted again
+    def sync_depsgraph(self, context, depsgraph, final=False):
         region = context.region
         view3d = context.space_data
         scene = depsgraph.scene
@@ -300,14 +617,42 @@ class CustomRenderEngine(bpy.types.RenderEngine):
         # Get viewport dimensions
         dimensions = region.width, region.height
 
+        settings = scene.custom_render_engine
+        TEXTURES.set_budget(settings.texture_budget)
+        # full resolution is kept for final renders
+        texture_max_size = settings.texture_proxy_size if settings.use_texture_proxies and not final else None
+        if texture_max_size != self.texture_max_size:
+            self.texture_max_size = texture_max_size
+            for material_shader in self.material_shaders.values():
+                material_shader.set_texture_max_size(texture_max_size)
+            if self.scene_data:
+                self.default_material_shader.set_texture_max_size(texture_max_size)
+
+        self.shadows.configure(settings.shadow_budget, settings.shadow_resolution)
+        if settings.use_shadows != self.use_shadows:
+            self.use_shadows = settings.use_shadows
+            self.lights = [self.create_light(light.object) for light in self.lights]
+
+        lod_levels = settings.lod_levels if settings.use_lod else 0
+        if lod_levels != self.lod_levels:
+            self.lod_levels = lod_levels
+            for draw in self.draw_calls.values():
+                # shared draws may already have been switched by another viewport
+                if draw.lod_levels != lod_levels:
+                    draw.request_lods(lod_levels)
+
         if not self.scene_data:
             # First time initialization
             print("Initializing renderer", flush=True)
             self.scene_data = [0]
             first_time = True
+            # the preview scene's objects come from another Main, their names can be taken in this one
+            self.scene_handles.set_mode("VIEWPORT" if not final else "PREVIEW" if getattr(self, "is_preview", False) else "RENDER")
 
-            self.default_material_shader = MeshMaterialShader(None)
+            self.default_material_shader = self.scene_handles.acquire(("material", None),
+                lambda: MeshMaterialShader(None, self.texture_max_size), free=MeshMaterialShader.release_textures)
             self.materials_users = dict()
+            self.request_shader_variants(scene.custom_render_engine)
 
             # find all materials in the scene and compile shaders
             # for id in depsgraph.ids:
@@ -318,7 +663,8 @@ class CustomRenderEngine(bpy.types.RenderEngine):
             for datablock in depsgraph.ids:
                 if isinstance(datablock, bpy.types.Object) and datablock.type == 'MESH':
                     # print(datablock.type, " ", datablock.name, flush=True)
-                    self.draw_calls[datablock.name] = self.create_mesh_draw(datablock)
+                    self.draw_calls[datablock.name] = self.scene_handles.acquire(("mesh", datablock.name),
+                        lambda: self.create_mesh_draw(datablock))
                     if datablock.active_material:
                         self.add_material_user(datablock, datablock.active_material)
 
@@ -328,6 +674,17 @@ class CustomRenderEngine(bpy.types.RenderEngine):
             # for upd in depsgraph.updates:
             #     print(upd.id.name)
             # print("", flush=True)
+            if len(depsgraph.updates) > 0:
+                self.temporal_aa.reset()
+
+            if final:
+                for datablock in depsgraph.ids:
+                    if isinstance(datablock, bpy.types.Object) and datablock.type == 'MESH' and can_deform(datablock):
+                        draw = self.draw_calls.get(datablock.name)
+                        if draw:
+                            self.shadows.invalidate_caster(self.get_caster_bounds(datablock, draw))
+                        self.update_mesh_draw(datablock, deform=True)
+
             # Test which datablocks changed
             for update in depsgraph.updates:
                 # print("Datablock updated: ", update.id.name, flush=True)
@@ -336,8 +693,13 @@ class CustomRenderEngine(bpy.types.RenderEngine):
                 and datablock.type == 'MESH' and (update.is_updated_geometry or update.is_updated_shading):
                     # print("mesh updated: ", datablock.name, flush=True)
                     # del self.draw_calls[datablock.name]
-                    
-                    self.draw_calls[datablock.name] = self.create_mesh_draw(datablock)
+
+                    # deformation during playback, UV and color edits only happen in edit mode
+                    draw = self.draw_calls.get(datablock.name)
+                    if draw:
+                        self.shadows.invalidate_caster(self.get_caster_bounds(datablock, draw))
+                    self.update_mesh_draw(datablock, deform=update.is_updated_geometry and not update.is_updated_shading \
+                        and datablock.mode != 'EDIT')
 
             # Test if any material was added, removed or changed.
             if depsgraph.id_type_updated('MATERIAL'):
@@ -345,50 +707,136 @@ class CustomRenderEngine(bpy.types.RenderEngine):
                 for update in depsgraph.updates:
                     if (isinstance(update.id, bpy.types.Material)):
                         # print(f"material updated: {update.id.name}", flush=True)
-                        self.material_shaders[update.id.name].update()
+                        self.update_material_shader(update.id)
                 pass
 
+            # Painted, reloaded or replaced images
+            if depsgraph.id_type_updated('IMAGE'):
+                for update in depsgraph.updates:
+                    if isinstance(update.id, bpy.types.Image):
+                        image = update.id.original
+                        TEXTURES.invalidate(image)
+                        for material_shader in list(self.material_shaders.values()):
+                            if material_shader.uses_image(image):
+                                self.update_material_shader(material_shader.material)
+
         # Loop over all object instances in the scene.
-        if first_time or depsgraph.id_type_updated('OBJECT'):
+        if first_time or final or depsgraph.id_type_updated('OBJECT'):
             pass
             self.mesh_objects = []
             for instance in depsgraph.object_instances:
                 object = instance.object
                 if object.type == 'MESH':
                     self.mesh_objects.append(object)
+            # let go of deleted objects, the last viewport to do so frees them
+            if not first_time:
+                names = set(datablock.name for datablock in depsgraph.ids
+                    if isinstance(datablock, bpy.types.Object) and datablock.type == 'MESH')
+                for name in [name for name in self.draw_calls if name not in names]:
+                    del self.draw_calls[name]
+                    self.scene_handles.release(("mesh", name))
             self.lights = []
             # for light in self.lights:
             #     self.lights.remove(light)
             for instance in depsgraph.object_instances:
                 object = instance.object
                 if object.type == 'LIGHT':
-                    match object.data.type:
-                        case "SUN":
-                            # print("light: ", object.name)
-                            # light_direction = mathutils.Vector((0, 0, 1))
-                            # light_direction.rotate(object.matrix_world.decompose()[1])
-                            # light = light_direction.to_4d()
-                            # light.w = object.data.energy
-                            # self.lights.append(light)
-                            self.lights.append(DirectionalLightRendering(object))
-                        case "POINT" | "SPOT":
-                            self.lights.append(LocalLightRendering(object))
-
-
-    # For viewport renders, this method is called whenever Blender redraws
-    # the 3D viewport. The renderer is expected to quickly draw the render
-    # with OpenGL, and not perform other expensive work.
-    # Blender will draw overlays for selection and editing on top of the
-    # rendered image automatically.
-    def view_draw(self, context, depsgraph):
-        
-        region = context.region
-        scene = depsgraph.scene
-
-        # Get viewport dimensions
-        dimensions = region.width, region.height
-
-        settings = self.get_settings(context)
+                    light = self.create_light(object)
+                    if light:
+                        self.lights.append(light)
+
+        if first_time or final or len(depsgraph.updates) > 0:
+            self.shadows.update_casters({object.name: self.get_caster_bounds(object, self.draw_calls[object.name])
+                for object in self.mesh_objects},
+                {object.name: tuple(tuple(row) for row in object.matrix_world) for object in self.mesh_objects})
+            self.sync_static_batches(depsgraph, settings)
+
+    # Objects that can go in a static batch: meshes that can't deform, aren't being edited,
+    # show up once in the scene without being instanced and are small enough to gain from it.
+    # The signature changes with the draw, its updates and the object's matrix.
+    def sync_static_batches(self, depsgraph, settings):
+        candidates = {}
+        if settings.use_static_batching:
+            instances = collections.Counter()
+            for instance in depsgraph.object_instances:
+                if instance.object.type == 'MESH':
+                    instances[instance.object.name] += 2 if instance.is_instance else 1
+            for object in self.mesh_objects:
+                draw = self.draw_calls[object.name]
+                vertices = len(draw.positions)
+                if instances[object.name] != 1 or can_deform(object) or object.mode == 'EDIT' \
+                or not 0 < vertices <= settings.static_batch_max_vertices:
+                    continue
+                key = object.active_material.name if object.active_material else None
+                signature = (id(draw), self.scene_handles.get_serial(("mesh", object.name)),
+                    tuple(tuple(row) for row in object.matrix_world))
+                candidates[object.name] = (key, vertices, signature)
+        if not candidates and not self.static_batches.batches:
+            return
+
+        objects = {object.name: object for object in self.mesh_objects}
+        # The members keep their own buffers, other viewports may draw them through SCENE.
+        # Nothing here touches them any more, so they're the first the memory budget evicts.
+        def build(key, names):
+            draws = [self.draw_calls[name] for name in names]
+            batch = StaticBatchRendering(draws, [objects[name].matrix_world for name in names], draws[0].matshader)
+            PROFILER.count("static_batch_rebuilds")
+            return batch
+        def patch(draw, names, changed):
+            indices = {name: index for index, name in enumerate(names)}
+            members = [(indices[name], self.draw_calls[name], objects[name].matrix_world) for name in changed]
+            # same draw and serial, only the matrix changed
+            geometry = any(candidates[name][2][:2] != signature[:2] for name, signature in changed.items())
+            PROFILER.count("static_batch_patches")
+            return draw.patch(members, geometry)
+        self.static_batches.sync(candidates, build, patch)
+
+    def create_light(self, object):
+        use_shadow = self.use_shadows and object.data.use_shadow
+        match object.data.type:
+            case "SUN":
+                # print("light: ", object.name)
+                # light_direction = mathutils.Vector((0, 0, 1))
+                # light_direction.rotate(object.matrix_world.decompose()[1])
+                # light = light_direction.to_4d()
+                # light.w = object.data.energy
+                # self.lights.append(light)
+                return DirectionalLightRendering(object, use_shadow)
+            case "POINT" | "SPOT":
+                return LocalLightRendering(object, use_shadow)
+        return None
+
+    # world space bounding sphere
+    def get_caster_bounds(self, object, draw):
+        matrix_world = object.matrix_world
+        return matrix_world @ draw.bounds_center, draw.bounds_radius * max(matrix_world.to_scale())
+
+
+    # Syncs for a frame drawn from the scene camera, with every program it needs compiled
+    # since final frames can't fall back on a later redraw
+    def sync_offscreen(self, depsgraph, width, height):
+        context = get_camera_context(depsgraph, width, height)
+        self.sync_depsgraph(context, depsgraph, final=True)
+        settings = depsgraph.scene.custom_render_engine
+        self.request_shader_variants(settings)
+        use_shadow = any(light.use_shadow for light in self.lights)
+        for background in (settings.world_color_clear, None):
+            self.get_light_passes(background, use_shadow, settings.use_light_tiles)
+        self.get_upsample_passes(settings, use_shadow)
+        with PROFILER.span("shader_warmup"):
+            SHADERS.compile_pending(math.inf)
+        SHADERS.reset_progress()
+        return context
+
+    # readback, if given, is filled with the G-buffer textures of RENDER_PASSES
+    def draw_offscreen(self, context, settings, offscreen, readback=None):
+        with offscreen.bind():
+            self.draw_frame(context, settings, readback)
+
+    # TAA needs the frames before, only the viewport has them. Final frames and previews are
+    # drawn once, they use FXAA instead.
+    def draw_frame(self, context, settings, readback=None, use_taa=False):
+        self.compile_shader_variants(settings)
 
         fb = gpu.state.active_framebuffer_get() # it's framebuffer_active_get in the api docs wtf?
         x, y, w, h = gpu.state.viewport_get()
@@ -400,116 +848,431 @@ class CustomRenderEngine(bpy.types.RenderEngine):
         normal_format = "RGBA32F"
         # if offscr_scale > 1:
         #     offscr_scale = math.floor(offscr_scale)
-        basecolor = gpu.types.GPUTexture(fb_size, format=gbuffer_format)
-        shadowcolor = gpu.types.GPUTexture(fb_size, format=gbuffer_format)
-        normal = gpu.types.GPUTexture(fb_size, format=normal_format)
-        t_shadingmodel = gpu.types.GPUTexture(fb_size, format="R8UI")
-        z = gpu.types.GPUTexture(fb_size, format="DEPTH_COMPONENT24")
-        gbuffer = gpu.types.GPUFrameBuffer(depth_slot=z, color_slots=(basecolor, shadowcolor, normal, t_shadingmodel))
+
+        use_taa = use_taa and settings.use_taa and settings.out_buffer == "SCENELIT"
+        view_projection = context.region_data.window_matrix @ context.region_data.view_matrix
+
+        graph = FrameGraph()
+        graph.create_texture("basecolor", fb_size, gbuffer_format)
+        graph.create_texture("shadowcolor", fb_size, gbuffer_format)
+        graph.create_texture("normal", fb_size, normal_format)
+        graph.create_texture("shadingmodel", fb_size, "R8UI")
+        graph.create_texture("depth", fb_size, "DEPTH_COMPONENT24")
+        graph.create_texture("scenelit", fb_size, final_color_format)
+        gbuffer = ("basecolor", "shadowcolor", "normal", "shadingmodel", "depth")
+
+        with PROFILER.span("sort_draws"):
+            draws = self.get_opaque_draws(context.region_data.view_matrix, context.region_data.window_matrix, view_projection,
+                fb_size, settings)
+
+        graph.add_pass("base_pass", writes=gbuffer,
+            execute=lambda res: self.draw_base_pass(res, context, settings, draws, view_projection, use_taa, fb_size, final_color_format))
+        lighting_reads = gbuffer
+        use_shadow = any(light.use_shadow for light in self.lights)
+        if use_shadow:
+            graph.import_texture("shadow_atlas")
+            graph.add_pass("shadows", writes=("shadow_atlas",), execute=self.draw_shadows)
+            lighting_reads += ("shadow_atlas",)
+        if settings.use_light_tiles or settings.out_buffer == "LIGHTTILES":
+            graph.create_texture("light_tiles", get_tile_count(fb_size), "R8UI")
+            graph.add_pass("classify_tiles", reads=("shadingmodel",), writes=("light_tiles",),
+                execute=self.draw_classify_tiles)
+            if settings.use_light_tiles:
+                lighting_reads += ("light_tiles",)
+        # full resolution until the upsampling programs are compiled
+        upsample = self.get_upsample_passes(settings, use_shadow)
+        if upsample:
+            scale = LIGHTING_SCALES[settings.lighting_resolution]
+            graph.create_texture("lighting_low", get_low_size(fb_size, scale), "RGBA16F")
+            graph.add_pass("lighting_low", reads=lighting_reads, writes=("lighting_low",),
+                execute=lambda res: self.draw_lighting_low(res, context, upsample["low"]))
+            lighting_reads += ("lighting_low",)
+        graph.add_pass("lighting", reads=lighting_reads, writes=("scenelit",),
+            execute=lambda res: self.draw_lighting(res, context, settings, upsample))
+
+        use_fxaa = False
+        match settings.out_buffer:
+            case "SCENELIT":
+                if use_taa:
+                    graph.import_texture("taa")
+                    graph.add_pass("taa", reads=("scenelit", "depth"), writes=("taa",),
+                        execute=lambda res: self.draw_taa(res, view_projection, settings))
+                    out_texture = "taa"
+                elif settings.use_fxaa and SHADERS.get(get_present_shader_key("SCENELIT", True)) \
+                and (settings.use_pass_fusion or SHADERS.get_or_compile(("rgbl",), compile_rgbl_shader)):
+                    use_fxaa = True
+                    if settings.use_pass_fusion:
+                        # luma is already in alpha
+                        out_texture = "scenelit"
+                    else:
+                        graph.create_texture("rgbl", fb_size, final_color_format)
+                        graph.add_pass("rgbl", reads=("scenelit",), writes=("rgbl",), execute=self.draw_rgbl)
+                        out_texture = "rgbl"
+                else:
+                    # also the fallback while the FXAA variant is still compiling, or if it failed to
+                    out_texture = "scenelit"
+                    if settings.use_fxaa:
+                        SHADERS.request(get_present_shader_key("SCENELIT", True), lambda: compile_present_shader("SCENELIT", True))
+            case "BASECOLOR":
+                out_texture = "basecolor"
+            case "SHADOWCOLOR":
+                out_texture = "shadowcolor"
+            case "NORMAL":
+                out_texture = "normal"
+            case "DEPTH" | "POSITION":
+                # the world position view only reconstructs from depth
+                out_texture = "depth"
+            case "SHADINGMODEL":
+                out_texture = "shadingmodel"
+            case "LIGHTTILES":
+                out_texture = "light_tiles"
+            case "OVERDRAW":
+                graph.create_texture("overdraw", fb_size, "R16F")
+                graph.create_texture("overdraw_depth", fb_size, "DEPTH_COMPONENT24")
+                graph.add_pass("overdraw", writes=("overdraw", "overdraw_depth"),
+                    execute=lambda res: self.draw_overdraw(res, draws, view_projection, settings))
+                out_texture = "overdraw"
+
+        if readback is not None:
+            # keeps every target it reads alive (and unaliased) until it has run
+            graph.add_pass("readback", reads=tuple(texture for _, texture, *_ in RENDER_PASSES), side_effect=True,
+                execute=lambda res: self.read_render_passes(res, readback))
+
+        graph.import_texture("viewport", fb)
+        graph.add_pass("present", reads=(out_texture, "depth"), writes=("viewport",), side_effect=True,
+            execute=lambda res: self.draw_present(res, out_texture, context, settings, use_fxaa, w, h))
+
+        compiled = graph.execute(self.render_targets)
+        for name, value in compiled.get_stats().items():
+            PROFILER.count(name, value)
+        GPU_MEMORY.end_frame(settings)
+        self.report_shader_errors()
+
+    # the passes whose program failed to compile are skipped or drawn with a fallback,
+    # the stats say why
+    def report_shader_errors(self):
+        errors = SHADERS.pop_errors()
+        if errors:
+            self.update_stats("", "; ".join(f"Shader variant {key} failed to compile: {error}" for key, error in errors))
+
+    # Opaque draws as (object, draw, lod), front to back by the distance of their bounds
+    # along the view so the depth test rejects hidden fragments before they're shaded
+    def get_opaque_draws(self, view_matrix, window_matrix, view_projection, fb_size, settings):
+        use_lod = self.lod_levels > 0
+        draws = []
+        batched = self.static_batches.members
+        for object in self.mesh_objects:
+            if object.name in batched:
+                continue
+            draw = self.draw_calls[object.name]
+            draw.make_resident()
+            GPU_MEMORY.touch(draw)
+            lod = 0
+            if use_lod:
+                lod = draw.select_lod(object.matrix_world, view_projection, window_matrix, fb_size[1], settings.lod_screen_size)
+            # the view looks down -z
+            distance = -(view_matrix @ (object.matrix_world @ draw.bounds_center)).z
+            draws.append((distance, object, draw, lod))
+        if self.static_batches.batches:
+            from .static_batching import get_frustum_planes
+
+            planes = get_frustum_planes(view_projection)
+            drawn = 0
+            for batch in self.static_batches.batches:
+                draw = batch.draw
+                draw.make_resident()
+                GPU_MEMORY.touch(draw)
+                if not draw.cull(planes):
+                    continue
+                distance = -(view_matrix @ draw.bounds_center).z
+                draws.append((distance, STATIC_BATCH_OBJECT, draw, 0))
+                drawn += 1
+            # every member used to be a draw call of its own
+            PROFILER.count("static_batch_draw_calls", drawn)
+            PROFILER.count("static_batched_objects", len(batched))
+            PROFILER.count("draw_calls_saved", len(batched) - drawn)
+        draws.sort(key=lambda entry: entry[0])
+        return [entry[1:] for entry in draws]
+
+    # Fills depth with the draws' surfaces only, outlines need the base pass' geometry shader.
+    # Returns False if its program failed to compile, the base pass then writes depth itself.
+    def draw_depth_prepass(self, depth, draws, view_projection):
+        shader = SHADERS.get_or_compile(("depth_prepass",), compile_depth_prepass_shader)
+        if not shader:
+            return False
+        framebuffer = self.render_targets.get_framebuffer(depth_slot=depth)
+        with framebuffer.bind(), PROFILER.span("depth_prepass", gpu=True):
+            framebuffer.clear(depth=1.0)
+            gpu.state.depth_test_set("LESS")
+            gpu.state.depth_mask_set(True)
+            gpu.state.face_culling_set("BACK")
+            shader.bind()
+            shader.uniform_float("mat_view_projection", view_projection)
+            for object, draw, lod in draws:
+                # not drawn by the base pass either until its program is compiled
+                if draw.matshader.shader:
+                    draw.draw_depth(shader, object.matrix_world, lod)
+            PROFILER.count("depth_prepass_draw_calls", len(draws))
+        return True
+
+    # With the pre-pass the base pass only shades the visible surface: it tests LESS_EQUAL
+    # against the depth already there and doesn't write it, except for outlines.
+    def set_base_pass_depth_state(self, settings, use_prepass):
+        if use_prepass:
+            gpu.state.depth_test_set("LESS_EQUAL")
+            gpu.state.depth_mask_set(settings.enable_outline)
+        else:
+            gpu.state.depth_test_set("LESS")
+            gpu.state.depth_mask_set(True)
+        gpu.state.face_culling_set("BACK")
+
+    def draw_base_pass(self, res, context, settings, draws, view_projection, use_taa, fb_size, final_color_format):
+        if use_taa:
+            self.temporal_aa.ensure_targets(fb_size, final_color_format)
+            mvp = self.temporal_aa.jitter_projection(context.region_data.window_matrix, fb_size) @ context.region_data.view_matrix
+        else:
+            mvp = view_projection
+
+        use_prepass = settings.use_depth_prepass and self.draw_depth_prepass(res["depth"], draws, mvp)
+
+        t_shadingmodel = res["shadingmodel"]
+        gbuffer = gpu.types.GPUFrameBuffer(depth_slot=res["depth"],
+            color_slots=(res["basecolor"], res["shadowcolor"], res["normal"], t_shadingmodel))
 
         with gbuffer.bind():
 
-            gpu.state.active_framebuffer_get().clear(color=(0, 0, 0, 0), depth=1.0)
+            if use_prepass:
+                gpu.state.active_framebuffer_get().clear(color=(0, 0, 0, 0))
+            else:
+                gpu.state.active_framebuffer_get().clear(color=(0, 0, 0, 0), depth=1.0)
             t_shadingmodel.clear(format="UBYTE", value=tuple([0]))
 
             # Bind (fragment) shader that converts from scene linear to display space,
             # self.bind_display_space_shader(scene)
 
-            gpu.state.depth_test_set("LESS")
-            gpu.state.depth_mask_set(True)
-            gpu.state.face_culling_set("BACK")
+            self.set_base_pass_depth_state(settings, use_prepass)
 
-            for object in self.mesh_objects:
-                draw = self.draw_calls[object.name]
-                mvp = context.region_data.window_matrix @ context.region_data.view_matrix
-                draw.draw(object.matrix_world, mvp, settings)
+            with PROFILER.span("base_pass", gpu=True):
+                for object, draw, lod in draws:
+                    draw.draw(object.matrix_world, mvp, settings, lod)
+                PROFILER.count("draw_calls", len(draws))
             # for key, draw in self.draw_calls.items():
             #     print(draw.object.name, " ", draw.object.hide_viewport, flush=True)
             #     draw.draw(draw.object.matrix_world, context.region_data, self.lights, settings)
 
 
             # self.unbind_display_space_shader()
-        
-        tscenelit = gpu.types.GPUTexture(fb_size, format=final_color_format)
-        lighting = gpu.types.GPUFrameBuffer(color_slots=(tscenelit))
-
-        with lighting.bind():
-            lighting.clear(color=(0, 0, 0, 0))
-            gpu.state.depth_test_set("ALWAYS")
-
-            ps_prefix = "\n#define BACKGROUND_COLOR " + ("1" if settings.world_color_clear else "0") + "\n"
-            ps_prefix += CustomRenderEngineMaterialSettings.get_shadingmodels_define()
-            shader = gpu.types.GPUShader(VERTEX_2D, ps_prefix + PIXEL_SCENE_LIGHTING)
-            shader.bind()
-            shader.uniform_float("scene_color", settings.world_color)
-            shader.uniform_sampler("tbasecolor", basecolor)
-            shader.uniform_sampler("tshadingmodel", t_shadingmodel)
-            batch_for_shader(shader, "TRI_FAN", {"pos": ((0, 0), (1, 0), (1, 1), (0, 1))}).draw(shader)
 
+    # Debug view: the base pass again, with the same draw order and depth state, counting
+    # the fragments that pass the depth test. The average and maximum go to the stats.
+    def draw_overdraw(self, res, draws, view_projection, settings):
+        shader = SHADERS.get_or_compile(("overdraw",), compile_overdraw_shader)
+        if not shader:
+            return
+        use_prepass = settings.use_depth_prepass and self.draw_depth_prepass(res["overdraw_depth"], draws, view_projection)
+        framebuffer = gpu.types.GPUFrameBuffer(depth_slot=res["overdraw_depth"], color_slots=(res["overdraw"]))
+        with framebuffer.bind(), PROFILER.span("overdraw", gpu=True):
+            if use_prepass:
+                framebuffer.clear(color=(0, 0, 0, 0))
+            else:
+                framebuffer.clear(color=(0, 0, 0, 0), depth=1.0)
+            self.set_base_pass_depth_state(settings, use_prepass)
             gpu.state.blend_set("ADDITIVE")
-            for light in self.lights:
-                light.draw(context.region_data, z, basecolor, shadowcolor, normal, t_shadingmodel)
-            
+            shader.bind()
+            for object, draw, lod in draws:
+                if draw.matshader.shader:
+                    draw.draw_with(shader, object.matrix_world, view_projection, settings, lod)
             gpu.state.blend_set("NONE")
-        
-        trgbl = gpu.types.GPUTexture(fb_size, format=final_color_format)
-        rgbl = gpu.types.GPUFrameBuffer(color_slots = (trgbl))
 
-        with rgbl.bind():
-            shader = gpu.types.GPUShader(VERTEX_2D, PIXEL_RGBL)
+        import numpy as np
+        texture = res["overdraw"]
+        fragments = np.asarray(texture.read(), dtype=np.float32).reshape(texture.height, texture.width, -1)[..., 0]
+        covered = np.count_nonzero(fragments)
+        average = fragments.sum() / covered if covered else 0.0
+        self.update_stats("", f"Overdraw: {average:.2f} fragments per covered pixel, {fragments.max():.0f} max")
+
+    def read_render_passes(self, res, readback):
+        with PROFILER.span("readback"):
+            for _, name, *_ in RENDER_PASSES:
+                texture = res[name]
+                readback[name] = (texture.read(), texture.width, texture.height)
+
+    def draw_shadows(self, res):
+        with PROFILER.span("shadows"):
+            batched = self.static_batches.members
+            casters = [(object.matrix_world, self.draw_calls[object.name].batch, self.shadows.casters.get(object.name))
+                for object in self.mesh_objects if object.name not in batched]
+            casters += [(STATIC_BATCH_OBJECT.matrix_world, batch.draw.batch, (batch.draw.bounds_center, batch.draw.bounds_radius))
+                for batch in self.static_batches.batches]
+            self.shadow_maps = self.shadows.render([light.object for light in self.lights if light.use_shadow], casters)
+        res["shadow_atlas"] = self.shadows.atlas
+
+    def draw_classify_tiles(self, res):
+        tiles = gpu.types.GPUFrameBuffer(color_slots=(res["light_tiles"]))
+        with tiles.bind(), PROFILER.span("classify_tiles", gpu=True):
+            gpu.state.depth_test_set("ALWAYS")
+            gpu.state.blend_set("NONE")
+            shader = SHADERS.get_or_compile(("classify_tiles",), compile_classify_shader)
+            if not shader:
+                # every bit set, all tiles go through the mixed program
+                res["light_tiles"].clear(format="UBYTE", value=(0xFF,))
+                return
             shader.bind()
-            shader.uniform_sampler("image", tscenelit)
-            batch_for_shader(shader, "TRI_FAN", {"pos": ((0, 0), (1, 0), (1, 1), (0, 1))}).draw(shader)
+            shader.uniform_sampler("tshadingmodel", res["shadingmodel"])
+            draw_fullscreen(shader)
+
+    # The lighting of every light block, at 1 / scale resolution
+    def draw_lighting_low(self, res, context, passes):
+        self.light_buffer.update(self.lights, self.shadow_maps, self.shadows.version)
+        lighting = gpu.types.GPUFrameBuffer(color_slots=(res["lighting_low"]))
+        with lighting.bind(), PROFILER.span("lighting_low", gpu=True):
+            gpu.state.depth_test_set("ALWAYS")
+            lighting.clear(color=(0, 0, 0, 0))
+            gpu.state.blend_set("ADDITIVE_PREMULT")
+            for ubo in self.light_buffer.ubos:
+                self.draw_light_pass(passes, ubo, res, context.region_data)
+            gpu.state.blend_set("NONE")
 
-        present_pixel_shader = PIXEL_2D
+    # upsample, if given, are the passes of get_upsample_passes, lighting_low has been drawn
+    def draw_lighting(self, res, context, settings, upsample=None):
+        basecolor, t_shadingmodel = res["basecolor"], res["shadingmodel"]
+        lighting = gpu.types.GPUFrameBuffer(color_slots=(res["scenelit"]))
+        use_shadow = "shadow_atlas" in res
+        use_tiles = "light_tiles" in res and settings.use_light_tiles
 
-        pixel_shader_prefix = """
-            vec4 finalize_color(vec4 incolor) { return incolor; }
-        """
-        match settings.out_buffer:
-            case "SCENELIT":
-                if settings.use_fxaa:
-                    out_texture = trgbl
-                    pixel_shader_prefix = """
-                        #define FXAA_GLSL_130 1
-                        #define FXAA_PC 1
-                        //#define FXAA_QUALITY__PRESET 29
-                    """
-                    if settings.use_fxaa:
-                        pixel_shader_prefix += """
-                            #define USE_FXAA 1
-                        """
-                    present_pixel_shader = PIXEL_FXAA.replace("FXAA_HEADER", open("shaders/FXAA311.glsl").read())
-                else:
-                    out_texture = tscenelit
-            case "BASECOLOR":
-                out_texture = basecolor
-            case "SHADOWCOLOR":
-                out_texture = shadowcolor
-            case "NORMAL":
-                out_texture = normal
-                pixel_shader_prefix = """
-                    vec4 finalize_color(vec4 incolor) { return incolor * 0.5 + 0.5; }
-                """
-            case "DEPTH":
-                out_texture = z
-                pixel_shader_prefix = """
-                    vec4 finalize_color(vec4 incolor)
-                    {
-                        float z = pow(incolor.x, 256);
-                        return vec4(z, z, z, 1);
-                    }
-                """
-            case "POSITION":
-                present_pixel_shader = PIXEL_DEFERRED_WORLDPOS
-                out_texture = tscenelit
-                pixel_shader_prefix = ""
-            case "SHADINGMODEL":
-                present_pixel_shader = PIXEL_SHADINGMODEL
-                pixel_shader_prefix = CustomRenderEngineMaterialSettings.get_shadingmodels_define()
-                out_texture = t_shadingmodel
+        # every light goes through the same program, MAX_LIGHTS per pass
+        self.light_buffer.update(self.lights, self.shadow_maps, self.shadows.version)
+        ubos = self.light_buffer.ubos
+        PROFILER.count("lights", len(self.lights))
+
+        with lighting.bind(), PROFILER.span("lighting", gpu=True):
+            gpu.state.depth_test_set("ALWAYS")
 
-        with fb.bind():
+            # Passes write rgb and luma, and are blended with ADDITIVE_PREMULT so alpha ends up
+            # holding the luma of the whole buffer. With pass fusion the first pass also applies
+            # the scene color and overwrites the buffer, which saves the clear and a fullscreen pass.
+            # When upsampling, the first pass writes the upsampled lighting of all light blocks
+            # and the others only add to the pixels it couldn't upsample.
+            upsample = upsample or {}
+            apply_upsampled = True
+            passes = None
+            if settings.use_pass_fusion:
+                passes = upsample.get("fused") or self.get_light_passes(settings.world_color_clear, use_shadow, use_tiles)
+            if passes:
+                self.draw_light_pass(passes, ubos[0], res, context.region_data, settings.world_color)
+                ubos = ubos[1:]
+                apply_upsampled = False
+            else:
+                # also while the fused variant is still compiling
+                lighting.clear(color=(0, 0, 0, 0))
+                with PROFILER.span("scene_color", gpu=True):
+                    ps_prefix = "\n#define BACKGROUND_COLOR " + ("1" if settings.world_color_clear else "0") + "\n"
+                    ps_prefix += CustomRenderEngineMaterialSettings.get_shadingmodels_define()
+                    shader = SHADERS.get_or_compile(("scene_lighting", settings.world_color_clear),
+                        lambda: compile_fullscreen_shader("scene_lighting", ps_prefix + PIXEL_SCENE_LIGHTING))
+                    if shader:
+                        shader.bind()
+                        shader.uniform_float("scene_color", settings.world_color)
+                        shader.uniform_sampler("tbasecolor", basecolor)
+                        shader.uniform_sampler("tshadingmodel", t_shadingmodel)
+                        draw_fullscreen(shader)
+
+            passes = upsample.get("edges") or self.get_light_passes(None, use_shadow, use_tiles)
+            if passes and self.lights:
+                gpu.state.blend_set("ADDITIVE_PREMULT")
+                for ubo in ubos:
+                    self.draw_light_pass(passes, ubo, res, context.region_data,
+                        apply_upsampled=apply_upsampled if upsample else None)
+                    apply_upsampled = False
+                gpu.state.blend_set("NONE")
+
+    # background is None for lights only, otherwise the variant that also applies the
+    # scene color (with or without the world color background)
+    def get_lighting_shader(self, background, use_shadow, tile_class=None, scale=1, upsample=False):
+        key = get_lighting_shader_key(background, use_shadow, tile_class, scale, upsample)
+        SHADERS.request(key, lambda: compile_lighting_shader(background, use_shadow, tile_class, scale, upsample))
+        return SHADERS.get(key)
+
+    # The (program, tile class) draws of one light pass, or None while they're compiling. With
+    # tiles every class has its own program, the fullscreen one is drawn until all of them are
+    # ready. Tiles without lit pixels are left out unless the pass applies the scene color.
+    def get_light_passes(self, background, use_shadow, use_tiles, scale=1, upsample=False):
+        fullscreen = self.get_lighting_shader(background, use_shadow, None, scale, upsample)
+        if use_tiles:
+            passes = [(self.get_lighting_shader(background, use_shadow, tile_class, scale, upsample), tile_class)
+                for tile_class in get_tile_classes(include_none=background is not None)]
+            if all(shader for shader, _ in passes):
+                return passes
+        return [(fullscreen, None)] if fullscreen else None
+
+    # The passes of lighting at a lower resolution: "low" lights the low resolution target,
+    # "fused" (with pass fusion) upsamples it and applies the scene color, "edges" adds the
+    # light blocks to the pixels that couldn't be upsampled. None at full resolution or while
+    # any of them is compiling.
+    def get_upsample_passes(self, settings, use_shadow):
+        scale = LIGHTING_SCALES[settings.lighting_resolution]
+        if scale == 1:
+            return None
+        use_tiles = settings.use_light_tiles
+        passes = {
+            "low": self.get_light_passes(None, use_shadow, use_tiles, scale),
+            "edges": self.get_light_passes(None, use_shadow, use_tiles, scale, upsample=True),
+        }
+        if settings.use_pass_fusion:
+            passes["fused"] = self.get_light_passes(settings.world_color_clear, use_shadow, use_tiles, scale, upsample=True)
+        return passes if all(passes.values()) else None
+
+    # apply_upsampled is None without upsampling, otherwise whether pixels that could be
+    # upsampled get the upsampled lighting (the first pass) or are left as they are
+    def draw_light_pass(self, passes, ubo, res, region_data, scene_color=None, apply_upsampled=None):
+        for shader, tile_class in passes:
+            shader.bind()
+            shader.uniform_sampler("tdepth", res["depth"])
+            shader.uniform_sampler("tbasecolor", res["basecolor"])
+            shader.uniform_sampler("tshadowcolor", res["shadowcolor"])
+            shader.uniform_sampler("tworldnormal", res["normal"])
+            shader.uniform_sampler("tshadingmodel", res["shadingmodel"])
+            if tile_class != TILE_CLASS_NONE:
+                # tiles without lit pixels only get the scene color, the rest is optimized out
+                shader.uniform_float("mat_view_projection", region_data.window_matrix @ region_data.view_matrix)
+                shader.uniform_block("LightBlock", ubo)
+                if "lighting_low" in res and (scene_color is not None or apply_upsampled is not None):
+                    shader.uniform_sampler("tlighting", res["lighting_low"])
+                    shader.uniform_float("depth_linearize",
+                        get_depth_linearize(region_data.window_matrix, region_data.is_perspective))
+                    if scene_color is None:
+                        shader.uniform_int("apply_upsampled", int(apply_upsampled))
+            if scene_color is not None:
+                shader.uniform_float("scene_color", scene_color)
+            if "shadow_atlas" in res:
+                shader.uniform_sampler("tshadow", res["shadow_atlas"] or TEXTURES.white())
+            if tile_class is None:
+                draw_fullscreen(shader)
+            else:
+                size = (res["depth"].width, res["depth"].height)
+                shader.uniform_sampler("ttiles", res["light_tiles"])
+                shader.uniform_float("tile_scale", self.light_tiles.get_tile_scale(size))
+                PROFILER.count("light_tile_draws")
+                self.light_tiles.get_grid(get_tile_count(size)).draw(shader)
+        PROFILER.count("light_passes")
+
+    def draw_taa(self, res, view_projection, settings):
+        with PROFILER.span("taa", gpu=True):
+            res["taa"] = self.temporal_aa.resolve(res["scenelit"], res["depth"], view_projection, settings.taa_feedback)
+        if self.temporal_aa.needs_redraw():
+            self.tag_redraw()
+
+    def draw_rgbl(self, res):
+        rgbl = gpu.types.GPUFrameBuffer(color_slots=(res["rgbl"]))
+        with rgbl.bind(), PROFILER.span("rgbl", gpu=True):
+            shader = SHADERS.get_or_compile(("rgbl",), compile_rgbl_shader)
+            shader.bind()
+            shader.uniform_sampler("image", res["scenelit"])
+            draw_fullscreen(shader)
+
+    def draw_present(self, res, out_texture, context, settings, use_fxaa, w, h):
+        fb = res["viewport"]
+        with fb.bind(), PROFILER.span("present", gpu=True):
             if settings.world_color_clear:
                 fb.clear(color=settings.world_color)
             fb.clear(depth=1.0)
@@ -517,14 +1280,14 @@ class CustomRenderEngine(bpy.types.RenderEngine):
             gpu.state.depth_test_set("ALWAYS")
             gpu.state.depth_mask_set(True)
             
-            coords = ((0, 0), (1, 0), (1, 1), (0, 1))
-            shader = gpu.types.GPUShader(VERTEX_2D, pixel_shader_prefix + present_pixel_shader)
-            vbo = gpu.types.GPUVertBuf(shader.format_calc(), 4)
-            vbo.attr_fill("pos", coords)
-            batch = gpu.types.GPUBatch(type="TRI_FAN", buf=vbo)
+            out_buffer = settings.out_buffer
+            shader = SHADERS.get_or_compile(get_present_shader_key(out_buffer, use_fxaa),
+                lambda: compile_present_shader(out_buffer, use_fxaa))
+            if not shader:
+                return
             shader.bind()
-            shader.uniform_sampler("image", out_texture)
-            shader.uniform_sampler("depth", z)
+            shader.uniform_sampler("image", res[out_texture])
+            shader.uniform_sampler("depth", res["depth"])
             if settings.out_buffer == "POSITION":
                 region_data = context.region_data
                 # shader.uniform_float("mat_view", region_data.view_matrix)
@@ -536,7 +1299,183 @@ class CustomRenderEngine(bpy.types.RenderEngine):
                 shader.uniform_float("invScreenSize", (1.0 / w, 1.0 / h))
             except ValueError:
                 pass
-            batch.draw(shader)
+            draw_fullscreen(shader)
+
+class CustomRenderEngine(SceneRenderer, bpy.types.RenderEngine):
+    # These three members are used by blender to set up the
+    # RenderEngine; define its internal name, visible name and capabilities.
+    bl_idname = "CUSTOM"
+    bl_label = "Custom"
+    bl_use_preview = True
+    # final renders draw with the same passes as the viewport
+    bl_use_gpu_context = True
+
+    # Hides Cycles node trees in the node editor.
+    bl_use_shading_nodes_custom = False
+
+    # When the render engine instance is destroy, this is called. Clean up any
+    # render engine data here, for example stopping running render threads.
+    def __del__(self):
+        self.free()
+
+    # This is the method called by Blender for both final renders (F12) and
+    # small preview for materials, world and lights.
+    def render(self, depsgraph):
+        scene = depsgraph.scene
+        self.size_x, self.size_y = get_render_size(scene)
+
+        # on a thread and GL context of their own, see Profiler
+        if self.is_preview:
+            with PROFILER.track("preview"):
+                self.render_preview(depsgraph)
+            return
+
+        if not scene.camera:
+            self.report({'ERROR'}, "No camera in the scene")
+            return
+
+        from .image_io import to_pass_pixels, linear_depth
+
+        settings = scene.custom_render_engine
+        # all the passes come from the one render
+        readback = {} if settings.use_render_passes else None
+        with PROFILER.track("render"):
+            if settings.render_backend == "CPU":
+                pixels, context = self.render_cpu(depsgraph, settings, readback)
+            else:
+                pixels, context = self.render_gpu(depsgraph, settings, readback)
+
+        result = self.begin_result(0, 0, self.size_x, self.size_y)
+        passes = result.layers[0].passes
+        passes["Combined"].rect.foreach_set(pixels.ravel())
+        if readback:
+            window_matrix = context.region_data.window_matrix
+            for name, texture, channels, *_ in RENDER_PASSES:
+                render_pass = passes.get(name)
+                if render_pass:
+                    data, width, height = readback[texture]
+                    pixels = to_pass_pixels(data, width, height, self.size_x, self.size_y, channels)
+                    if texture == "depth":
+                        pixels = linear_depth(pixels, window_matrix)
+                    elif texture == "scenelit":
+                        # alpha holds luma for FXAA
+                        pixels[..., 3] = 1
+                    render_pass.rect.foreach_set(pixels.ravel())
+        self.end_result(result)
+
+    def render_gpu(self, depsgraph, settings, readback):
+        from .image_io import to_rgba
+
+        offscreen = gpu.types.GPUOffScreen(self.size_x, self.size_y, format="RGBA16F")
+        try:
+            context = self.sync_offscreen(depsgraph, self.size_x, self.size_y)
+            self.draw_offscreen(context, settings, offscreen, readback)
+            return to_rgba(offscreen.texture_color.read(), self.size_x, self.size_y), context
+        finally:
+            offscreen.free()
+
+    # The same frame drawn by cpu_render, for render nodes without a GPU. Nothing here
+    # touches the gpu module.
+    def render_cpu(self, depsgraph, settings, readback):
+        from .cpu_render import OUT_BUFFERS as CPU_OUT_BUFFERS, render_frame as render_frame_cpu
+
+        if settings.out_buffer not in CPU_OUT_BUFFERS:
+            self.report({'WARNING'}, f"The CPU backend doesn't draw the {settings.out_buffer} buffer, rendering the lit image")
+        context = get_camera_context(depsgraph, self.size_x, self.size_y)
+        self.use_shadows = settings.use_shadows
+        lights = [self.create_light(instance.object) for instance in depsgraph.object_instances
+            if instance.object.type == 'LIGHT']
+        with PROFILER.span("cpu_render"):
+            pixels = render_frame_cpu(depsgraph, context, settings, [light for light in lights if light], readback)
+        return pixels, context
+
+    # Material previews are cached on everything that changes them, scrolling through a material
+    # list only draws the ones that were never drawn before. Light, world and texture previews
+    # draw the preview scene from its camera like a final render.
+    def render_preview(self, depsgraph):
+        from .material_preview import PREVIEWS, get_preview_key
+
+        size = (self.size_x, self.size_y)
+        settings = depsgraph.scene.custom_render_engine
+        instances = get_material_preview_instances(depsgraph)
+        if instances:
+            material = get_preview_material(instances)
+            key = get_preview_key(material, size)
+            pixels = PREVIEWS.get(key)
+            if pixels is None:
+                with PROFILER.span("preview"):
+                    pixels = self.draw_preview(material, settings, *size)
+                PREVIEWS.add(key, pixels)
+        elif depsgraph.scene.camera:
+            with PROFILER.span("preview"):
+                pixels, _ = self.render_gpu(depsgraph, settings, None)
+            pixels = pixels.ravel()
+        else:
+            return
+
+        result = self.begin_result(0, 0, self.size_x, self.size_y)
+        result.layers[0].passes["Combined"].rect.foreach_set(pixels)
+        self.end_result(result)
+
+    def draw_preview(self, material, settings, width, height):
+        from .image_io import to_rgba
+        from .material_preview import PREVIEWS
+
+        material_shader = MeshMaterialShader(material)
+        try:
+            SHADERS.get_or_compile(("base_pass",), compile_base_pass_shader)
+            if settings.use_light_tiles:
+                SHADERS.request(("classify_tiles",), compile_classify_shader)
+            for background in (settings.world_color_clear, None):
+                self.get_light_passes(background, False, settings.use_light_tiles)
+            self.get_upsample_passes(settings, False)
+            if settings.use_fxaa:
+                SHADERS.request(get_present_shader_key("SCENELIT", True), lambda: compile_present_shader("SCENELIT", True))
+            # including the node tree's program, the cached preview has to be the final one
+            SHADERS.compile_pending(math.inf)
+            self.mesh_objects = [PREVIEW_OBJECT]
+            self.draw_calls = {PREVIEW_OBJECT.name: PreviewSphereRendering(material_shader)}
+            self.lights = [PreviewLightRendering()]
+            self.render_targets = PREVIEWS.render_targets
+            offscreen = PREVIEWS.get_offscreen(width, height)
+            self.draw_offscreen(get_preview_context(width, height), settings, offscreen)
+            return to_rgba(offscreen.texture_color.read(), width, height).ravel()
+        finally:
+            material_shader.release_textures()
+
+    # Passes shown in the compositor's Render Layers node
+    def update_render_passes(self, scene=None, renderlayer=None):
+        self.register_pass(scene, renderlayer, "Combined", 4, "RGBA", 'COLOR')
+        if scene.custom_render_engine.use_render_passes:
+            for name, _, channels, chan_id, type in RENDER_PASSES:
+                self.register_pass(scene, renderlayer, name, channels, chan_id, type)
+
+    # For viewport renders, this method gets called once at the start and
+    # whenever the scene or 3D viewport changes. This method is where data
+    # should be read from Blender in the same thread. Typically a render
+    # thread will be started to do the work while keeping Blender responsive.
+    def view_update(self, context, depsgraph):
+        with PROFILER.span("view_update"):
+            self.sync_depsgraph(context, depsgraph)
+
+    # For viewport renders, this method is called whenever Blender redraws
+    # the 3D viewport. The renderer is expected to quickly draw the render
+    # with OpenGL, and not perform other expensive work.
+    # Blender will draw overlays for selection and editing on top of the
+    # rendered image automatically.
+    def view_draw(self, context, depsgraph):
+        
+        region = context.region
+        scene = depsgraph.scene
+
+        # Get viewport dimensions
+        dimensions = region.width, region.height
+
+        settings = self.get_settings(context)
+        PROFILER.set_enabled(settings.use_profiler)
+        with PROFILER.span("view_draw"):
+            self.draw_frame(context, settings, use_taa=True)
+        PROFILER.end_frame()
 
 # class MeshShader:
 #     def __init__(self, vertex_path, pixel_path, geometry_path=None):
@@ -559,34 +1498,33 @@ class CustomRenderEngine(bpy.types.RenderEngine):
 #         self.shader.uniform_sampler(name, tex)
 
 class MeshMaterialShader():
-    def __init__(self, material):
-
-        self.shader = gpu.types.GPUShader(
-            open("shaders/VertexShader.glsl").read(),
-            open("shaders/BasePassPixelShader.glsl").read(),
-            geocode=open("shaders/GeometryShader.glsl").read())
+    def __init__(self, material, texture_max_size=None):
+        # every material uses the same program, only the uniforms differ
+        SHADERS.request(("base_pass",), compile_base_pass_shader, priority=True)
         # print("compiling material: " + ("default" if not material else material.name), flush=True)
         self.material = material
+        self.texture_keys = []
+        self.texture_max_size = texture_max_size
         self.update()
 
-    def update(self):
-        self.tbasecolor = gpu.types.GPUTexture((1, 1))
-        self.tbasecolor.clear(format="FLOAT", value=(1, 1, 1, 1))
-        
-        self.tshadowtint = gpu.types.GPUTexture((1, 1))
-        self.tshadowtint.clear(format="FLOAT", value=(0, 0, 0, 1))
-
-        try:
-            basecolor = bpy.data.images[self.material.custom_settings.tex_base_color]
-            self.tbasecolor = gpu.texture.from_image(basecolor)
-        except (AttributeError, KeyError):
-            pass
+    # the node tree's program once it's compiled, the flat properties until then
+    @property
+    def shader(self):
+        if self.node_graph:
+            shader = SHADERS.get(("base_pass", self.node_graph.key))
+            if shader:
+                return shader
+        return SHADERS.get(("base_pass",))
 
-        try:
-            shadowtint = bpy.data.images[self.material.custom_settings.tex_shadow_tint]
-            self.tshadowtint = gpu.texture.from_image(shadowtint)
-        except (AttributeError, KeyError):
-            pass
+    def update(self):
+        # acquire before releasing, so textures that are still used don't get evicted in between
+        old_keys = self.texture_keys
+        self.texture_keys = []
+        self.tbasecolor = self.acquire_texture("tex_base_color", TEXTURES.white())
+        self.tshadowtint = self.acquire_texture("tex_shadow_tint", TEXTURES.black())
+        self.update_node_tree()
+        for key in old_keys:
+            TEXTURES.release(key)
 
         if self.material:
             self.col_basecolor = tuple(self.material.diffuse_color[:3])
@@ -599,13 +1537,110 @@ class MeshMaterialShader():
             self.col_basecolor = (1, 1, 1)
             self.shadingmodel = 1
     
+    # Programs are shared by every node tree with the same structure, so only a structure
+    # change compiles anything; the values are read again on every update
+    def update_node_tree(self):
+        from .node_compiler import NODE_SHADERS, UnsupportedNode
+
+        self.node_graph = None
+        self.node_uniforms = []
+        self.node_samplers = []
+        material = self.material
+        if not material or not material.use_nodes or not material.node_tree:
+            return
+        try:
+            compiled = NODE_SHADERS.compile(material.node_tree)
+        except UnsupportedNode as e:
+            print(f"{material.name}: {e}, using the material settings", flush=True)
+            return
+        if compiled is None:
+            # not one of this engine's node trees
+            return
+        graph, source = compiled
+        self.node_graph = graph
+        SHADERS.request(("base_pass", graph.key), lambda: compile_node_base_pass_shader(source), priority=True)
+        self.node_uniforms = [(f"node_u{i}", value) for i, value in enumerate(graph.get_uniform_values())]
+        for i, image in enumerate(graph.samplers):
+            texture = TEXTURES.black()
+            if image is not None:
+                self.texture_keys.append(texture_key(image, self.texture_max_size))
+                texture = TEXTURES.acquire(image, self.texture_max_size)
+            self.node_samplers.append((f"node_t{i}", texture))
+
+    def acquire_texture(self, prop, fallback):
+        try:
+            image = bpy.data.images[getattr(self.material.custom_settings, prop)]
+        except (AttributeError, KeyError):
+            return fallback
+        self.texture_keys.append(texture_key(image, self.texture_max_size))
+        return TEXTURES.acquire(image, self.texture_max_size)
+
+    def release_textures(self):
+        for key in self.texture_keys:
+            TEXTURES.release(key)
+        self.texture_keys = []
+
+    def uses_image(self, image):
+        pointer = image_key(image)
+        return any(key[0] == pointer for key in self.texture_keys)
+
+    # None uploads full resolution textures
+    def set_texture_max_size(self, max_size):
+        if max_size != self.texture_max_size:
+            self.texture_max_size = max_size
+            self.update()
+
+    # returns None while the base pass program is still compiling
     def bind(self):
-        self.shader.bind()
-        self.shader.uniform_sampler("tbasecolor", self.tbasecolor)
-        self.shader.uniform_sampler("tshadowtint", self.tshadowtint)
-        self.shader.uniform_float("col_basecolor", self.col_basecolor)
-        self.shader.uniform_int("shadingmodel", self.shadingmodel)
-        return self.shader
+        shader = self.shader
+        if not shader:
+            return None
+        shader.bind()
+        shader.uniform_sampler("tbasecolor", self.tbasecolor)
+        shader.uniform_sampler("tshadowtint", self.tshadowtint)
+        shader.uniform_float("col_basecolor", self.col_basecolor)
+        shader.uniform_int("shadingmodel", self.shadingmodel)
+        if self.node_graph and shader is SHADERS.get(("base_pass", self.node_graph.key)):
+            for name, texture in self.node_samplers:
+                shader.uniform_sampler(name, texture)
+            for name, value in self.node_uniforms:
+                try:
+                    shader.uniform_float(name, value)
+                except ValueError:
+                    # optimized out
+                    pass
+        return shader
+
+# Attributes are split in two vertex buffers, the dynamic one is all that gets
+# re-uploaded when an armature (or any other deformer) moves the mesh.
+BASE_PASS_DYNAMIC_ATTRIBUTES = (
+    ("position", 3),
+    ("normal", 3),
+    ("tangent", 3),
+)
+BASE_PASS_STATIC_ATTRIBUTES = (
+    ("bitangent_sign", 1),
+    ("uv", 2),
+    ("color", 4),
+)
+DEPTH_PASS_ATTRIBUTES = (
+    ("position", 3),
+)
+
+_vertex_formats = {}
+
+def get_vertex_format(attributes):
+    fmt = _vertex_formats.get(attributes)
+    if fmt is None:
+        fmt = gpu.types.GPUVertFormat()
+        for id, length in attributes:
+            fmt.attr_add(id=id, comp_type='F32', len=length, fetch_mode="FLOAT")
+        _vertex_formats[attributes] = fmt
+    return fmt
+
+def get_topology(mesh, loop_vertices):
+    import zlib
+    return (len(mesh.vertices), len(mesh.loops), len(mesh.polygons), zlib.crc32(loop_vertices))
 
 class MeshDraw:
     def __init__(self, mesh):
@@ -614,51 +1649,218 @@ class MeshDraw:
         self.create_batch(mesh)
 
     def create_shaders(self):
-        self.shader = gpu.types.GPUShader(VERTEX_SHADER, PIXEL_SHADER, geocode=GEOMETRY_SHADER)
+        self.shader = gpu.types.GPUShader(
+            get_shader_source("VertexShader.glsl"),
+            get_shader_source("PixelShader.glsl"),
+            geocode=get_shader_source("GeometryShader.glsl"))
     
     def create_batch(self, mesh):
+        with PROFILER.span("create_batch"):
+            self.build_batch(mesh)
+
+    # Fast path for deforming meshes: if the topology is the same, only positions, normals and
+    # tangents are extracted again, index buffer and static attributes are kept.
+    # Returns False if the batch has to be created from scratch.
+    def update_deformed(self, mesh):
+        import numpy as np
+
+        with PROFILER.span("update_deformed"):
+            if len(mesh.loops) != len(self.loop_vertices) or len(mesh.vertices) != len(self.coords):
+                return False
+            loop_vertices = np.empty(len(mesh.loops), dtype=np.intc)
+            mesh.loops.foreach_get("vertex_index", loop_vertices)
+            if get_topology(mesh, loop_vertices) != self.topology:
+                return False
+
+            # calc_tangents used to fill in the loop normals as well
+            mesh.calc_normals_split()
+            self.extract_dynamic(mesh)
+            # sorting, LODs, shadow casters and culling go by the deformed bounds
+            self.update_bounds()
+            if self.resident:
+                self.create_dynamic_batch()
+            else:
+                self.upload()
+            PROFILER.count("deformed_meshes")
+            return True
+
+    def extract_dynamic(self, mesh):
+        import numpy as np
+        from .tangents import calc_tangents
+
+        mesh.vertices.foreach_get("co", np.reshape(self.coords, len(mesh.vertices) * 3))
+        np.take(self.coords, self.loop_vertices, axis=0, out=self.positions)
+        mesh.loops.foreach_get("normal", np.reshape(self.normals, len(mesh.loops) * 3))
+        # the bitangent signs only depend on the UVs, deformed meshes keep the uploaded ones
+        with PROFILER.span("tangents"):
+            self.tangents, self.bitangent_signs = calc_tangents(self.positions, self.normals, self.uvs, self.indices)
+
+    def create_dynamic_batch(self):
+        # GPUVertBuf can't be written to again after it's been uploaded, so a new (smaller)
+        # buffer is made for the dynamic attributes and drawn together with the kept ones
+        vbo = gpu.types.GPUVertBuf(len=len(self.positions), format=get_vertex_format(BASE_PASS_DYNAMIC_ATTRIBUTES))
+        vbo.attr_fill(id="position", data=self.positions)
+        vbo.attr_fill(id="normal", data=self.normals)
+        vbo.attr_fill(id="tangent", data=self.tangents)
+        self.dynamic_vbo = vbo
+        self.batch = self.make_batch(self.ibo)
+        self.lod_batches = [self.make_batch(ibo) for ibo in self.lod_ibos]
+        self.depth_vbo = None
+        self.depth_batches = {}
+
+    def make_batch(self, ibo):
+        batch = gpu.types.GPUBatch(type="TRIS", buf=self.dynamic_vbo, elem=ibo)
+        batch.vertbuf_add(self.static_vbo)
+        return batch
+
+    # LODs are index buffers over the same vertex buffers, generated in the background
+    def request_lods(self, levels):
+        from .lod import LODS
+
+        self.lod_levels = levels
+        self.lod_key = LODS.request(self.positions, self.indices, levels) if levels else None
+        self.lod_indices = []
+        self.lod_ibos = []
+        self.lod_batches = []
+        self.lod_triangles = []
+
+    def update_lods(self):
+        if not self.lod_key or self.lod_ibos:
+            return
+        from .lod import LODS
+
+        lods = LODS.get(self.lod_key)
+        if lods is None:
+            return
+        self.lod_key = None
+        self.lod_indices = lods
+        self.lod_ibos = [gpu.types.GPUIndexBuf(type="TRIS", seq=triangles) for triangles in lods]
+        self.lod_triangles = [len(triangles) for triangles in lods]
+        self.lod_batches = [self.make_batch(ibo) for ibo in self.lod_ibos]
+        self.depth_batches = {}
+
+    def select_lod(self, transform, view_projection, projection, viewport_height, screen_size):
+        from .lod import projected_size, select_lod
+
+        self.update_lods()
+        if not self.lod_batches:
+            return 0
+        center = transform @ self.bounds_center
+        radius = self.bounds_radius * max(transform.to_scale())
+        size = projected_size(center, radius, view_projection, projection, viewport_height)
+        return select_lod(size, screen_size, len(self.lod_batches))
+
+    def get_batch(self, lod):
+        if lod == 0:
+            PROFILER.count("triangles", len(self.indices))
+            return self.batch
+        PROFILER.count("triangles", self.lod_triangles[lod - 1])
+        return self.lod_batches[lod - 1]
+
+    # Positions only, for the depth pre-pass. Made on first use, most meshes never need it.
+    def get_depth_batch(self, lod):
+        batch = self.depth_batches.get(lod)
+        if batch is None:
+            ibo = self.ibo if lod == 0 else self.lod_ibos[lod - 1]
+            batch = gpu.types.GPUBatch(type="TRIS", buf=self.get_depth_vbo(), elem=ibo)
+            self.depth_batches[lod] = batch
+        return batch
+
+    def get_depth_vbo(self):
+        if self.depth_vbo is None:
+            self.depth_vbo = gpu.types.GPUVertBuf(len=len(self.positions), format=get_vertex_format(DEPTH_PASS_ATTRIBUTES))
+            self.depth_vbo.attr_fill(id="position", data=self.positions)
+        return self.depth_vbo
+
+    def build_batch(self, mesh):
+        # numpy is only needed once there's something to draw, keep it out of add-on startup
+        import numpy as np
+
         mesh.calc_loop_triangles()
-        try:
-            mesh.calc_tangents()
-        except:
-            pass
+        mesh.calc_normals_split()
 
-        vertices = np.empty((len(mesh.loops), 3), dtype=np.float32)
         color = np.full((len(mesh.loops), 4), [0.5, 0.5, 1, 1], dtype=np.float32)
-        normals = np.empty((len(mesh.loops), 3), dtype=np.float32)
-        tangents = np.empty((len(mesh.loops), 3), dtype=np.float32)
-        bitangent_signs = np.empty(len(mesh.loops), dtype=np.half)
         uvs = np.zeros((len(mesh.loops), 2), dtype=np.float32)
         indices = np.empty((len(mesh.loop_triangles), 3), dtype=np.uintc)
 
-        coords = np.empty((len(mesh.vertices), 3), dtype=np.float32)
-        mesh.vertices.foreach_get("co", np.reshape(coords, len(mesh.vertices) * 3))
-        loop_vertices = np.empty(len(mesh.loops), dtype=np.int)
-        mesh.loops.foreach_get("vertex_index", loop_vertices)
-        vertices = coords[loop_vertices]
-
-        mesh.loops.foreach_get("normal", np.reshape(normals, len(mesh.loops) * 3))
-        mesh.loops.foreach_get("tangent", np.reshape(tangents, len(mesh.loops) * 3))
-        mesh.loops.foreach_get("bitangent_sign", bitangent_signs)
-        bitangent_signs = np.negative(bitangent_signs)
         if mesh.uv_layers.active:
             mesh.uv_layers.active.data.foreach_get("uv", np.reshape(uvs, len(mesh.loops) * 2))
         if mesh.vertex_colors.active:
             mesh.vertex_colors.active.data.foreach_get("color", np.reshape(color, len(mesh.loops) * 4))
-
         mesh.loop_triangles.foreach_get("loops", np.reshape(indices, len(mesh.loop_triangles) * 3))
-
-        # fmt = gpu.types.GPUVertFormat()
-        # fmt.attr_add(id="position", comp_type='F32', len=3, fetch_mode="FLOAT")
-        # fmt.attr_add(id="color", comp_type='F32', len=4, fetch_mode="FLOAT")
-
-        # vbo = gpu.types.GPUVertBuf(len=len(vertices), format=fmt)
-        # vbo.attr_fill(id="position", data=vertices)
-        # vbo.attr_fill(id="color", data=color)
-
-        # ibo = gpu.types.GPUIndexBuf(types="TRIS", seq=indices)
-
-        self.batch = batch_for_shader(self.shader, 'TRIS', {"position": vertices, "normal": normals, "tangent": tangents, "bitangent_sign": bitangent_signs, "uv": uvs, "color": color}, indices=indices)
+        self.indices = indices
+
+        # kept around for update_deformed, without a UV map tangents are any perpendicular to the normal
+        self.uvs = uvs if mesh.uv_layers.active else None
+        self.coords = np.empty((len(mesh.vertices), 3), dtype=np.float32)
+        self.positions = np.empty((len(mesh.loops), 3), dtype=np.float32)
+        self.normals = np.empty((len(mesh.loops), 3), dtype=np.float32)
+        self.loop_vertices = np.empty(len(mesh.loops), dtype=np.intc)
+        mesh.loops.foreach_get("vertex_index", self.loop_vertices)
+        self.topology = get_topology(mesh, self.loop_vertices)
+        self.extract_dynamic(mesh)
+        bitangent_signs = np.negative(self.bitangent_signs)
+        self.update_bounds()
+
+        # kept with the dynamic attributes and indices, so the buffers can be uploaded again
+        # after GPU_MEMORY evicted them
+        self.static_attributes = {"bitangent_sign": bitangent_signs, "uv": uvs, "color": color}
+        self.lod_indices = []
+        self.upload()
+        self.last_used = GPU_MEMORY.frame
+        self.request_lods(getattr(self, "lod_levels", 0))
+
+    # bounding sphere of the positions
+    def update_bounds(self):
+        import numpy as np
+
+        if len(self.positions):
+            lo = self.positions.min(axis=0)
+            hi = self.positions.max(axis=0)
+            center = (lo + hi) / 2
+            self.bounds_center = mathutils.Vector(center.tolist())
+            self.bounds_radius = float(np.linalg.norm(hi - center))
+        else:
+            self.bounds_center = mathutils.Vector((0, 0, 0))
+            self.bounds_radius = 0.0
+
+    def upload(self):
+        # the vertex format is built by hand so batches can be created before the program is compiled
+        self.static_vbo = gpu.types.GPUVertBuf(len=len(self.positions), format=get_vertex_format(BASE_PASS_STATIC_ATTRIBUTES))
+        for id, data in self.static_attributes.items():
+            self.static_vbo.attr_fill(id=id, data=data)
+        self.ibo = gpu.types.GPUIndexBuf(type="TRIS", seq=self.indices)
+        self.lod_ibos = [gpu.types.GPUIndexBuf(type="TRIS", seq=triangles) for triangles in self.lod_indices]
+        self.create_dynamic_batch()
+        self.resident = True
+
+    # Frees the GPU buffers, the next draw uploads them again
+    def evict(self):
+        self.static_vbo = None
+        self.dynamic_vbo = None
+        self.ibo = None
+        self.lod_ibos = []
+        self.batch = None
+        self.lod_batches = []
+        self.depth_vbo = None
+        self.depth_batches = {}
+        self.resident = False
+
+    def make_resident(self):
+        if not self.resident:
+            self.upload()
+            PROFILER.count("mesh_uploads")
+
+    # estimated from the buffer sizes
+    def get_bytes(self):
+        if not self.resident:
+            return 0
+        vertex_size = sum(length for _, length in BASE_PASS_DYNAMIC_ATTRIBUTES + BASE_PASS_STATIC_ATTRIBUTES) * 4
+        nbytes = len(self.positions) * vertex_size + self.indices.nbytes
+        nbytes += sum(triangles.nbytes for triangles in self.lod_indices)
+        if self.depth_vbo is not None:
+            nbytes += len(self.positions) * 12
+        return nbytes
 
 
     def draw_forward(self, transform, region_data, lights, settings):
@@ -712,10 +1914,10 @@ class MeshDraw:
 
 class BasePassRendering(MeshDraw):
 
-    def __init__(self, mesh, mesh_material_shader: MeshMaterialShader):
+    def __init__(self, mesh, mesh_material_shader: MeshMaterialShader, lod_levels=0):
         # super().__init__(mesh)
         self.matshader = mesh_material_shader
-        self.shader = mesh_material_shader.shader
+        self.lod_levels = lod_levels
         self.create_batch(mesh)
 
     # def create_shaders(self):
@@ -724,20 +1926,15 @@ class BasePassRendering(MeshDraw):
     #         open("shaders/BasePassPixelShader.glsl").read(),
     #         geocode=GEOMETRY_SHADER)
 
-    def draw(self, transform, view_projection_matrix, settings):
+    def draw(self, transform, view_projection_matrix, settings, lod=0):
 
         shader = self.matshader.bind()
+        if not shader:
+            return
         # shader.bind()
 
-        shader.uniform_float("matrix_world", transform)
-        shader.uniform_float("mat_view_projection", view_projection_matrix)
-
-        shader.uniform_bool("render_outlines", [settings.enable_outline])
-        shader.uniform_float("outline_width", settings.outline_width)
+        self.set_uniforms(shader, transform, view_projection_matrix, settings)
         shader.uniform_float("outline_color", settings.outline_color)
-        shader.uniform_float("depth_scale_exponent", settings.outline_depth_exponent)
-        shader.uniform_bool("use_vertexcolor_alpha", [settings.use_vertexcolor_alpha])
-        shader.uniform_bool("use_vertexcolor_rgb", [settings.use_vertexcolor_rgb])
         
         # if settings.basecolor_texture:
         #     tbasecolor = gpu.texture.from_image(bpy.data.images[settings.basecolor_texture])
@@ -761,86 +1958,214 @@ class BasePassRendering(MeshDraw):
         # self.shader.uniform_sampler("tbasecolor", tbasecolor)
         # self.shader.uniform_sampler("tshadowtint", tshadowtint)
 
-        self.batch.draw(shader)
+        PROFILER.count(f"lod{lod}")
+        self.get_batch(lod).draw(shader)
+
+    # the vertex and geometry shader uniforms, shared with the overdraw view
+    def set_uniforms(self, shader, transform, view_projection_matrix, settings):
+        shader.uniform_float("matrix_world", transform)
+        shader.uniform_float("mat_view_projection", view_projection_matrix)
+
+        shader.uniform_bool("render_outlines", [settings.enable_outline])
+        shader.uniform_float("outline_width", settings.outline_width)
+        shader.uniform_float("depth_scale_exponent", settings.outline_depth_exponent)
+        shader.uniform_bool("use_vertexcolor_alpha", [settings.use_vertexcolor_alpha])
+        shader.uniform_bool("use_vertexcolor_rgb", [settings.use_vertexcolor_rgb])
+
+    # with the depth pre-pass program, already bound
+    def draw_depth(self, shader, transform, lod=0):
+        shader.uniform_float("matrix_world", transform)
+        self.get_depth_batch(lod).draw(shader)
+
+    # the base pass geometry with another (bound) program
+    def draw_with(self, shader, transform, view_projection_matrix, settings, lod=0):
+        self.set_uniforms(shader, transform, view_projection_matrix, settings)
+        self.get_batch(lod).draw(shader)
+
+_preview_sphere_batch = None
+
+def get_preview_sphere_batch():
+    global _preview_sphere_batch
+    if _preview_sphere_batch is None:
+        import numpy as np
+        from .material_preview import create_sphere
+
+        positions, tangents, uvs, indices = create_sphere()
+        dynamic_vbo = gpu.types.GPUVertBuf(len=len(positions), format=get_vertex_format(BASE_PASS_DYNAMIC_ATTRIBUTES))
+        dynamic_vbo.attr_fill(id="position", data=positions)
+        dynamic_vbo.attr_fill(id="normal", data=positions)
+        dynamic_vbo.attr_fill(id="tangent", data=tangents)
+        static_vbo = gpu.types.GPUVertBuf(len=len(positions), format=get_vertex_format(BASE_PASS_STATIC_ATTRIBUTES))
+        static_vbo.attr_fill(id="bitangent_sign", data=np.full(len(positions), -1, dtype=np.float32))
+        static_vbo.attr_fill(id="uv", data=uvs)
+        static_vbo.attr_fill(id="color", data=np.full((len(positions), 4), [0.5, 0.5, 1, 1], dtype=np.float32))
+        _preview_sphere_batch = gpu.types.GPUBatch(type="TRIS", buf=dynamic_vbo, elem=gpu.types.GPUIndexBuf(type="TRIS", seq=indices))
+        _preview_sphere_batch.vertbuf_add(static_vbo)
+    return _preview_sphere_batch
+
+PREVIEW_OBJECT = types.SimpleNamespace(name="preview_sphere", matrix_world=mathutils.Matrix.Identity(4))
+
+class PreviewSphereRendering(BasePassRendering):
+    # draws the shared sphere batch with the previewed material
+    def __init__(self, mesh_material_shader: MeshMaterialShader):
+        self.matshader = mesh_material_shader
+        self.lod_levels = 0
+        self.bounds_center = mathutils.Vector((0, 0, 0))
+        # the batch is built once and kept, it's not in SCENE for the memory budget to evict
+        self.resident = True
+
+    def get_batch(self, lod):
+        return get_preview_sphere_batch()
+
+    def get_depth_batch(self, lod):
+        return get_preview_sphere_batch()
+
+# stands in for the object of a static batch's draw, its vertices are already in world space
+STATIC_BATCH_OBJECT = types.SimpleNamespace(name="static_batch", matrix_world=mathutils.Matrix.Identity(4))
+
+# The members of a static batch merged into one draw with their vertices in world space, drawn
+# with an identity matrix_world (see static_batching.py). No LODs, the members are small.
+class StaticBatchRendering(BasePassRendering):
+    def __init__(self, draws, matrices, mesh_material_shader: MeshMaterialShader):
+        from .static_batching import merge_meshes
+
+        self.matshader = mesh_material_shader
+        self.lod_levels = 0
+        with PROFILER.span("static_batch"):
+            merged = merge_meshes(draws, matrices)
+            self.merged = merged
+            self.positions = merged["positions"]
+            self.normals = merged["normals"]
+            self.tangents = merged["tangents"]
+            self.static_attributes = merged["static_attributes"]
+            self.indices = merged["indices"]
+            self.first_triangles = merged["first_triangles"]
+            self.triangle_counts = merged["triangle_counts"]
+            self.member_centers = merged["centers"]
+            self.member_radii = merged["radii"]
+            self.update_bounds()
+            self.lod_indices = []
+            self.request_lods(0)
+            self.upload()
+        self.last_used = GPU_MEMORY.frame
+        self.subset = None
+        self.use_subset = False
+
+    # Culls the members against the frustum, False if none of them is visible. Most of the
+    # batch visible draws all of it (the GPU clips the rest for less than a new index buffer
+    # costs), otherwise an index buffer of the visible members' ranges, kept while the same
+    # members are visible.
+    def cull(self, planes):
+        import numpy as np
+        from .static_batching import spheres_visible
+
+        visible = spheres_visible(planes, self.member_centers, self.member_radii)
+        triangles = int(self.triangle_counts[visible].sum())
+        self.use_subset = 0 < triangles and triangles * 2 < len(self.indices)
+        if self.use_subset:
+            key = np.packbits(visible).tobytes()
+            if self.subset is None or self.subset[0] != key:
+                ranges = [self.indices[first:first + count]
+                    for first, count in zip(self.first_triangles[visible], self.triangle_counts[visible])]
+                ibo = gpu.types.GPUIndexBuf(type="TRIS", seq=np.concatenate(ranges))
+                # key, triangles, index buffer, batch and depth batch, made on first use
+                self.subset = [key, triangles, ibo, None, None]
+                PROFILER.count("static_batch_subsets")
+        return triangles > 0
+
+    # Writes members, (index, draw, matrix), into their ranges again, see patch_member. Only
+    # the transformed attributes are uploaded again unless geometry is set.
+    def patch(self, members, geometry):
+        from .static_batching import patch_member
+
+        with PROFILER.span("static_batch_patch"):
+            for index, draw, matrix in members:
+                if not patch_member(self.merged, index, draw, matrix, geometry):
+                    return False
+            self.update_bounds()
+            # made with the old buffers
+            self.subset = None
+            self.use_subset = False
+            if self.resident:
+                if geometry:
+                    self.upload()
+                else:
+                    self.create_dynamic_batch()
+        return True
+
+    def get_batch(self, lod):
+        if not self.use_subset:
+            return super().get_batch(lod)
+        PROFILER.count("triangles", self.subset[1])
+        if self.subset[3] is None:
+            self.subset[3] = self.make_batch(self.subset[2])
+        return self.subset[3]
+
+    def get_depth_batch(self, lod):
+        if not self.use_subset:
+            return super().get_depth_batch(lod)
+        if self.subset[4] is None:
+            self.subset[4] = gpu.types.GPUBatch(type="TRIS", buf=self.get_depth_vbo(), elem=self.subset[2])
+        return self.subset[4]
+
+    def evict(self):
+        super().evict()
+        self.subset = None
+        self.use_subset = False
 
 class LightRendering:
-    def __init__(self, light_object):
+    # Light parameters for the packed light buffer, gathered once when the light is created
+    # (lights are created again whenever objects change)
+    def __init__(self, light_object, use_shadow=False):
         self.object = light_object
-        # self.create_shader_info()
-        self.create_shader()
-    
-    def get_defines(self):
-        return CustomRenderEngineMaterialSettings.get_shadingmodels_define()
-    
-    # def create_shader_info(self):
-    #     self.shaderinfo = gpu.types.GPUShaderCreateInfo()
-    #     self.shaderinfo.vertex_source(VERTEX_2D)
-    #     pixel_shader_source = open(get_path("shaders/DeferredLightPixelShader.glsl")).read()
-    #     self.shaderinfo.fragment_source(pixel_shader_source)
-
-    def create_shader(self):
-        # self.shader = gpu.shader.create_from_info(self.shaderinfo)
-        pixel_shader_source = open("shaders/DeferredLightPixelShader.glsl").read()
-        self.shader = gpu.types.GPUShader(VERTEX_2D, pixel_shader_source, defines=self.get_defines())
-        self.batch = batch_for_shader(self.shader, "TRI_FAN", {"pos": ((0, 0), (1, 0), (1, 1), (0, 1))})
-
-    def set_uniforms(self, region_data):
-        try:
-            self.shader.uniform_float("energy", self.object.data.energy * self.energy_factor)
-            # self.shader.uniform_float("energy", self.object.data.energy)
-        except ValueError:
-            # optimized out by shader compiler
-            pass
-        try:
-            self.shader.uniform_float("mat_view_projection", region_data.window_matrix @ region_data.view_matrix)
-        except ValueError:
-            # this is dumb
-            pass
-        try:
-            self.shader.uniform_float("light_color", self.object.data.color)
-        except ValueError:
-            pass
-
-    def draw(self, region_data, tdepth, tbasecolor, tshadowcolor, tworldnormal, tshadingmodel):
-        shader = self.shader
-        shader.bind()
-        shader.uniform_sampler("tdepth", tdepth)
-        shader.uniform_sampler("tbasecolor", tbasecolor)
-        shader.uniform_sampler("tshadowcolor", tshadowcolor)
-        shader.uniform_sampler("tworldnormal", tworldnormal)
-        shader.uniform_sampler("tshadingmodel", tshadingmodel)
+        self.use_shadow = use_shadow
+        self.energy_factor = 1
 
-        self.set_uniforms(region_data)
+    def pack(self, block, index):
+        light = self.object.data
+        color = light.color
+        energy = light.energy * self.energy_factor
+        block["light_color"][index] = (color[0] * energy, color[1] * energy, color[2] * energy, 0)
 
-        self.batch.draw(shader)
+    # the settings pack reads from the light datablock
+    def get_signature(self):
+        light = self.object.data
+        return light.type, light.energy, tuple(light.color)
 
 class DirectionalLightRendering(LightRendering):
-    def __init__(self, light_object):
+    def __init__(self, light_object, use_shadow=False):
         assert light_object.data.type == "SUN"
-        super().__init__(light_object)
+        super().__init__(light_object, use_shadow)
         self.energy_factor = 1
         light_direction = mathutils.Vector((0, 0, 1))
         light_direction.rotate(light_object.matrix_world.decompose()[1])
         self.direction = light_direction
-    
-    def get_defines(self):
-        return super().get_defines() + """
-            #define DIRECTIONAL_LIGHT 1
-        """
-    
-    # def create_shader_info(self):
-    #     super().create_shader_info()
-    #     self.shaderinfo.define("DIRECTIONAL_LIGHT", "1")
-    
-    def set_uniforms(self, region_data):
-        super().set_uniforms(region_data)
-        shader = self.shader
-        shader.uniform_float("light_direction", self.direction)
+
+    def pack(self, block, index):
+        from .light_buffer import LIGHT_TYPES
+
+        super().pack(block, index)
+        block["light_position"][index] = (*self.direction[:3], LIGHT_TYPES["SUN"])
+
+class PreviewLightRendering(LightRendering):
+    # the preview's sun, there's no light object behind it
+    def __init__(self):
+        super().__init__(None)
+
+    def get_signature(self):
+        return None
+
+    def pack(self, block, index):
+        from .light_buffer import LIGHT_TYPES
+
+        block["light_color"][index] = (3, 3, 3, 0)
+        direction = mathutils.Vector(PREVIEW_LIGHT_DIRECTION).normalized()
+        block["light_position"][index] = (*direction[:3], LIGHT_TYPES["SUN"])
 
 class LocalLightRendering(LightRendering):
-    def __init__(self, light_object):
+    def __init__(self, light_object, use_shadow=False):
         assert light_object.data.type in ("POINT", "SPOT", "AREA")
-        super().__init__(light_object)
+        super().__init__(light_object, use_shadow)
         self.energy_factor = 0.09
         light = light_object.data
 
@@ -849,31 +2174,89 @@ class LocalLightRendering(LightRendering):
         self.location = light_object.matrix_world.to_translation()
 
         if light.use_custom_distance:
-            self.attenuation = self.cutoff_distance
+            self.attenuation = light.cutoff_distance
         else:
             self.attenuation = -1
-    
-    def get_defines(self):
-        return super().get_defines() + """
-            #define LOCAL_LIGHT 1
-        """ + f"\n#define {self.object.data.type}_LIGHT 1\n"
-    
-    def set_uniforms(self, region_data):
-        super().set_uniforms(region_data)
-        shader = self.shader
-        shader.uniform_float("light_location", self.location)
 
-        light = self.object.data
         if light.type == "SPOT":
             light_direction = mathutils.Vector((0, 0, 1))
-            light_direction.rotate(self.object.matrix_world.decompose()[1])
-            shader.uniform_float("light_spot_direction", light_direction)
-            shader.uniform_float("light_spot_size", light.spot_size / math.pi)
-            shader.uniform_float("light_spot_blend", light.spot_blend)
+            light_direction.rotate(light_object.matrix_world.decompose()[1])
+            self.spot_direction = light_direction
+
+    def pack(self, block, index):
+        from .light_buffer import LIGHT_TYPES
+
+        super().pack(block, index)
+        light = self.object.data
+        block["light_position"][index] = (*self.location[:3], LIGHT_TYPES.get(light.type, LIGHT_TYPES["POINT"]))
+        if light.type == "SPOT":
+            block["light_color"][index][3] = light.spot_size / math.pi
+            block["light_spot"][index] = (*self.spot_direction[:3], light.spot_blend)
+
+    # only spot lights have a cone
+    def get_signature(self):
+        signature = super().get_signature()
+        light = self.object.data
+        if light.type == "SPOT":
+            signature += (light.spot_size, light.spot_blend)
+        return signature
 
 class CustomRenderEngineSettings(bpy.types.PropertyGroup):
+    render_backend: bpy.props.EnumProperty(name="Render Backend", default="GPU", options=set(),
+        items=[
+            ("GPU", "GPU", "Render with the same passes as the viewport"),
+            ("CPU", "CPU", "Render with NumPy on image tiles, for machines without a GPU and reference images"),
+        ],
+        description="What final renders are drawn with, the viewport always uses the GPU")
+    cpu_threads: bpy.props.IntProperty(name="CPU Threads", default=0, min=0, soft_max=64, options=set(),
+        description="Threads rendering image tiles in parallel, 0 uses one per core")
     backbuffer_scale: bpy.props.FloatProperty(name="Backbuffer Scale", default=1.0, min=0.1, max=10)
     use_fxaa: bpy.props.BoolProperty(name="FXAA", default=True)
+    use_pass_fusion: bpy.props.BoolProperty(name="Fuse Passes", default=True, options=set(),
+        description="Apply the scene color in the lighting pass and read FXAA luma straight from the lighting buffer")
+    shader_compile_budget: bpy.props.FloatProperty(name="Shader Compile Budget", default=16, min=0, soft_max=100, options=set(),
+        description="Milliseconds per viewport redraw spent compiling shaders, at least one is compiled per redraw")
+    use_texture_proxies: bpy.props.BoolProperty(name="Texture Proxies", default=False, options=set(),
+        description="Use downscaled copies of large textures in the viewport, final renders always use full resolution")
+    texture_proxy_size: bpy.props.IntProperty(name="Proxy Max Size", default=1024, min=64, soft_max=4096, options=set())
+    use_shadows: bpy.props.BoolProperty(name="Shadows", default=True, options=set(),
+        description="Shadow maps for lights with shadows enabled, only rendered again when the light or a caster near it changes")
+    shadow_resolution: bpy.props.IntProperty(name="Shadow Resolution", default=1024, min=128, max=4096, subtype='PIXEL', options=set(),
+        description="Size of a shadow map, point lights use six")
+    shadow_budget: bpy.props.IntProperty(name="Shadow Memory", default=64, min=1, soft_max=1024, subtype='UNSIGNED', options=set(),
+        description="Video memory for the shadow atlas in MB, the least recently drawn lights lose their shadow maps first")
+    use_lod: bpy.props.BoolProperty(name="Automatic LOD", default=False, options=set(),
+        description="Draw simplified meshes for objects that are small on screen")
+    lod_levels: bpy.props.IntProperty(name="LOD Levels", default=3, min=2, max=4, options=set())
+    lod_screen_size: bpy.props.FloatProperty(name="LOD Screen Size", default=256, min=1, soft_max=2048, subtype='PIXEL', options=set(),
+        description="Objects smaller than this on screen use the first LOD, each halving goes one level further")
+    use_static_batching: bpy.props.BoolProperty(name="Static Batching", default=False, options=set(),
+        description="Merge small meshes that don't deform and aren't instanced into a few batches per material, drawn in one call each. Pays off with thousands of small props")
+    static_batch_max_vertices: bpy.props.IntProperty(name="Static Batch Max Vertices", default=4096, min=1, options=set(),
+        description="Meshes with more face corners than this keep their own draw call")
+    texture_budget: bpy.props.IntProperty(name="Texture Budget (MB)", default=2048, min=64, options=set(),
+        description="Unused textures are evicted from the cache above this size")
+    use_depth_prepass: bpy.props.BoolProperty(name="Depth Pre-Pass", default=False, options=set(),
+        description="Draw the depth of all meshes first, so the base pass only shades visible surfaces. Pays off with a lot of overdraw")
+    use_light_tiles: bpy.props.BoolProperty(name="Light Tiles", default=True, options=set(),
+        description="Classify screen tiles by shading model, lighting skips tiles without lit pixels and uses a simpler program on tiles with a single shading model")
+    lighting_resolution: bpy.props.EnumProperty(name="Lighting Resolution", default="FULL", options=set(),
+        items=[
+            ("FULL", "Full", "Light every pixel"),
+            ("HALF", "Half", "Light at half resolution and upsample, edges are lit at full resolution"),
+            ("QUARTER", "Quarter", "Light at quarter resolution and upsample, edges are lit at full resolution"),
+        ],
+        description="Resolution of the deferred lighting, lower ones upsample it guided by the depth and normals")
+    use_render_passes: bpy.props.BoolProperty(name="Render Passes", default=False, options=set(),
+        description="Write the lit, base color, shadow color, normal, depth and shading model passes of final renders, for compositing",
+        update=lambda self, context: context.view_layer.update_render_passes())
+    use_memory_budget: bpy.props.BoolProperty(name="GPU Memory Budget", default=False, options=set(),
+        description="Free unused texture proxies, cached textures and the buffers of meshes that haven't been drawn in a while above the budget")
+    memory_budget: bpy.props.IntProperty(name="Budget (MB)", default=4096, min=64, options=set(),
+        description="Estimated video memory the engine may hold, textures and meshes in use are never freed")
+    use_profiler: bpy.props.BoolProperty(name="Profiler", default=False, options=set(), description="Record CPU/GPU timings of each render pass")
+    use_taa: bpy.props.BoolProperty(name="TAA", default=False, description="Temporal anti-aliasing, replaces FXAA in the viewport when enabled")
+    taa_feedback: bpy.props.FloatProperty(name="TAA Feedback", default=0.9, min=0, max=0.98, subtype='FACTOR', options=set())
 
     out_buffer: bpy.props.EnumProperty(
         items = [
@@ -884,6 +2267,8 @@ class CustomRenderEngineSettings(bpy.types.PropertyGroup):
             ("POSITION", "World Position", ""),
             ("DEPTH", "Depth", ""),
             ("SHADINGMODEL", "Shading Model", ""),
+            ("OVERDRAW", "Overdraw", "Fragments shaded per pixel by the base pass, blue (1) to red (4 and more)"),
+            ("LIGHTTILES", "Light Tiles", "Tiles skipped by lighting (black), single shading model (red Lambert, green Toon) and mixed (yellow)"),
         ],
         name="Out Buffer",
         options=set()
@@ -923,8 +2308,18 @@ class CustomRenderEnginePanel(bpy.types.Panel):
         layout.use_property_decorate = True
         layout.use_property_split = True
         settings = context.scene.custom_render_engine
+        layout.prop(settings, "render_backend")
+        if settings.render_backend == "CPU":
+            layout.prop(settings, "cpu_threads")
         layout.prop(settings, "backbuffer_scale")
         layout.prop(settings, "use_fxaa")
+        layout.prop(settings, "use_pass_fusion")
+        layout.prop(settings, "use_depth_prepass")
+        layout.prop(settings, "use_light_tiles")
+        layout.prop(settings, "lighting_resolution")
+        layout.prop(settings, "use_taa")
+        if settings.use_taa:
+            layout.prop(settings, "taa_feedback")
         layout.prop(settings, "out_buffer")
         layout.prop(settings, "enable_outline")
         layout.prop(settings, "outline_width")
@@ -938,6 +2333,43 @@ class CustomRenderEnginePanel(bpy.types.Panel):
         layout.prop(settings, "world_color_clear")
         layout.prop(settings, "shading_sharpness")
         layout.prop(settings, "fresnel_fac")
+        layout.prop(settings, "shader_compile_budget")
+        layout.prop(settings, "use_texture_proxies")
+        if settings.use_texture_proxies:
+            layout.prop(settings, "texture_proxy_size")
+        layout.prop(settings, "use_shadows")
+        if settings.use_shadows:
+            layout.prop(settings, "shadow_resolution")
+            layout.prop(settings, "shadow_budget")
+        layout.prop(settings, "use_lod")
+        if settings.use_lod:
+            layout.prop(settings, "lod_levels")
+            layout.prop(settings, "lod_screen_size")
+        layout.prop(settings, "use_static_batching")
+        if settings.use_static_batching:
+            layout.prop(settings, "static_batch_max_vertices")
+        layout.prop(settings, "texture_budget")
+        stats = TEXTURES.get_stats()
+        layout.label(text=f"Textures: {stats['textures']} ({stats['bytes'] / 2**20:.1f} MB), "
+            f"{stats.get('hits', 0)} hits, {stats.get('misses', 0)} misses")
+        layout.prop(settings, "use_memory_budget")
+        if settings.use_memory_budget:
+            layout.prop(settings, "memory_budget")
+        draw_memory_report(layout)
+        layout.prop(settings, "use_render_passes")
+        layout.prop(settings, "use_profiler")
+        if settings.use_profiler:
+            draw_profiler(layout)
+        layout.operator("render.custom_render_animation", icon='RENDER_ANIMATION')
+
+def draw_memory_report(layout):
+    report = GPU_MEMORY.get_report()
+    col = layout.column(align=True)
+    col.label(text=f"GPU Memory (estimated): {report['total'] / 2**20:.1f} MB")
+    for category, nbytes in report["categories"].items():
+        col.label(text=f"    {category.replace('_', ' ').capitalize()}: {nbytes / 2**20:.1f} MB")
+    if report["evicted_meshes"]:
+        col.label(text=f"    {report['evicted_meshes']} of {report['meshes']} meshes evicted")
 
 # expose light properties
 class CustomRenderEngineLightPanel(bpy.types.Panel):
@@ -1024,3 +2456,11 @@ def unregister():
         if 'CUSTOM' in panel.COMPAT_ENGINES:
             panel.COMPAT_ENGINES.remove('CUSTOM')
 
+    # the subsystems that were never used have nothing to shut down
+    lod = sys.modules.get(__package__ + ".lod")
+    if lod:
+        lod.LODS.shutdown()
+    material_preview = sys.modules.get(__package__ + ".material_preview")
+    if material_preview:
+        material_preview.PREVIEWS.clear()
+
@@ -0,0 +1,170 @@
+import collections
+import concurrent.futures
+import os
+import time
+
+import bpy
+import gpu
+
+from .custom_render_engine import SceneRenderer, get_render_size
+from .profiler import PROFILER
+
+class OfflineRenderer(SceneRenderer):
+    # SceneRenderer outside of a RenderEngine, there's no viewport to redraw or show stats in
+    def tag_redraw(self):
+        pass
+
+    def update_stats(self, stats, info):
+        pass
+
+STAGES = ("sync", "draw", "readback", "convert", "write")
+
+class AnimationPipeline:
+    # Renders a sequence of frames into two offscreen targets in turn. Frame N is only read
+    # back once frame N+1 has been synced and its draws submitted, so the GPU has work queued
+    # while the main thread waits on the readback, and converting and writing frame N runs on
+    # a worker thread while the main thread moves on to frame N+2.
+    #
+    # The gpu module has no asynchronous readback (pixel buffer objects), so that wait is
+    # still there, just overlapped with the next frame.
+    def __init__(self, renderer, width, height, file_format=None, max_pending=2):
+        self.renderer = renderer
+        self.width = width
+        self.height = height
+        self.file_format = file_format
+        self.targets = [gpu.types.GPUOffScreen(width, height, format="RGBA16F") for _ in range(2)]
+        self.index = 0
+        # (target, path, timings) of the frame waiting to be read back
+        self.drawn = None
+        # readbacks are kept in memory until written, this bounds how many
+        self.max_pending = max_pending
+        self.jobs = collections.deque()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="custom_render_output")
+        self.frames = []
+        self.start = time.perf_counter()
+
+    def render_frame(self, depsgraph, frame, path=None):
+        timings = {"frame": frame}
+        # a frame of its own in the profile, not the viewport's next
+        with PROFILER.track("animation"):
+            start = time.perf_counter()
+            context = self.renderer.sync_offscreen(depsgraph, self.width, self.height)
+            timings["sync"] = (time.perf_counter() - start) * 1000.0
+
+            start = time.perf_counter()
+            target = self.targets[self.index]
+            self.index = 1 - self.index
+            self.renderer.draw_offscreen(context, depsgraph.scene.custom_render_engine, target)
+            timings["draw"] = (time.perf_counter() - start) * 1000.0
+
+        self.read_back()
+        self.drawn = (target, path, timings)
+
+    def read_back(self):
+        if self.drawn is None:
+            return
+        target, path, timings = self.drawn
+        self.drawn = None
+
+        start = time.perf_counter()
+        pixels = target.texture_color.read()
+        timings["readback"] = (time.perf_counter() - start) * 1000.0
+
+        while len(self.jobs) >= self.max_pending:
+            self.jobs.popleft().result()
+        self.jobs.append(self.executor.submit(self.write, pixels, path, timings))
+
+    # worker thread
+    def write(self, pixels, path, timings):
+        from .image_io import to_rgba, write_image
+
+        start = time.perf_counter()
+        rgba = to_rgba(pixels, self.width, self.height)
+        timings["convert"] = (time.perf_counter() - start) * 1000.0
+
+        start = time.perf_counter()
+        if path and self.file_format:
+            write_image(path, rgba, self.file_format)
+        timings["write"] = (time.perf_counter() - start) * 1000.0
+
+        print(f"Frame {timings['frame']}: " + ", ".join(f"{stage} {timings[stage]:.1f}ms" for stage in STAGES), flush=True)
+        self.frames.append(timings)
+
+    # Waits for the last frames, returns the total of every stage and the wall time
+    def finish(self):
+        try:
+            self.read_back()
+            while self.jobs:
+                self.jobs.popleft().result()
+        finally:
+            self.executor.shutdown()
+            for target in self.targets:
+                target.free()
+            self.targets = []
+
+        stats = {stage: sum(timings[stage] for timings in self.frames) for stage in STAGES}
+        stats["frames"] = len(self.frames)
+        stats["wall_ms"] = (time.perf_counter() - self.start) * 1000.0
+        # time the stages spent running at the same time
+        stats["overlap_ms"] = max(0.0, sum(stats[stage] for stage in STAGES) - stats["wall_ms"])
+        print(f"Rendered {stats['frames']} frames in {stats['wall_ms']:.0f}ms, "
+            + ", ".join(f"{stage} {stats[stage]:.0f}ms" for stage in STAGES)
+            + f", {stats['overlap_ms']:.0f}ms overlapped", flush=True)
+        return stats
+
+def get_frame_path(scene, frame, file_format):
+    from .image_io import get_extension
+
+    if not file_format:
+        return None
+    path = bpy.path.abspath(scene.render.frame_path(frame=frame))
+    if scene.render.use_file_extension:
+        # the extension comes from the scene's output format, not the one written here
+        path = os.path.splitext(path)[0]
+    return path + get_extension(file_format)
+
+class RENDER_OT_custom_render_animation(bpy.types.Operator):
+    bl_idname = "render.custom_render_animation"
+    bl_label = "Render Animation (Pipelined)"
+    bl_description = "Render the frame range with the Custom engine, reading back and writing frames while the next ones draw"
+
+    file_format: bpy.props.EnumProperty(
+        items=[
+            ("PNG", "PNG", "8 bit RGBA"),
+            ("OPEN_EXR", "OpenEXR", "Half float RGBA, uncompressed"),
+            ("NONE", "None", "Render without writing files, for timing"),
+        ],
+        name="File Format",
+        default="PNG",
+    )
+
+    @classmethod
+    def poll(cls, context):
+        return context.engine == "CUSTOM" and context.scene.camera is not None
+
+    def execute(self, context):
+        scene = context.scene
+        width, height = get_render_size(scene)
+        file_format = self.file_format if self.file_format != "NONE" else None
+        frame_current = scene.frame_current
+
+        renderer = OfflineRenderer()
+        pipeline = AnimationPipeline(renderer, width, height, file_format)
+        try:
+            for frame in range(scene.frame_start, scene.frame_end + 1, scene.frame_step):
+                scene.frame_set(frame)
+                depsgraph = context.evaluated_depsgraph_get()
+                pipeline.render_frame(depsgraph, frame, get_frame_path(scene, frame, file_format))
+        finally:
+            stats = pipeline.finish()
+            renderer.free()
+            scene.frame_set(frame_current)
+
+        self.report({'INFO'}, f"Rendered {stats['frames']} frames in {stats['wall_ms'] / 1000.0:.1f}s")
+        return {'FINISHED'}
+
+def register():
+    bpy.utils.register_class(RENDER_OT_custom_render_animation)
+
+def unregister():
+    bpy.utils.unregister_class(RENDER_OT_custom_render_animation)
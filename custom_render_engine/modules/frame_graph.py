@@ -0,0 +1,209 @@
+import collections
+
+# A small frame graph: passes declare the textures they read and write, compile() culls
+# the passes nothing depends on and maps the remaining transient textures onto as few
+# physical targets as their lifetimes allow. Compiling only looks at names, sizes and
+# formats, it never touches the GPU.
+
+class TextureDesc:
+    __slots__ = ("name", "size", "format", "imported")
+
+    def __init__(self, name, size, format, imported=False):
+        self.name = name
+        self.size = tuple(size) if size is not None else None
+        self.format = format
+        self.imported = imported
+
+    def get_key(self):
+        return self.size, self.format
+
+class RenderPass:
+    __slots__ = ("name", "reads", "writes", "execute", "side_effect")
+
+    def __init__(self, name, reads, writes, execute, side_effect):
+        self.name = name
+        self.reads = tuple(reads)
+        self.writes = tuple(writes)
+        self.execute = execute
+        self.side_effect = side_effect
+
+class CompiledGraph:
+    def __init__(self, passes, culled, slots, aliases):
+        # live passes in submission order
+        self.passes = passes
+        self.culled = culled
+        # physical targets as (size, format), aliases maps transient texture name -> slot index
+        self.slots = slots
+        self.aliases = aliases
+
+    def get_stats(self):
+        return {
+            "passes": len(self.passes),
+            "culled_passes": len(self.culled),
+            "transient_textures": len(self.aliases),
+            "render_targets": len(self.slots),
+        }
+
+class FrameGraph:
+    def __init__(self):
+        self.textures = {}
+        self.imported = {}
+        self.passes = []
+
+    # transient textures only live for the frame and may share memory with each other
+    def create_texture(self, name, size, format):
+        if name in self.textures:
+            raise ValueError(f"Texture {name} is already declared")
+        self.textures[name] = TextureDesc(name, size, format)
+        return name
+
+    # textures owned by someone else (the viewport, TAA history), never aliased.
+    # texture can be None for outputs the producing pass only knows when it runs.
+    def import_texture(self, name, texture=None):
+        if name in self.textures:
+            raise ValueError(f"Texture {name} is already declared")
+        self.textures[name] = TextureDesc(name, None, None, imported=True)
+        self.imported[name] = texture
+        return name
+
+    # side_effect passes (eg. drawing to the viewport) are always kept, everything else
+    # only if something kept reads one of its outputs
+    def add_pass(self, name, reads=(), writes=(), execute=None, side_effect=False):
+        for texture in tuple(reads) + tuple(writes):
+            if texture not in self.textures:
+                raise ValueError(f"Pass {name} uses undeclared texture {texture}")
+        render_pass = RenderPass(name, reads, writes, execute, side_effect)
+        self.passes.append(render_pass)
+        return render_pass
+
+    def cull(self):
+        needed = set()
+        live = [False] * len(self.passes)
+        for i in range(len(self.passes) - 1, -1, -1):
+            render_pass = self.passes[i]
+            if render_pass.side_effect or needed.intersection(render_pass.writes):
+                live[i] = True
+                needed.update(render_pass.reads)
+        return live
+
+    def compile(self):
+        live = self.cull()
+        passes = [p for p, keep in zip(self.passes, live) if keep]
+        culled = [p for p, keep in zip(self.passes, live) if not keep]
+
+        # lifetime of every transient texture as (first pass, last pass) over the live passes
+        first_use = {}
+        last_use = {}
+        for i, render_pass in enumerate(passes):
+            for name in render_pass.writes + render_pass.reads:
+                if self.textures[name].imported:
+                    continue
+                first_use.setdefault(name, i)
+                last_use[name] = i
+
+        starting = collections.defaultdict(list)
+        ending = collections.defaultdict(list)
+        for name, i in first_use.items():
+            starting[i].append(name)
+            ending[last_use[name]].append(name)
+
+        # Greedy interval allocation in pass order. Textures starting at a pass are given
+        # targets before the ones ending there are freed, so a pass never reads and writes
+        # the same memory.
+        slots = []
+        free = collections.defaultdict(list)
+        aliases = {}
+        for i in range(len(passes)):
+            for name in starting[i]:
+                key = self.textures[name].get_key()
+                if free[key]:
+                    slot = free[key].pop()
+                else:
+                    slot = len(slots)
+                    slots.append(key)
+                aliases[name] = slot
+            for name in ending[i]:
+                free[self.textures[name].get_key()].append(aliases[name])
+
+        return CompiledGraph(passes, culled, slots, aliases)
+
+    # Runs the live passes with targets from pool, execute callbacks get a dict of
+    # texture name -> GPUTexture and may fill in imported textures they produce
+    def execute(self, pool):
+        compiled = self.compile()
+        targets = [pool.acquire(size, format) for size, format in compiled.slots]
+        resources = dict(self.imported)
+        for name, slot in compiled.aliases.items():
+            resources[name] = targets[slot]
+        try:
+            for render_pass in compiled.passes:
+                if render_pass.execute:
+                    render_pass.execute(resources)
+        finally:
+            for (size, format), texture in zip(compiled.slots, targets):
+                pool.release(size, format, texture)
+            pool.end_frame()
+        return compiled
+
+class TexturePool:
+    # Render targets kept across frames by (size, format). Targets unused for max_age frames
+    # (eg. after a viewport resize) are dropped.
+    def __init__(self, allocate=None, max_age=3):
+        self.allocate = allocate
+        self.max_age = max_age
+        self.free = collections.defaultdict(list)
+        self.frame = 0
+        self.allocations = 0
+        # framebuffers over kept targets by the ids of their attachments, with the attachments
+        self.framebuffers = {}
+
+    def acquire(self, size, format):
+        entries = self.free[(size, format)]
+        if entries:
+            return entries.pop()[1]
+        self.allocations += 1
+        if self.allocate:
+            return self.allocate(size, format)
+        import gpu
+        return gpu.types.GPUTexture(size, format=format)
+
+    def release(self, size, format, texture):
+        self.free[(size, format)].append((self.frame, texture))
+
+    # A framebuffer over targets of this pool, made once and dropped with its targets
+    def get_framebuffer(self, depth_slot=None, color_slots=()):
+        attachments = ((depth_slot,) if depth_slot is not None else ()) + tuple(color_slots)
+        key = (depth_slot is not None,) + tuple(id(texture) for texture in attachments)
+        entry = self.framebuffers.get(key)
+        if entry is None:
+            import gpu
+            framebuffer = gpu.types.GPUFrameBuffer(depth_slot=depth_slot, color_slots=tuple(color_slots) or None)
+            entry = self.framebuffers[key] = (framebuffer, attachments)
+        return entry[0]
+
+    def end_frame(self):
+        self.frame += 1
+        self.evict(self.max_age)
+
+    # drops the targets unused for more than max_age frames
+    def evict(self, max_age):
+        for key in list(self.free.keys()):
+            entries = [entry for entry in self.free[key] if self.frame - entry[0] <= max_age]
+            if entries:
+                self.free[key] = entries
+            else:
+                del self.free[key]
+        kept = {id(texture) for entries in self.free.values() for _, texture in entries}
+        self.framebuffers = {key: entry for key, entry in self.framebuffers.items()
+            if all(id(texture) in kept for texture in entry[1])}
+
+    def get_texture_count(self):
+        return sum(len(entries) for entries in self.free.values())
+
+    # (size, format) of every kept target
+    def get_targets(self):
+        return [key for key, entries in self.free.items() for _ in entries]
+
+    def clear(self):
+        self.free.clear()
+        self.framebuffers.clear()
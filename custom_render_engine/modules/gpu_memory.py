@@ -0,0 +1,149 @@
+import collections
+import weakref
+
+from .scene_cache import SCENE
+from .shader_cache import SHADERS
+from .texture_cache import TEXTURES
+
+# Video memory held by the engine, estimated from the sizes and formats of what it allocated:
+# the gpu module can't query real allocations, and drivers add their own padding and
+# alignment on top. Good enough to see where the memory goes and to stay under a budget.
+
+FORMAT_BYTES = {
+    "RGBA8": 4, "RGBA16": 8, "RGBA16F": 8, "RGBA32F": 16, "R8UI": 1, "R16F": 2, "R32F": 4,
+    "RG16F": 4, "R32UI": 4, "DEPTH_COMPONENT24": 4, "DEPTH_COMPONENT32F": 4, "DEPTH24_STENCIL8": 4,
+}
+
+# drivers don't report program sizes, this is about what a compiled variant takes
+PROGRAM_BYTES = 64 * 1024
+
+CATEGORIES = ("meshes", "textures", "texture_proxies", "programs", "render_targets", "shadows", "lights", "previews")
+
+# what goes first when over budget, everything in use by the current frame stays
+EVICTION_ORDER = ("proxies", "caches", "batches")
+
+# meshes not drawn for this many frames can lose their buffers
+COLD_FRAMES = 30
+
+def get_texture_bytes(size, format):
+    return size[0] * size[1] * FORMAT_BYTES.get(format, 4)
+
+def get_pool_bytes(pool):
+    return sum(get_texture_bytes(size, format) for size, format in pool.get_targets())
+
+class GPUMemory:
+    # Per category totals over every engine instance and the shared caches, and a budget
+    # enforced once per drawn frame. Engines register themselves, they're only held weakly.
+    def __init__(self):
+        self.renderers = weakref.WeakSet()
+        self.frame = 0
+        self.budget = None
+        self.stats = collections.Counter()
+
+    def add_renderer(self, renderer):
+        self.renderers.add(renderer)
+
+    def remove_renderer(self, renderer):
+        self.renderers.discard(renderer)
+
+    def get_mesh_draws(self):
+        return [entry.value for key, entry in SCENE.entries.items() if key[0] == "mesh"]
+
+    def get_bytes(self):
+        from .material_preview import PREVIEWS
+
+        out = dict.fromkeys(CATEGORIES, 0)
+        out["meshes"] = sum(draw.get_bytes() for draw in self.get_mesh_draws())
+        out["textures"] = TEXTURES.get_bytes(proxies=False)
+        out["texture_proxies"] = TEXTURES.get_bytes(proxies=True)
+        out["programs"] = len(SHADERS.programs) * PROGRAM_BYTES
+
+        # the preview engines draw with the pool of PREVIEWS
+        pools = {id(PREVIEWS.render_targets)}
+        for renderer in list(self.renderers):
+            if id(renderer.render_targets) not in pools:
+                pools.add(id(renderer.render_targets))
+                out["render_targets"] += get_pool_bytes(renderer.render_targets)
+            out["render_targets"] += renderer.temporal_aa.get_bytes()
+            out["shadows"] += renderer.shadows.get_bytes()
+            out["meshes"] += renderer.static_batches.get_bytes()
+            out["lights"] += renderer.light_buffer.get_bytes() + renderer.light_tiles.get_bytes()
+
+        out["previews"] = get_pool_bytes(PREVIEWS.render_targets)
+        if PREVIEWS.offscreen is not None:
+            # color and depth
+            out["previews"] += PREVIEWS.offscreen.width * PREVIEWS.offscreen.height * (8 + 4)
+        return out
+
+    # For the panel and monitoring scripts, sizes in bytes
+    def get_report(self):
+        categories = self.get_bytes()
+        return {
+            "categories": categories,
+            "total": sum(categories.values()),
+            "budget": self.budget,
+            "meshes": len(self.get_mesh_draws()),
+            "evicted_meshes": sum(1 for draw in self.get_mesh_draws() if not draw.resident),
+            "stats": dict(self.stats),
+        }
+
+    # Called at the end of every drawn frame
+    def end_frame(self, settings):
+        self.frame += 1
+        self.budget = settings.memory_budget * 2**20 if settings.use_memory_budget else None
+        if self.budget is None:
+            return
+        total = sum(self.get_bytes().values())
+        if total > self.budget:
+            self.stats["over_budget_frames"] += 1
+            self.evict(total - self.budget)
+
+    # Frees at least nbytes if it can, returns how much was freed
+    def evict(self, nbytes):
+        freed = 0
+        for tier in EVICTION_ORDER:
+            if freed >= nbytes:
+                break
+            amount = getattr(self, "evict_" + tier)(nbytes - freed)
+            self.stats["evicted_" + tier] += amount
+            freed += amount
+        return freed
+
+    # downscaled textures nothing is using
+    def evict_proxies(self, nbytes):
+        return TEXTURES.evict_unused(nbytes, proxies=True)
+
+    # full resolution textures nothing is using, the preview targets and render targets
+    # left over from other sizes
+    def evict_caches(self, nbytes):
+        from .material_preview import PREVIEWS
+
+        freed = TEXTURES.evict_unused(nbytes, proxies=False)
+        if freed < nbytes:
+            freed += PREVIEWS.release_targets()
+        for renderer in list(self.renderers):
+            if freed >= nbytes:
+                break
+            before = get_pool_bytes(renderer.render_targets)
+            renderer.render_targets.evict(max_age=1)
+            freed += before - get_pool_bytes(renderer.render_targets)
+        return freed
+
+    # buffers of meshes that haven't been drawn in a while, least recently drawn first
+    def evict_batches(self, nbytes):
+        freed = 0
+        draws = [draw for draw in self.get_mesh_draws()
+            if draw.resident and self.frame - draw.last_used > COLD_FRAMES]
+        draws.sort(key=lambda draw: draw.last_used)
+        for draw in draws:
+            if freed >= nbytes:
+                break
+            freed += draw.get_bytes()
+            draw.evict()
+            self.stats["mesh_evictions"] += 1
+        return freed
+
+    def touch(self, draw):
+        draw.last_used = self.frame
+
+GPU_MEMORY = GPUMemory()
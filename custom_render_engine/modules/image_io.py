@@ -0,0 +1,100 @@
+import os
+import struct
+import zlib
+
+import numpy as np
+
+# Pixel conversion and image encoders for final frames. They only take numpy arrays, not
+# bpy.types.Image, so the animation pipeline can run them on its worker thread.
+#
+# Frames are written as drawn: the engine doesn't apply a view transform, so PNGs look like
+# the viewport and EXRs hold the same values in half float.
+
+def to_rgba(pixels, width, height):
+    # GPU readbacks start at the bottom row, like render results
+    return np.asarray(pixels, dtype=np.float32).reshape(height, width, 4)
+
+# Render pass pixels from a texture readback. The G-buffer follows the backbuffer scale, so
+# it's resampled (nearest) to the render size. Integer formats come out as float.
+def to_pass_pixels(data, width, height, out_width, out_height, channels):
+    pixels = np.asarray(data).reshape(height, width, -1)
+    if (width, height) != (out_width, out_height):
+        rows = ((np.arange(out_height) + 0.5) * height / out_height).astype(np.intp)
+        columns = ((np.arange(out_width) + 0.5) * width / out_width).astype(np.intp)
+        pixels = pixels[rows[:, None], columns]
+    return pixels[..., :channels].astype(np.float32)
+
+# Depth buffer values to distance from the camera plane, what Blender's Z pass holds.
+# The background gets 1e10, like in Cycles and Eevee.
+def linear_depth(depth, window_matrix):
+    inverse = np.linalg.inv(np.array(window_matrix, dtype=np.float64))
+    ndc = depth.astype(np.float64) * 2 - 1
+    z = (inverse[2, 2] * ndc + inverse[2, 3]) / (inverse[3, 2] * ndc + inverse[3, 3])
+    return np.where(depth >= 1, 1e10, -z).astype(np.float32)
+
+def _png_chunk(kind, data):
+    chunk = kind + data
+    return struct.pack(">I", len(data)) + chunk + struct.pack(">I", zlib.crc32(chunk))
+
+# 8 bit RGBA
+def encode_png(rgba, compression=6):
+    height, width = rgba.shape[:2]
+    # every row starts with its filter type, 0 is none
+    rows = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+    rows[:, 1:] = (np.clip(rgba[::-1], 0, 1) * 255 + 0.5).astype(np.uint8).reshape(height, width * 4)
+    header = struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)
+    return b"".join((
+        b"\x89PNG\r\n\x1a\n",
+        _png_chunk(b"IHDR", header),
+        _png_chunk(b"IDAT", zlib.compress(rows.tobytes(), compression)),
+        _png_chunk(b"IEND", b""),
+    ))
+
+def _exr_attribute(name, kind, data):
+    return name + b"\0" + kind + b"\0" + struct.pack("<i", len(data)) + data
+
+EXR_HALF = 1
+
+# Half float RGBA, uncompressed scanlines
+def encode_exr(rgba):
+    height, width = rgba.shape[:2]
+    window = struct.pack("<iiii", 0, 0, width - 1, height - 1)
+    # channels are stored in alphabetical order
+    channels = b"".join(name + b"\0" + struct.pack("<iB3xii", EXR_HALF, 0, 1, 1) for name in (b"A", b"B", b"G", b"R"))
+    header = b"".join((
+        struct.pack("<ii", 20000630, 2),
+        _exr_attribute(b"channels", b"chlist", channels + b"\0"),
+        _exr_attribute(b"compression", b"compression", b"\0"),
+        _exr_attribute(b"dataWindow", b"box2i", window),
+        _exr_attribute(b"displayWindow", b"box2i", window),
+        _exr_attribute(b"lineOrder", b"lineOrder", b"\0"),
+        _exr_attribute(b"pixelAspectRatio", b"float", struct.pack("<f", 1)),
+        _exr_attribute(b"screenWindowCenter", b"v2f", struct.pack("<ff", 0, 0)),
+        _exr_attribute(b"screenWindowWidth", b"float", struct.pack("<f", 1)),
+        b"\0",
+    ))
+
+    # one block per scanline, top to bottom: y, data size, then a row of each channel
+    lines = np.empty(height, dtype=np.dtype([("y", "<i4"), ("size", "<i4"), ("data", "<f2", (4, width))]))
+    lines["y"] = np.arange(height)
+    lines["size"] = width * 4 * 2
+    lines["data"] = rgba[::-1, :, ::-1].transpose(0, 2, 1)
+    offsets = len(header) + height * 8 + np.arange(height, dtype="<u8") * lines.dtype.itemsize
+    return header + offsets.astype("<u8").tobytes() + lines.tobytes()
+
+ENCODERS = {
+    "PNG": (encode_png, ".png"),
+    "OPEN_EXR": (encode_exr, ".exr"),
+}
+
+def get_extension(file_format):
+    return ENCODERS[file_format][1]
+
+def write_image(path, rgba, file_format):
+    encode, _ = ENCODERS[file_format]
+    data = encode(rgba)
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
@@ -0,0 +1,99 @@
+import gpu
+import numpy as np
+
+# Must match the LightBlock uniform block in DeferredLightPixelShader.glsl. A block is
+# 64 * 4 vec4s + 96 mat4s + 96 vec4s + 1 vec4 (11.5KB), within the 16KB every GL
+# implementation has to support.
+MAX_LIGHTS = 64
+MAX_SHADOW_TILES = 96
+
+LIGHT_TYPES = {"SUN": 0, "POINT": 1, "SPOT": 2}
+
+BLOCK_DTYPE = np.dtype([
+    ("light_count", np.float32, (4,)),
+    ("light_position", np.float32, (MAX_LIGHTS, 4)),
+    ("light_color", np.float32, (MAX_LIGHTS, 4)),
+    ("light_spot", np.float32, (MAX_LIGHTS, 4)),
+    ("light_shadow", np.float32, (MAX_LIGHTS, 4)),
+    # column major, like GLSL
+    ("shadow_matrix", np.float32, (MAX_SHADOW_TILES, 4, 4)),
+    ("shadow_rect", np.float32, (MAX_SHADOW_TILES, 4)),
+])
+
+def get_block_defines():
+    return f"\n#define MAX_LIGHTS {MAX_LIGHTS}\n#define MAX_SHADOW_TILES {MAX_SHADOW_TILES}\n"
+
+# The parameters of lights in blocks of BLOCK_DTYPE, a new block starts when one runs
+# out of lights or shadow tiles. shadow_maps is light name -> ShadowMap.
+def pack_lights(lights, shadow_maps):
+    blocks = [np.zeros(1, dtype=BLOCK_DTYPE)[0]]
+    count = 0
+    tiles = 0
+    for light in lights:
+        shadow_map = shadow_maps.get(light.object.name) if light.use_shadow else None
+        tile_count = len(shadow_map.tiles) if shadow_map else 0
+        if count == MAX_LIGHTS or tiles + tile_count > MAX_SHADOW_TILES:
+            blocks[-1]["light_count"][0] = count
+            blocks.append(np.zeros(1, dtype=BLOCK_DTYPE)[0])
+            count = 0
+            tiles = 0
+        block = blocks[-1]
+        light.pack(block, count)
+        if tile_count:
+            block["light_shadow"][count] = (tiles, tile_count, 0, 0)
+            for view_projection, rect in zip(shadow_map.view_projections, shadow_map.rects):
+                block["shadow_matrix"][tiles] = np.array(view_projection, dtype=np.float32).T
+                block["shadow_rect"][tiles] = rect
+                tiles += 1
+        count += 1
+    blocks[-1]["light_count"][0] = count
+    return blocks
+
+class LightBuffer:
+    # Parameters of every light packed into std140 uniform blocks, MAX_LIGHTS per block and
+    # each block drawn by one fullscreen pass. Blocks are only packed and uploaded again when
+    # the lights, their settings or their shadow maps change, there's always at least one
+    # (possibly empty) block.
+    def __init__(self):
+        self.lights = None
+        self.signature = None
+        self.shadow_version = None
+        self.blocks = []
+        self.ubos = []
+        self.uploaded = 0
+
+    # Editing a light's energy or color doesn't create the lights again, their signatures
+    # (what pack reads from the light datablock) catch that
+    def update(self, lights, shadow_maps, shadow_version):
+        signature = [light.get_signature() for light in lights]
+        if lights is self.lights and signature == self.signature and shadow_version == self.shadow_version:
+            return False
+        self.lights = lights
+        self.signature = signature
+        self.shadow_version = shadow_version
+        self.blocks = pack_lights(lights, shadow_maps)
+        self.upload()
+        return True
+
+    def upload(self):
+        for i, block in enumerate(self.blocks):
+            data = block.tobytes()
+            if i < len(self.ubos):
+                self.ubos[i].update(data)
+            else:
+                self.ubos.append(gpu.types.GPUUniformBuf(data))
+            self.uploaded += 1
+        del self.ubos[len(self.blocks):]
+
+    def get_bytes(self):
+        return len(self.ubos) * BLOCK_DTYPE.itemsize
+
+    def get_light_count(self):
+        return sum(int(block["light_count"][0]) for block in self.blocks)
+
+    def clear(self):
+        self.lights = None
+        self.signature = None
+        self.shadow_version = None
+        self.blocks = []
+        self.ubos = []
@@ -0,0 +1,139 @@
+import gpu
+
+from .material import CustomRenderEngineMaterialSettings
+from .profiler import PROFILER
+
+# The lighting passes only need to run where there are lit pixels. A classification pass
+# reduces the G-buffer to one mask per TILE_SIZE pixel tile, a bit for every shading model
+# found in the tile. Light passes then draw a grid of tile quads with one program per tile
+# class, the vertex shader collapses the quads of tiles from other classes. Tiles without
+# lit pixels are skipped (or only get the scene color), tiles with a single shading model
+# get a program where it's a constant.
+# The base pass clears the shading model target to UNLIT (0), so background pixels set the
+# UNLIT bit like unlit geometry does: neither gets lit, and both get the scene color.
+
+TILE_SIZE = 16
+
+# tile classes besides the shading models, outside of the shading model values
+TILE_CLASS_NONE = 254
+TILE_CLASS_MIXED = 255
+
+VERTEX_TILES = """
+    in vec2 pos;
+    in ivec2 tile;
+    out vec2 uv;
+
+    uniform usampler2D ttiles;
+    // tile units to uv
+    uniform vec2 tile_scale;
+
+    void main()
+    {
+        uint mask = texelFetch(ttiles, tile, 0).r;
+        uint lit = mask & uint(LIT_SHADINGMODELS);
+    #if TILE_CLASS == TILE_CLASS_NONE
+        bool visible = lit == 0u;
+    #elif TILE_CLASS == TILE_CLASS_MIXED
+        // lit pixels, but also unlit ones or more than one shading model
+        bool visible = lit != 0u && (mask != lit || (lit & (lit - 1u)) != 0u);
+    #else
+        // only this shading model, no unlit or background pixels
+        bool visible = mask == (1u << uint(TILE_CLASS));
+    #endif
+        uv = min(pos * tile_scale, vec2(1));
+        // outside the clip volume, the triangles of other classes are dropped before rasterization
+        gl_Position = visible ? vec4(uv * 2 - 1, 0, 1) : vec4(-2, -2, -2, 1);
+    }
+"""
+
+PIXEL_CLASSIFY = """
+    uniform usampler2D tshadingmodel;
+
+    out uint mask;
+
+    void main()
+    {
+        ivec2 size = textureSize(tshadingmodel, 0);
+        ivec2 start = ivec2(gl_FragCoord.xy) * TILE_SIZE;
+        ivec2 end = min(start + TILE_SIZE, size);
+        uint bits = 0u;
+        for (int y = start.y; y < end.y; y++)
+        {
+            for (int x = start.x; x < end.x; x++)
+            {
+                bits |= 1u << texelFetch(tshadingmodel, ivec2(x, y), 0).r;
+            }
+        }
+        mask = bits;
+    }
+"""
+
+def get_tile_count(size):
+    return (size[0] + TILE_SIZE - 1) // TILE_SIZE, (size[1] + TILE_SIZE - 1) // TILE_SIZE
+
+def get_lit_shadingmodels():
+    return [value for id, _, _, value in CustomRenderEngineMaterialSettings.EShadingModels if id != "UNLIT"]
+
+# Classes drawn by a light pass. Tiles without lit pixels only need drawing when the pass
+# also applies the scene color.
+def get_tile_classes(include_none):
+    classes = get_lit_shadingmodels() + [TILE_CLASS_MIXED]
+    if include_none:
+        classes.insert(0, TILE_CLASS_NONE)
+    return classes
+
+def get_tile_defines(tile_class=None):
+    lit = 0
+    for value in get_lit_shadingmodels():
+        lit |= 1 << value
+    defines = (f"\n#define TILE_SIZE {TILE_SIZE}\n#define LIT_SHADINGMODELS {lit}\n"
+        f"#define TILE_CLASS_NONE {TILE_CLASS_NONE}\n#define TILE_CLASS_MIXED {TILE_CLASS_MIXED}\n")
+    if tile_class is not None:
+        defines += f"#define TILE_CLASS {tile_class}\n"
+    return defines
+
+def compile_classify_shader():
+    vertex = """
+        in vec2 pos;
+
+        void main()
+        {
+            gl_Position = vec4(pos * 2 - 1, 0, 1);
+        }
+    """
+    with PROFILER.span("compile:classify_tiles"):
+        return gpu.types.GPUShader(vertex, PIXEL_CLASSIFY, defines=get_tile_defines())
+
+class LightTiles:
+    # The tile grid of the current render target size, two triangles per tile with the
+    # tile's coordinates on every vertex
+    def __init__(self):
+        self.tile_count = None
+        self.batch = None
+
+    def get_grid(self, tile_count):
+        if self.tile_count != tile_count:
+            import numpy as np
+
+            tx, ty = tile_count
+            tiles = np.stack(np.meshgrid(np.arange(tx), np.arange(ty), indexing="xy"), axis=-1).reshape(-1, 1, 2)
+            corners = np.array(((0, 0), (1, 0), (1, 1), (0, 0), (1, 1), (0, 1)), dtype=np.int32)
+            tile = np.broadcast_to(tiles, (len(tiles), 6, 2)).reshape(-1, 2).astype(np.int32)
+            pos = (tiles + corners).reshape(-1, 2).astype(np.float32)
+
+            fmt = gpu.types.GPUVertFormat()
+            fmt.attr_add(id="pos", comp_type='F32', len=2, fetch_mode="FLOAT")
+            fmt.attr_add(id="tile", comp_type='I32', len=2, fetch_mode="INT")
+            vbo = gpu.types.GPUVertBuf(len=len(pos), format=fmt)
+            vbo.attr_fill(id="pos", data=pos)
+            vbo.attr_fill(id="tile", data=tile)
+            self.batch = gpu.types.GPUBatch(type="TRIS", buf=vbo)
+            self.tile_count = tile_count
+        return self.batch
+
+    # pos and tile, 16 bytes per vertex
+    def get_bytes(self):
+        return self.tile_count[0] * self.tile_count[1] * 6 * 16 if self.tile_count else 0
+
+    def get_tile_scale(self, size):
+        return TILE_SIZE / size[0], TILE_SIZE / size[1]
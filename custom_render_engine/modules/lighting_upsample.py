@@ -0,0 +1,89 @@
+from .material import CustomRenderEngineMaterialSettings
+
+# Deferred lighting at a fraction of the resolution. A first pass lights one pixel out of
+# every LIGHTING_SCALE x LIGHTING_SCALE block into a small target, the lighting pass then
+# upsamples it with bilinear weights that drop samples from other surfaces (depth and
+# normal differences, another shading model). Pixels that can't be upsampled, or where the
+# samples are too far apart in brightness (toon terminators, shadow edges), are lit again
+# at full resolution, so only smooth areas get the cheap lighting.
+
+LIGHTING_SCALES = {"FULL": 1, "HALF": 2, "QUARTER": 4}
+
+# relative difference of the view depths where a sample stops counting
+DEPTH_TOLERANCE = 0.05
+# exponent of the cosine between the normals
+NORMAL_POWER = 8
+# samples under this weight are another surface, the pixel is refined
+MIN_WEIGHT = 0.5
+# luma contrast between the samples that counts as an edge, relative to the brightest
+EDGE_CONTRAST = 0.25
+# and absolute, so dark areas don't all count as edges
+EDGE_BIAS = 0.01
+
+LUMA = (0.3, 0.59, 0.11)
+
+def get_low_size(size, scale):
+    return (size[0] + scale - 1) // scale, (size[1] + scale - 1) // scale
+
+def get_upsample_defines(scale, upsample):
+    defines = f"\n#define LIGHTING_SCALE {scale}\n"
+    if upsample:
+        defines += (f"#define UPSAMPLE_LIGHTING 1\n#define UPSAMPLE_DEPTH_TOLERANCE {DEPTH_TOLERANCE}\n"
+            f"#define UPSAMPLE_NORMAL_POWER {NORMAL_POWER}\n#define UPSAMPLE_MIN_WEIGHT {MIN_WEIGHT}\n"
+            f"#define UPSAMPLE_EDGE_CONTRAST {EDGE_CONTRAST}\n#define UPSAMPLE_EDGE_BIAS {EDGE_BIAS}\n")
+    return defines
+
+# The depth_linearize uniform, what turns depth buffer values back into view depth
+def get_depth_linearize(window_matrix, is_perspective):
+    return window_matrix[2][2], window_matrix[2][3], 1.0 if is_perspective else 0.0
+
+# CPU version of UpsampleLighting in DeferredLightPixelShader.glsl, to check the shader
+# against and to tune the constants on read back buffers. Arrays are (height, width, ...):
+# lighting_low the low resolution lighting (rgb), linear_depth the view depth, normal the
+# world normals and shadingmodel the shading model of every full resolution pixel.
+# Returns the upsampled lighting and which pixels it resolved, the others are the ones the
+# shader lights again at full resolution (unlit pixels count as resolved, they get none).
+def upsample_reference(lighting_low, linear_depth, normal, shadingmodel, scale):
+    import numpy as np
+
+    height, width = linear_depth.shape
+    low_height, low_width = lighting_low.shape[:2]
+    unlit = CustomRenderEngineMaterialSettings.get_shadingmodel_value("UNLIT")
+    lighting_low = lighting_low[..., :3].astype(np.float64)
+    low_luma = lighting_low @ np.array(LUMA)
+    normal = normal[..., :3].astype(np.float64)
+    depth = linear_depth.astype(np.float64)
+
+    y, x = np.mgrid[0:height, 0:width]
+    base_x, base_y = x // scale, y // scale
+    fx, fy = (x - base_x * scale) / scale, (y - base_y * scale) / scale
+
+    total = np.zeros((height, width, 3))
+    weight_sum = np.zeros((height, width))
+    luma_min = np.full((height, width), np.inf)
+    luma_max = np.zeros((height, width))
+    resolved = np.ones((height, width), dtype=bool)
+    for ox, oy in ((0, 0), (1, 0), (0, 1), (1, 1)):
+        bilinear = (fx if ox else 1 - fx) * (fy if oy else 1 - fy)
+        used = bilinear > 0
+        low_x = np.minimum(base_x + ox, low_width - 1)
+        low_y = np.minimum(base_y + oy, low_height - 1)
+        source_x = np.minimum(low_x * scale, width - 1)
+        source_y = np.minimum(low_y * scale, height - 1)
+        sample_depth = depth[source_y, source_x]
+        cosine = np.maximum(np.sum(normal[source_y, source_x] * normal, axis=-1), 0)
+        weight = np.maximum(0, 1 - np.abs(sample_depth - depth) / (DEPTH_TOLERANCE * depth)) * cosine**NORMAL_POWER
+        same = shadingmodel[source_y, source_x] == shadingmodel
+        resolved &= ~used | (same & (weight >= MIN_WEIGHT))
+        luma = low_luma[low_y, low_x]
+        luma_min = np.where(used, np.minimum(luma_min, luma), luma_min)
+        luma_max = np.where(used, np.maximum(luma_max, luma), luma_max)
+        w = np.where(used, bilinear * weight, 0)
+        total += lighting_low[low_y, low_x] * w[..., None]
+        weight_sum += w
+    resolved &= luma_max - luma_min <= EDGE_CONTRAST * luma_max + EDGE_BIAS
+    lighting = np.where(resolved[..., None], total / np.maximum(weight_sum, 1e-10)[..., None], 0)
+    is_unlit = shadingmodel == unlit
+    lighting[is_unlit] = 0
+    resolved |= is_unlit
+    return lighting.astype(np.float32), resolved
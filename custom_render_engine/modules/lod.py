@@ -0,0 +1,113 @@
+import collections
+import concurrent.futures
+import hashlib
+
+import numpy as np
+
+# Vertex clustering decimation. Every LOD is just another index buffer over the mesh's
+# existing vertex buffers: loops falling in the same grid cell are collapsed onto the first
+# one, and triangles that end up degenerate are dropped.
+
+# grid cells along the longest side of the bounding box, per LOD level
+LOD_GRID_RESOLUTIONS = (64, 32, 16, 8)
+
+def decimate_clusters(positions, indices, cell_size, origin):
+    cells = np.floor((positions - origin) / cell_size).astype(np.int64)
+    # first loop of every cell becomes the representative of the whole cell
+    _, first, inverse = np.unique(cells, axis=0, return_index=True, return_inverse=True)
+    remap = first[inverse.ravel()].astype(np.uintc)
+    triangles = remap[indices]
+    keep = (triangles[:, 0] != triangles[:, 1]) & (triangles[:, 1] != triangles[:, 2]) & (triangles[:, 0] != triangles[:, 2])
+    triangles = triangles[keep]
+    # the same triangle can come out of several source triangles
+    if len(triangles):
+        triangles = np.unique(triangles, axis=0)
+    return np.ascontiguousarray(triangles, dtype=np.uintc)
+
+def generate_lods(positions, indices, levels):
+    lo = positions.min(axis=0)
+    hi = positions.max(axis=0)
+    extent = float((hi - lo).max())
+    out = []
+    if extent <= 0:
+        return out
+    for resolution in LOD_GRID_RESOLUTIONS[:levels]:
+        triangles = decimate_clusters(positions, indices, extent / resolution, lo)
+        # no point keeping levels that don't reduce anything or collapse the mesh entirely
+        if len(triangles) == 0 or (out and len(triangles) >= len(out[-1])) or len(triangles) >= len(indices):
+            continue
+        out.append(triangles)
+    return out
+
+def content_hash(positions, indices, levels):
+    h = hashlib.blake2b(digest_size=16)
+    h.update(positions.tobytes())
+    h.update(indices.tobytes())
+    h.update(bytes((levels,)))
+    return h.hexdigest()
+
+# Projected diameter of a bounding sphere in pixels, for both perspective and ortho projections.
+# The vertical focal length comes from the projection alone (window_matrix), view_projection's
+# [1][1] depends on the view's orientation and is 0 for a front view.
+def projected_size(center_world, radius_world, view_projection, projection, viewport_height):
+    clip = view_projection @ center_world.to_4d()
+    w = abs(clip.w) if abs(clip.w) > 1e-6 else 1e-6
+    return radius_world * abs(projection[1][1]) / w * viewport_height
+
+# LOD 0 is the full mesh, every halving of the screen size below screen_size goes one level down
+def select_lod(size_pixels, screen_size, level_count):
+    level = 0
+    threshold = screen_size
+    while level < level_count and size_pixels < threshold:
+        level += 1
+        threshold /= 2
+    return level
+
+class LODGenerator:
+    # Decimation runs on worker threads (numpy releases the GIL for most of it), results are
+    # cached by mesh content so identical meshes, undo and re-syncs don't decimate again.
+    # GPU objects are created by the caller on the main thread.
+    def __init__(self, max_cached=256, workers=2):
+        self.cache = collections.OrderedDict()
+        self.max_cached = max_cached
+        self.executor = None
+        self.workers = workers
+        self.pending = {}
+
+    def request(self, positions, indices, levels):
+        key = content_hash(positions, indices, levels)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return key
+        if key not in self.pending:
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="lod")
+            self.pending[key] = self.executor.submit(generate_lods, positions.copy(), indices.copy(), levels)
+        return key
+
+    # Returns the list of index arrays, or None while still being generated
+    def get(self, key):
+        lods = self.cache.get(key)
+        if lods is not None:
+            return lods
+        future = self.pending.get(key)
+        if future is None or not future.done():
+            return None
+        del self.pending[key]
+        try:
+            lods = future.result()
+        except Exception as e:
+            print(f"LOD generation failed: {e}", flush=True)
+            lods = []
+        self.cache[key] = lods
+        while len(self.cache) > self.max_cached:
+            self.cache.popitem(last=False)
+        return lods
+
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+        self.pending.clear()
+
+LODS = LODGenerator()
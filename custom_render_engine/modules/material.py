@@ -74,6 +74,8 @@ class CustomShaderNode1(bpy.types.ShaderNode):
         self.outputs.new("NodeSocketShader", "aaaaaa")
         self.inputs.new("NodeSocketColor", "basecolor")
         self.inputs["basecolor"].default_value = (1, 1, 1, 1)
+        self.inputs.new("NodeSocketColor", "shadowtint")
+        self.inputs["shadowtint"].default_value = (0, 0, 0, 1)
     
 class CustomShaderNodeCategory(nodeitems_utils.NodeCategory):
     @classmethod
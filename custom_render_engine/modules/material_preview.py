@@ -0,0 +1,128 @@
+import collections
+
+import bpy
+import gpu
+import numpy as np
+
+from .frame_graph import TexturePool
+from .texture_cache import image_key, image_signature
+from .node_compiler import canonicalize, UnsupportedNode
+
+# Material previews are drawn on one sphere with a fixed camera and light, so the pixels only
+# depend on the material and the preview size and can be cached on those.
+
+# everything in the material's custom_settings that changes how it's drawn
+PREVIEW_PROPERTIES = ("tex_base_color", "tex_shadow_tint", "col_shadow_tint", "shading_model", "f_sm_param")
+PREVIEW_TEXTURES = ("tex_base_color", "tex_shadow_tint")
+
+def _freeze(value):
+    if isinstance(value, str) or not hasattr(value, "__len__"):
+        return value
+    return tuple(value)
+
+def _image_identity(image):
+    return (image_key(image), image_signature(image)) if image else None
+
+# structure, values and images of the material's node tree
+def get_node_tree_key(material):
+    if not material.use_nodes or not material.node_tree:
+        return None
+    try:
+        graph = canonicalize(material.node_tree)
+    except UnsupportedNode:
+        return None
+    if graph is None:
+        return None
+    return (graph.key, tuple(graph.get_uniform_values()), tuple(_image_identity(image) for image in graph.samplers))
+
+def get_preview_key(material, size):
+    if material is None:
+        return (tuple(size), None)
+    settings = material.custom_settings
+    values = tuple(_freeze(getattr(settings, name)) for name in PREVIEW_PROPERTIES)
+    images = tuple(_image_identity(bpy.data.images.get(getattr(settings, name))) for name in PREVIEW_TEXTURES)
+    return (tuple(size), tuple(material.diffuse_color), values, images, get_node_tree_key(material))
+
+# UV sphere with the attributes of the base pass, seams have their own vertices
+def create_sphere(segments=48, rings=24):
+    theta = np.linspace(0, np.pi, rings + 1, dtype=np.float32)
+    phi = np.linspace(0, 2 * np.pi, segments + 1, dtype=np.float32)
+    theta, phi = np.meshgrid(theta, phi, indexing="ij")
+    positions = np.stack((np.sin(theta) * np.cos(phi), np.sin(theta) * np.sin(phi), np.cos(theta)), axis=-1).reshape(-1, 3)
+    tangents = np.stack((-np.sin(phi), np.cos(phi), np.zeros_like(phi)), axis=-1).reshape(-1, 3)
+    uvs = np.stack((phi / (2 * np.pi), 1 - theta / np.pi), axis=-1).reshape(-1, 2)
+
+    # two counter-clockwise triangles per quad, seen from outside
+    r, s = np.meshgrid(np.arange(rings), np.arange(segments), indexing="ij")
+    a = (r * (segments + 1) + s).ravel()
+    b = a + segments + 1
+    indices = np.concatenate((np.stack((a, b, b + 1), axis=1), np.stack((a, b + 1, a + 1), axis=1))).astype(np.uintc)
+    return positions.astype(np.float32), tangents.astype(np.float32), uvs.astype(np.float32), indices
+
+class PreviewCache:
+    # Rendered previews by get_preview_key, the least recently used are dropped above
+    # max_bytes. Blender creates an engine for every preview, so the offscreen and render
+    # targets they draw to are kept here as well.
+    def __init__(self, max_bytes=64 * 2**20):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.stats = collections.Counter()
+        self.offscreen = None
+        self.render_targets = TexturePool()
+
+    def get(self, key):
+        pixels = self.entries.get(key)
+        if pixels is None:
+            self.stats["misses"] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return pixels
+
+    def add(self, key, pixels):
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.bytes -= old.nbytes
+        self.entries[key] = pixels
+        self.bytes += pixels.nbytes
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= evicted.nbytes
+            self.stats["evictions"] += 1
+
+    def get_offscreen(self, width, height):
+        if self.offscreen is None or (self.offscreen.width, self.offscreen.height) != (width, height):
+            if self.offscreen is not None:
+                self.offscreen.free()
+            self.offscreen = gpu.types.GPUOffScreen(width, height, format="RGBA16F")
+        return self.offscreen
+
+    # Frees the offscreen and render targets (the next preview makes them again) but keeps
+    # the cached pixels, returns the bytes freed
+    def release_targets(self):
+        from .gpu_memory import get_pool_bytes
+        freed = get_pool_bytes(self.render_targets)
+        if self.offscreen is not None:
+            freed += self.offscreen.width * self.offscreen.height * (8 + 4)
+            self.offscreen.free()
+            self.offscreen = None
+        self.render_targets.clear()
+        return freed
+
+    def get_stats(self):
+        out = dict(self.stats)
+        out["previews"] = len(self.entries)
+        out["bytes"] = self.bytes
+        return out
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+        self.stats.clear()
+        if self.offscreen is not None:
+            self.offscreen.free()
+            self.offscreen = None
+        self.render_targets.clear()
+
+PREVIEWS = PreviewCache()
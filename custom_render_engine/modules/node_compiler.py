@@ -0,0 +1,343 @@
+import collections
+import hashlib
+import os
+import re
+import tempfile
+
+# Compiles material node trees to a GLSL function for the base pass:
+#
+#     void EvaluateMaterial(out vec3 BaseColor, out vec3 ShadowTint)
+#
+# The tree is first canonicalized: the nodes reachable from the output are ordered by a
+# depth first walk in socket order, so names, locations and creation order don't matter,
+# reroutes and muted nodes are looked through and unconnected nodes are dropped. The key of
+# a program is a hash of that structure. Constant inputs (socket values, RGB and Value nodes)
+# become uniforms and images become samplers, so editing them never changes the key:
+# materials with the same structure share one program and value tweaks only update uniforms.
+#
+# Nothing in here uses bpy or gpu, node trees are only read through their attributes.
+
+# bump when the generated code changes, so sources cached on disk aren't reused
+CODEGEN_VERSION = 2
+
+GLSL_TYPES = {"VALUE": "float", "RGBA": "vec4", "VECTOR": "vec3"}
+
+class UnsupportedNode(Exception):
+    pass
+
+def convert(expr, from_type, to_type):
+    if from_type == to_type:
+        return expr
+    match from_type, to_type:
+        case "VALUE", "RGBA":
+            return f"vec4(vec3({expr}), 1.0)"
+        case "VALUE", "VECTOR":
+            return f"vec3({expr})"
+        case "RGBA", "VALUE":
+            return f"dot({expr}.rgb, vec3(0.2126, 0.7152, 0.0722))"
+        case "RGBA", "VECTOR":
+            return f"{expr}.rgb"
+        case "VECTOR", "VALUE":
+            return f"dot({expr}, vec3(1.0 / 3.0))"
+        case "VECTOR", "RGBA":
+            return f"vec4({expr}, 1.0)"
+    raise UnsupportedNode(f"Can't convert a {from_type} socket to {to_type}")
+
+class NodeType:
+    # inputs: (identifier, socket type, implicit) where implicit is the GLSL used when nothing
+    # is linked to the input (eg. texture coordinates), in place of its value, or None.
+    # outputs: identifier -> socket type. constants: outputs whose value is a uniform.
+    # generate(inputs, props) returns identifier -> GLSL expression of every output.
+    def __init__(self, inputs, outputs, generate, props=(), constants=(), sampler=False):
+        self.inputs = inputs
+        self.outputs = outputs
+        self.generate = generate
+        self.props = props
+        self.constants = constants
+        self.sampler = sampler
+
+MIX_BLEND = {
+    "MIX": "{b}",
+    "ADD": "{a} + {b}",
+    "SUBTRACT": "{a} - {b}",
+    "MULTIPLY": "{a} * {b}",
+    "SCREEN": "1.0 - (1.0 - {a}) * (1.0 - {b})",
+    "DIFFERENCE": "abs({a} - {b})",
+    "DARKEN": "min({a}, {b})",
+    "LIGHTEN": "max({a}, {b})",
+}
+
+def _mix_rgb(ins, props):
+    a, b = ins["Color1"], ins["Color2"]
+    blend = MIX_BLEND[props["blend_type"]].format(a=f"{a}.rgb", b=f"{b}.rgb")
+    color = f"mix({a}.rgb, {blend}, clamp({ins['Fac']}, 0.0, 1.0))"
+    if props["use_clamp"]:
+        color = f"clamp({color}, 0.0, 1.0)"
+    return {"Color": f"vec4({color}, {a}.a)"}
+
+MATH_OPERATIONS = {
+    "ADD": "{a} + {b}",
+    "SUBTRACT": "{a} - {b}",
+    "MULTIPLY": "{a} * {b}",
+    "DIVIDE": "({b} != 0.0 ? {a} / {b} : 0.0)",
+    "MULTIPLY_ADD": "{a} * {b} + {c}",
+    "POWER": "pow({a}, {b})",
+    "MINIMUM": "min({a}, {b})",
+    "MAXIMUM": "max({a}, {b})",
+    "LESS_THAN": "float({a} < {b})",
+    "GREATER_THAN": "float({a} > {b})",
+    "ABSOLUTE": "abs({a})",
+    "SQRT": "sqrt(max({a}, 0.0))",
+    "FRACT": "fract({a})",
+    "FLOOR": "floor({a})",
+    "SINE": "sin({a})",
+    "COSINE": "cos({a})",
+}
+
+def _math(ins, props):
+    if props["operation"] not in MATH_OPERATIONS:
+        raise UnsupportedNode(f"Math operation {props['operation']} isn't supported")
+    value = MATH_OPERATIONS[props["operation"]].format(a=ins["Value"], b=ins["Value_001"], c=ins["Value_002"])
+    if props["use_clamp"]:
+        value = f"clamp({value}, 0.0, 1.0)"
+    return {"Value": value}
+
+def _invert(ins, props):
+    color = ins["Color"]
+    return {"Color": f"vec4(mix({color}.rgb, 1.0 - {color}.rgb, {ins['Fac']}), {color}.a)"}
+
+def _image(ins, props):
+    # the sampler name is passed in as an input
+    color = f"texture({ins['image']}, {ins['Vector']}.xy)"
+    return {"Color": color, "Alpha": f"{color}.a"}
+
+def _custom_output(ins, props):
+    return {"BaseColor": f"{ins['basecolor']}.rgb", "ShadowTint": f"{ins['shadowtint']}.rgb"}
+
+NODE_TYPES = {
+    "ShaderNodeRGB": NodeType((), {"Color": "RGBA"}, lambda ins, props: {}, constants=("Color",)),
+    "ShaderNodeValue": NodeType((), {"Value": "VALUE"}, lambda ins, props: {}, constants=("Value",)),
+    "ShaderNodeVertexColor": NodeType((), {"Color": "RGBA", "Alpha": "VALUE"},
+        lambda ins, props: {"Color": "vcolor", "Alpha": "vcolor.a"}),
+    "ShaderNodeUVMap": NodeType((), {"UV": "VECTOR"}, lambda ins, props: {"UV": "vec3(uv, 0.0)"}),
+    "ShaderNodeTexCoord": NodeType((), {"UV": "VECTOR", "Normal": "VECTOR"},
+        lambda ins, props: {"UV": "vec3(uv, 0.0)", "Normal": "normal"}),
+    "ShaderNodeTexImage": NodeType((("Vector", "VECTOR", "vec3(uv, 0.0)"),), {"Color": "RGBA", "Alpha": "VALUE"},
+        _image, sampler=True),
+    "ShaderNodeMixRGB": NodeType((("Fac", "VALUE", None), ("Color1", "RGBA", None), ("Color2", "RGBA", None)),
+        {"Color": "RGBA"}, _mix_rgb, props=("blend_type", "use_clamp")),
+    "ShaderNodeMath": NodeType((("Value", "VALUE", None), ("Value_001", "VALUE", None), ("Value_002", "VALUE", None)),
+        {"Value": "VALUE"}, _math, props=("operation", "use_clamp")),
+    "ShaderNodeInvert": NodeType((("Fac", "VALUE", None), ("Color", "RGBA", None)), {"Color": "RGBA"}, _invert),
+    # the material's shadow tint texture is used if nothing is linked to shadowtint
+    "CustomShaderNode1": NodeType((("basecolor", "RGBA", None), ("shadowtint", "RGBA", "texture(tshadowtint, uv)")),
+        {"BaseColor": "VECTOR", "ShadowTint": "VECTOR"}, _custom_output),
+}
+
+OUTPUT_NODE_TYPES = {"CustomShaderNode1"}
+
+def find_socket(sockets, identifier):
+    for socket in sockets:
+        if socket.identifier == identifier:
+            return socket
+    return None
+
+# What an input reads from: ("link", node, output socket), ("value", socket) for a constant
+# (the input itself, or the input of a muted node passing it through) or None
+def resolve_input(socket):
+    if socket.is_linked:
+        for link in socket.links:
+            if link.is_valid and not getattr(link, "is_muted", False):
+                return resolve_output(link.from_node, link.from_socket)
+        return None
+    return ("value", socket)
+
+def resolve_output(node, output):
+    if node.bl_idname == "NodeReroute":
+        return resolve_input(node.inputs[0])
+    if node.mute:
+        for internal in node.internal_links:
+            if internal.to_socket.identifier == output.identifier:
+                return resolve_input(internal.from_socket)
+        return None
+    return ("link", node, output)
+
+def get_output_node(tree):
+    for node in tree.nodes:
+        if node.bl_idname == "ShaderNodeOutputMaterial" and node.is_active_output and not node.mute:
+            surface = resolve_input(find_socket(node.inputs, "Surface"))
+            if surface and surface[0] == "link" and surface[1].bl_idname in OUTPUT_NODE_TYPES:
+                return surface[1]
+    return None
+
+class CanonicalGraph:
+    def __init__(self):
+        # (bl_idname, props, inputs) in evaluation order, inputs being
+        # ("node", index, output, type), ("uniform", index, type), ("implicit",) or ("sampler", index)
+        self.nodes = []
+        # (socket type, socket) the uniform values are read from, in uniform order
+        self.uniforms = []
+        # image of every sampler (can be None)
+        self.samplers = []
+        self.key = None
+
+    def get_uniform_values(self):
+        values = []
+        for type, socket in self.uniforms:
+            value = socket.default_value
+            values.append(float(value) if type == "VALUE" else tuple(value))
+        return values
+
+def canonicalize(tree):
+    graph = CanonicalGraph()
+    output_node = get_output_node(tree)
+    if output_node is None:
+        return None
+    indices = {}
+
+    def add_uniform(type, socket):
+        if type not in GLSL_TYPES:
+            raise UnsupportedNode(f"{type} sockets can't be uniforms")
+        graph.uniforms.append((type, socket))
+        return ("uniform", len(graph.uniforms) - 1, type)
+
+    def visit(node):
+        if node.name in indices:
+            return indices[node.name]
+        node_type = NODE_TYPES.get(node.bl_idname)
+        if node_type is None:
+            raise UnsupportedNode(f"{node.bl_label} nodes aren't supported ({node.name})")
+        props = tuple(getattr(node, name) for name in node_type.props)
+        inputs = []
+        for identifier, type, implicit in node_type.inputs:
+            socket = find_socket(node.inputs, identifier)
+            source = resolve_input(socket) if socket is not None else None
+            if implicit is not None and (source is None or source[0] == "value"):
+                inputs.append(("implicit",))
+            elif source is None:
+                if socket is None:
+                    raise UnsupportedNode(f"{node.name} has no {identifier} input")
+                inputs.append(add_uniform(type, socket))
+            elif source[0] == "value":
+                inputs.append(add_uniform(type, source[1]))
+            else:
+                _, from_node, from_socket = source
+                index = visit(from_node)
+                from_type = NODE_TYPES[from_node.bl_idname].outputs.get(from_socket.identifier)
+                if from_type is None:
+                    raise UnsupportedNode(f"{from_node.name}.{from_socket.identifier} isn't supported")
+                inputs.append(("node", index, from_socket.identifier, from_type))
+        for identifier in node_type.constants:
+            inputs.append(add_uniform(node_type.outputs[identifier], find_socket(node.outputs, identifier)))
+        if node_type.sampler:
+            graph.samplers.append(node.image)
+            inputs.append(("sampler", len(graph.samplers) - 1))
+        graph.nodes.append((node.bl_idname, props, tuple(inputs)))
+        indices[node.name] = len(graph.nodes) - 1
+        return indices[node.name]
+
+    visit(output_node)
+    structure = repr((CODEGEN_VERSION, graph.nodes)).encode()
+    graph.key = hashlib.sha1(structure).hexdigest()[:16]
+    return graph
+
+def get_variable(index, identifier):
+    return f"n{index}_" + re.sub(r"\W", "_", identifier)
+
+def generate_source(graph):
+    lines = [f"// generated from a material node tree, structure {graph.key}"]
+    for i, (type, _) in enumerate(graph.uniforms):
+        lines.append(f"uniform {GLSL_TYPES[type]} node_u{i};")
+    for i in range(len(graph.samplers)):
+        lines.append(f"uniform sampler2D node_t{i};")
+    lines.append("")
+    lines.append("void EvaluateMaterial(out vec3 BaseColor, out vec3 ShadowTint)")
+    lines.append("{")
+    for index, (bl_idname, props, inputs) in enumerate(graph.nodes):
+        node_type = NODE_TYPES[bl_idname]
+        ins = {}
+        for (identifier, type, implicit), source in zip(node_type.inputs, inputs):
+            match source:
+                case ("node", from_index, from_identifier, from_type):
+                    ins[identifier] = convert(get_variable(from_index, from_identifier), from_type, type)
+                case ("uniform", uniform, _):
+                    ins[identifier] = f"node_u{uniform}"
+                case ("implicit",):
+                    ins[identifier] = implicit
+        # constant outputs and the sampler come after the declared inputs
+        extra = inputs[len(node_type.inputs):]
+        for source in extra:
+            if source[0] == "sampler":
+                ins["image"] = f"node_t{source[1]}"
+        outputs = node_type.generate(ins, dict(zip(node_type.props, props)))
+        for identifier, (_, uniform, _) in zip(node_type.constants, extra):
+            outputs[identifier] = f"node_u{uniform}"
+        if bl_idname in OUTPUT_NODE_TYPES:
+            lines.append(f"    BaseColor = {outputs['BaseColor']};")
+            lines.append(f"    ShadowTint = {outputs['ShadowTint']};")
+            continue
+        for identifier, type in node_type.outputs.items():
+            lines.append(f"    {GLSL_TYPES[type]} {get_variable(index, identifier)} = {outputs[identifier]};")
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+class NodeShaderCache:
+    # Generated sources by structure key, in memory and (if cache_dir is set) on disk so they
+    # survive restarts and can be looked at. Programs are compiled and kept by the shader cache.
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self.sources = {}
+        self.stats = collections.Counter()
+
+    # Returns (graph, source), or None if the tree doesn't end in one of this engine's
+    # output nodes. Raises UnsupportedNode for trees that can't be compiled.
+    def compile(self, tree):
+        graph = canonicalize(tree)
+        if graph is None:
+            return None
+        source = self.sources.get(graph.key)
+        if source is not None:
+            self.stats["hits"] += 1
+            return graph, source
+        source = self.load(graph.key)
+        if source is not None:
+            self.stats["disk_hits"] += 1
+        else:
+            source = generate_source(graph)
+            self.stats["generated"] += 1
+            self.store(graph.key, source)
+        self.sources[graph.key] = source
+        return graph, source
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, key + ".glsl")
+
+    def load(self, key):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self.get_path(key)) as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def store(self, key, source):
+        if not self.cache_dir:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(self.get_path(key), "w") as f:
+                f.write(source)
+        except OSError as e:
+            print(f"Couldn't write node shader cache: {e}", flush=True)
+
+    def get_stats(self):
+        out = dict(self.stats)
+        out["sources"] = len(self.sources)
+        return out
+
+    def clear(self):
+        self.sources.clear()
+        self.stats.clear()
+
+NODE_SHADERS = NodeShaderCache(os.path.join(tempfile.gettempdir(), "custom_render_engine", "node_shaders"))
@@ -1,20 +1,30 @@
 
 import bpy
-import numpy as np
 import mathutils
 import bl_math
 
 # Maps calculated normals into vertex color when using custom split normals
 def bake_vertex_normals(object, write_z, merge_axis, merge_threshold):
+    import numpy as np
+    from .tangents import calc_tangents, calc_bitangents
+
     mesh = object.data
-    mesh.calc_tangents()
+    mesh.calc_normals_split()
+    mesh.calc_loop_triangles()
     normals = np.empty((len(mesh.loops), 3), dtype=np.float32)
     mesh.loops.foreach_get("normal", np.reshape(normals, len(mesh.loops) * 3))
-    tangents = np.empty((len(mesh.loops), 3), dtype=np.float32)
-    mesh.loops.foreach_get("tangent", np.reshape(tangents, len(mesh.loops) * 3))
-    bitangents = np.empty((len(mesh.loops), 3), dtype=np.float32)
-    mesh.loops.foreach_get("bitangent", np.reshape(bitangents, len(mesh.loops) * 3))
-    bitangents = np.negative(bitangents)
+    coords = np.empty((len(mesh.vertices), 3), dtype=np.float32)
+    mesh.vertices.foreach_get("co", np.reshape(coords, len(mesh.vertices) * 3))
+    loop_vertices = np.empty(len(mesh.loops), dtype=np.intc)
+    mesh.loops.foreach_get("vertex_index", loop_vertices)
+    triangles = np.empty((len(mesh.loop_triangles), 3), dtype=np.intc)
+    mesh.loop_triangles.foreach_get("loops", np.reshape(triangles, len(mesh.loop_triangles) * 3))
+    uvs = None
+    if mesh.uv_layers.active:
+        uvs = np.empty((len(mesh.loops), 2), dtype=np.float32)
+        mesh.uv_layers.active.data.foreach_get("uv", np.reshape(uvs, len(mesh.loops) * 2))
+    tangents, signs = calc_tangents(coords[loop_vertices], normals, uvs, triangles)
+    bitangents = np.negative(calc_bitangents(normals, tangents, signs))
     
     vertex_normals = np.copy(normals)
     for i in range(len(mesh.loops)):
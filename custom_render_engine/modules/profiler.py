@@ -0,0 +1,308 @@
+import collections
+import contextlib
+import json
+import threading
+import time
+
+import bpy
+from bpy_extras.io_utils import ExportHelper
+
+try:
+    import bgl
+    _HAS_GL_QUERIES = all(hasattr(bgl, f) for f in ("glGenQueries", "glBeginQuery", "glEndQuery", "glGetQueryObjectuiv"))
+except ImportError:
+    bgl = None
+    _HAS_GL_QUERIES = False
+
+# not all bgl builds export these
+GL_TIME_ELAPSED = 0x88BF
+GL_QUERY_RESULT = 0x8866
+GL_QUERY_RESULT_AVAILABLE = 0x8867
+
+Span = collections.namedtuple("Span", ["name", "start_ns", "duration_ns", "depth", "gpu_ns"])
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+class GPUTimer:
+    # GL_TIME_ELAPSED queries can't nest, so only one span at a time gets a GPU time.
+    # Results are read one frame late to avoid stalling on the GPU.
+    def __init__(self):
+        self.free = []
+        self.active = None
+        self.pending = []
+
+    @staticmethod
+    def supported():
+        if not _HAS_GL_QUERIES:
+            return False
+        try:
+            import gpu
+            return gpu.platform.backend_type_get() == "OPENGL"
+        except (AttributeError, ImportError):
+            # blender < 3.4 only has the OpenGL backend
+            return True
+
+    def begin(self, span_index):
+        if self.active is not None:
+            return False
+        if self.free:
+            query = self.free.pop()
+        else:
+            buf = bgl.Buffer(bgl.GL_INT, 1)
+            bgl.glGenQueries(1, buf)
+            query = buf[0]
+        bgl.glBeginQuery(GL_TIME_ELAPSED, query)
+        self.active = (query, span_index)
+        return True
+
+    def end(self, frame):
+        query, span_index = self.active
+        bgl.glEndQuery(GL_TIME_ELAPSED)
+        self.pending.append((frame, span_index, query))
+        self.active = None
+
+    def collect(self):
+        still_pending = []
+        buf = bgl.Buffer(bgl.GL_INT, 1)
+        for frame, span_index, query in self.pending:
+            bgl.glGetQueryObjectuiv(query, GL_QUERY_RESULT_AVAILABLE, buf)
+            if not buf[0]:
+                still_pending.append((frame, span_index, query))
+                continue
+            bgl.glGetQueryObjectuiv(query, GL_QUERY_RESULT, buf)
+            frame["spans"][span_index] = frame["spans"][span_index]._replace(gpu_ns=buf[0])
+            self.free.append(query)
+        self.pending = still_pending
+
+class _Span:
+    __slots__ = ("profiler", "name", "gpu", "start", "index", "timed_gpu")
+
+    def __init__(self, profiler, name, gpu):
+        self.profiler = profiler
+        self.name = name
+        self.gpu = gpu
+
+    def __enter__(self):
+        state = self.profiler.get_state()
+        self.index = len(state.current["spans"])
+        state.current["spans"].append(None)
+        gpu_timer = self.profiler.gpu_timer
+        self.timed_gpu = self.gpu and gpu_timer is not None and state.use_gpu_timer and gpu_timer.begin(self.index)
+        state.depth += 1
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *args):
+        end = time.perf_counter_ns()
+        state = self.profiler.get_state()
+        state.depth -= 1
+        if self.timed_gpu:
+            self.profiler.gpu_timer.end(state.current)
+        state.current["spans"][self.index] = Span(self.name, self.start, end - self.start, state.depth, None)
+        return False
+
+VIEWPORT_TRACK = "viewport"
+
+class Profiler:
+    # Records CPU spans, and GPU spans where GL timer queries are available, into a
+    # rolling window of frames. When disabled span() returns a shared no-op context.
+    # Final renders and previews run on threads and GL contexts of their own, every thread
+    # records into its own frame and they're told apart by track. Queries only work in the
+    # context they were made in, so only the viewport's frames (view_draw, on the main
+    # thread) get GPU times.
+    def __init__(self, window=120):
+        self.enabled = False
+        self.frames = collections.deque(maxlen=window)
+        self.gpu_timer = None
+        self.local = threading.local()
+
+    @staticmethod
+    def new_frame(track=VIEWPORT_TRACK):
+        return {"start_ns": time.perf_counter_ns(), "spans": [], "counters": {}, "track": track}
+
+    # the calling thread's frame, viewport frames until track() says otherwise
+    def get_state(self):
+        state = self.local
+        if not hasattr(state, "current"):
+            state.current = self.new_frame()
+            state.depth = 0
+            state.use_gpu_timer = threading.current_thread() is threading.main_thread()
+        return state
+
+    # Records what runs inside into frames of the named track, eg. "render" for F12 renders,
+    # ended on the way out
+    @contextlib.contextmanager
+    def track(self, name):
+        state = self.get_state()
+        saved = (state.current, state.depth, state.use_gpu_timer)
+        state.current, state.depth, state.use_gpu_timer = self.new_frame(name), 0, False
+        try:
+            yield
+        finally:
+            if self.enabled:
+                state.current["end_ns"] = time.perf_counter_ns()
+                self.frames.append(state.current)
+            state.current, state.depth, state.use_gpu_timer = saved
+
+    def set_enabled(self, enabled):
+        if enabled == self.enabled:
+            return
+        self.enabled = enabled
+        self.clear()
+        if enabled and GPUTimer.supported():
+            self.gpu_timer = GPUTimer()
+        else:
+            self.gpu_timer = None
+
+    def clear(self):
+        self.frames.clear()
+        state = self.get_state()
+        state.depth = 0
+        state.current = self.new_frame(state.current["track"])
+
+    def span(self, name, gpu=False):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, gpu)
+
+    def count(self, name, value=1):
+        if self.enabled:
+            counters = self.get_state().current["counters"]
+            counters[name] = counters.get(name, 0) + value
+
+    # spans recorded between frames (eg. view_update) end up in the next frame
+    def end_frame(self):
+        if not self.enabled:
+            return
+        state = self.get_state()
+        if self.gpu_timer and state.use_gpu_timer:
+            self.gpu_timer.collect()
+        state.current["end_ns"] = time.perf_counter_ns()
+        self.frames.append(state.current)
+        state.current = self.new_frame(state.current["track"])
+
+    # span names of other tracks than the viewport's start with the track
+    @staticmethod
+    def get_label(track, name):
+        return name if track == VIEWPORT_TRACK else f"{track}: {name}"
+
+    # Averages per frame of the span's track
+    def summary(self):
+        frame_counts = collections.Counter(frame["track"] for frame in self.frames)
+        totals = collections.OrderedDict()
+        for frame in self.frames:
+            for span in frame["spans"]:
+                if span is None:
+                    continue
+                entry = totals.setdefault((frame["track"], span.name), [0, 0, 0, 0])
+                entry[0] += 1
+                entry[1] += span.duration_ns
+                if span.gpu_ns is not None:
+                    entry[2] += 1
+                    entry[3] += span.gpu_ns
+        out = collections.OrderedDict()
+        for (track, name), (calls, cpu_ns, gpu_calls, gpu_ns) in totals.items():
+            frame_count = frame_counts[track]
+            out[self.get_label(track, name)] = {
+                "calls_per_frame": calls / frame_count,
+                "cpu_ms": cpu_ns / frame_count / 1e6,
+                "gpu_ms": gpu_ns / frame_count / 1e6 if gpu_calls else None,
+            }
+        return out
+
+    def counter_summary(self):
+        frame_counts = collections.Counter(frame["track"] for frame in self.frames)
+        out = {}
+        for frame in self.frames:
+            for name, value in frame["counters"].items():
+                key = (frame["track"], name)
+                out[key] = out.get(key, 0) + value
+        return {self.get_label(track, name): value / frame_counts[track] for (track, name), value in out.items()}
+
+    # https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU
+    # The viewport's CPU and GPU spans are threads 0 and 1, every other track gets a thread of
+    # its own so its spans don't land in between the viewport's
+    def to_chrome_trace(self):
+        tids = {VIEWPORT_TRACK: 0}
+        events = [
+            {"name": "thread_name", "ph": "M", "pid": 0, "tid": 0, "args": {"name": VIEWPORT_TRACK}},
+            {"name": "thread_name", "ph": "M", "pid": 0, "tid": 1, "args": {"name": VIEWPORT_TRACK + " (GPU)"}},
+        ]
+        for frame_number, frame in enumerate(self.frames):
+            track = frame["track"]
+            if track not in tids:
+                tids[track] = len(tids) + 1
+                events.append({"name": "thread_name", "ph": "M", "pid": 0, "tid": tids[track], "args": {"name": track}})
+            tid = tids[track]
+            for span in frame["spans"]:
+                if span is None:
+                    continue
+                events.append({
+                    "name": span.name, "cat": "cpu", "ph": "X", "pid": 0, "tid": tid,
+                    "ts": span.start_ns / 1000.0, "dur": span.duration_ns / 1000.0,
+                    "args": {"frame": frame_number, "track": track},
+                })
+                if span.gpu_ns is not None:
+                    events.append({
+                        "name": span.name, "cat": "gpu", "ph": "X", "pid": 0, "tid": 1,
+                        "ts": span.start_ns / 1000.0, "dur": span.gpu_ns / 1000.0,
+                        "args": {"frame": frame_number, "track": track},
+                    })
+            for name, value in frame["counters"].items():
+                label = self.get_label(track, name)
+                events.append({"name": label, "ph": "C", "pid": 0, "ts": frame["start_ns"] / 1000.0, "args": {label: value}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def export_chrome_trace(self, filepath):
+        with open(filepath, "w") as f:
+            json.dump(self.to_chrome_trace(), f)
+
+PROFILER = Profiler()
+
+class RENDER_OT_custom_export_profile(bpy.types.Operator, ExportHelper):
+    bl_idname = "render.custom_export_profile"
+    bl_label = "Export Profile"
+    bl_description = "Export the recorded frames as Chrome trace JSON (chrome://tracing, Perfetto)"
+
+    filename_ext = ".json"
+    filter_glob: bpy.props.StringProperty(default="*.json", options={'HIDDEN'})
+
+    @classmethod
+    def poll(cls, context):
+        return len(PROFILER.frames) > 0
+
+    def execute(self, context):
+        PROFILER.export_chrome_trace(self.filepath)
+        return {"FINISHED"}
+
+def draw_profiler(layout):
+    box = layout.box()
+    summary = PROFILER.summary()
+    if not summary:
+        box.label(text="No frames recorded")
+        return
+    col = box.column(align=True)
+    for name, entry in summary.items():
+        text = f"{name}: {entry['cpu_ms']:.3f} ms"
+        if entry["gpu_ms"] is not None:
+            text += f" (GPU {entry['gpu_ms']:.3f} ms)"
+        if entry["calls_per_frame"] != 1:
+            text += f" x{entry['calls_per_frame']:.1f}"
+        col.label(text=text)
+    for name, value in PROFILER.counter_summary().items():
+        col.label(text=f"{name}: {value:.1f}")
+    box.operator(RENDER_OT_custom_export_profile.bl_idname)
+
+def register():
+    bpy.utils.register_class(RENDER_OT_custom_export_profile)
+
+def unregister():
+    bpy.utils.unregister_class(RENDER_OT_custom_export_profile)
+    PROFILER.set_enabled(False)
@@ -0,0 +1,17 @@
+import functools
+import os
+
+# resolved from this file instead of the working directory, blender (and render farm workers)
+# can be started from anywhere
+ADDON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SHADER_DIR = os.path.join(ADDON_DIR, "shaders")
+
+# Shader files are read once, on first use, and kept for the rest of the session
+@functools.lru_cache(maxsize=None)
+def get_shader_source(name):
+    with open(os.path.join(SHADER_DIR, name)) as f:
+        return f.read()
+
+# for shader development, call this to pick up edits without restarting blender
+def clear_shader_cache():
+    get_shader_source.cache_clear()
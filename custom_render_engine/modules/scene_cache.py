@@ -0,0 +1,115 @@
+import collections
+
+class SharedResource:
+    __slots__ = ("value", "users", "serial", "free")
+
+    def __init__(self, value, free):
+        self.value = value
+        self.users = 0
+        # bumped whenever the value is rebuilt or updated
+        self.serial = 0
+        self.free = free
+
+class SceneCache:
+    # Per datablock GPU resources (mesh batches, material uniforms and textures) shared by
+    # the engine instances of a depsgraph mode, Blender creates one per viewport in rendered
+    # mode. Entries are
+    # reference counted by the engines holding them, the last release frees them.
+    #
+    # Every engine gets the depsgraph updates, so an update is only applied by the first engine
+    # to see it: the others find the entry's serial has moved on and just pick up the new value.
+    def __init__(self):
+        self.entries = {}
+        self.stats = collections.Counter()
+
+    def acquire(self, key, build, free=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = SharedResource(build(), free)
+            self.entries[key] = entry
+            self.stats["builds"] += 1
+        else:
+            self.stats["shared"] += 1
+        entry.users += 1
+        return entry
+
+    def release(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return
+        entry.users -= 1
+        if entry.users <= 0:
+            del self.entries[key]
+            if entry.free:
+                entry.free(entry.value)
+
+    # update(value) returns the new value, which can be the same object updated in place
+    def update(self, entry, update):
+        value = update(entry.value)
+        if value is not entry.value and entry.free:
+            entry.free(entry.value)
+        entry.value = value
+        entry.serial += 1
+        self.stats["updates"] += 1
+
+    def get_stats(self):
+        out = dict(self.stats)
+        out["entries"] = len(self.entries)
+        return out
+
+    def clear(self):
+        for entry in self.entries.values():
+            if entry.free:
+                entry.free(entry.value)
+        self.entries.clear()
+        self.stats.clear()
+
+SCENE = SceneCache()
+
+class SceneHandles:
+    # One engine's references into SCENE, with the serial of every entry the engine has seen.
+    # Entries are only shared between engines of the same depsgraph mode: final renders
+    # evaluate with render settings (modifier levels and such) and get their own updates, so
+    # the viewport's entries are none of their business. Previews draw the objects of Blender's
+    # preview scene, which can have the names of this file's. SCENE keys end with the mode.
+    def __init__(self, mode="VIEWPORT"):
+        self.handles = {}
+        self.mode = mode
+
+    def set_mode(self, mode):
+        assert not self.handles, "the mode has to be set before acquiring anything"
+        self.mode = mode
+
+    def acquire(self, key, build, free=None):
+        handle = self.handles.get(key)
+        if handle is None:
+            entry = SCENE.acquire(key + (self.mode,), build, free)
+            self.handles[key] = [entry, entry.serial]
+            return entry.value
+        return handle[0].value
+
+    # For a depsgraph update of key: applies update unless another engine already did
+    def update(self, key, build, update, free=None):
+        handle = self.handles.get(key)
+        if handle is None:
+            return self.acquire(key, build, free)
+        entry, seen = handle
+        if entry.serial != seen:
+            SCENE.stats["skipped_updates"] += 1
+        else:
+            SCENE.update(entry, update)
+        handle[1] = entry.serial
+        return entry.value
+
+    # serial of the entry this engine has seen, None without a handle
+    def get_serial(self, key):
+        handle = self.handles.get(key)
+        return handle[1] if handle else None
+
+    def release(self, key):
+        if self.handles.pop(key, None) is not None:
+            SCENE.release(key + (self.mode,))
+
+    def release_all(self):
+        for key in list(self.handles.keys()):
+            self.release(key)
@@ -0,0 +1,81 @@
+import collections
+import time
+
+class ShaderCache:
+    # Compiled programs keyed by variant, eg. ("light", "SPOT") or ("present", "SCENELIT", True).
+    # Variants are requested up front and compiled a few at a time from view_draw,
+    # callers draw a fallback (or skip the pass) while get() returns None.
+    def __init__(self):
+        self.programs = {}
+        self.pending = collections.OrderedDict()
+        self.failed = set()
+        # (key, message) of failures nobody has shown yet
+        self.errors = []
+        self.requested = 0
+
+    def request(self, key, builder, priority=False):
+        if key in self.programs or key in self.failed:
+            return
+        if key not in self.pending:
+            self.requested += 1
+        self.pending[key] = builder
+        if priority:
+            self.pending.move_to_end(key, last=False)
+
+    def get(self, key):
+        return self.programs.get(key)
+
+    # for passes that can't be drawn without their program, None if it failed to compile
+    def get_or_compile(self, key, builder):
+        program = self.programs.get(key)
+        if program is None and key not in self.failed:
+            if key not in self.pending:
+                self.requested += 1
+            self.pending[key] = builder
+            self.compile(key)
+            program = self.programs.get(key)
+        return program
+
+    def compile(self, key):
+        builder = self.pending.pop(key)
+        try:
+            self.programs[key] = builder()
+        except Exception as e:
+            # keep drawing the fallback instead of retrying every frame
+            self.failed.add(key)
+            self.errors.append((key, str(e)))
+            print(f"Shader variant {key} failed to compile: {e}", flush=True)
+
+    # the failures since the last call, so they're only reported once
+    def pop_errors(self):
+        errors, self.errors = self.errors, []
+        return errors
+
+    # Compiles at least one pending variant, then keeps going until the budget runs out.
+    # Returns True if there is still work left.
+    def compile_pending(self, budget_ms):
+        start = time.perf_counter()
+        while self.pending:
+            self.compile(next(iter(self.pending)))
+            if (time.perf_counter() - start) * 1000.0 >= budget_ms:
+                break
+        return len(self.pending) > 0
+
+    def is_ready(self):
+        return len(self.pending) == 0
+
+    def progress(self):
+        total = self.requested
+        return total - len(self.pending), total
+
+    def reset_progress(self):
+        self.requested = len(self.pending)
+
+    def clear(self):
+        self.programs.clear()
+        self.pending.clear()
+        self.failed.clear()
+        self.errors.clear()
+        self.requested = 0
+
+SHADERS = ShaderCache()
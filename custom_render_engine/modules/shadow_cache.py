@@ -0,0 +1,359 @@
+import collections
+import math
+
+import gpu
+from gpu_extras.batch import batch_for_shader
+import mathutils
+
+from .profiler import PROFILER
+from .shader_cache import SHADERS
+
+VERTEX_SHADOW = """
+    in vec3 position;
+    uniform mat4 matrix_world;
+    uniform mat4 mat_view_projection;
+
+    void main()
+    {
+        gl_Position = mat_view_projection * matrix_world * vec4(position, 1);
+    }
+"""
+
+PIXEL_SHADOW = """
+    void main()
+    {
+    }
+"""
+
+VERTEX_SHADOW_CLEAR = """
+    in vec2 pos;
+
+    void main()
+    {
+        gl_Position = vec4(pos * 2 - 1, 0, 1);
+    }
+"""
+
+PIXEL_SHADOW_CLEAR = """
+    void main()
+    {
+        gl_FragDepth = 1;
+    }
+"""
+
+# matches LocalLightRendering.energy_factor
+LOCAL_LIGHT_ENERGY_FACTOR = 0.09
+# light contributions below this are treated as out of range
+LIGHT_CUTOFF = 1 / 256
+SHADOW_NEAR = 0.05
+
+# point lights render +X, -X, +Y, -Y, +Z, -Z in that order, the light shader picks the face
+# from the major axis of the light to surface vector
+CUBE_FACES = (
+    ((1, 0, 0), (0, -1, 0)),
+    ((-1, 0, 0), (0, -1, 0)),
+    ((0, 1, 0), (0, 0, 1)),
+    ((0, -1, 0), (0, 0, -1)),
+    ((0, 0, 1), (0, -1, 0)),
+    ((0, 0, -1), (0, -1, 0)),
+)
+
+def look_at(eye, direction, up):
+    f = mathutils.Vector(direction).normalized()
+    s = f.cross(mathutils.Vector(up)).normalized()
+    u = s.cross(f)
+    return mathutils.Matrix((
+        (s[0], s[1], s[2], -s.dot(eye)),
+        (u[0], u[1], u[2], -u.dot(eye)),
+        (-f[0], -f[1], -f[2], f.dot(eye)),
+        (0, 0, 0, 1)))
+
+def perspective(fov, near, far):
+    f = 1 / math.tan(fov / 2)
+    return mathutils.Matrix((
+        (f, 0, 0, 0),
+        (0, f, 0, 0),
+        (0, 0, (far + near) / (near - far), 2 * far * near / (near - far)),
+        (0, 0, -1, 0)))
+
+def orthographic(half_size, near, far):
+    return mathutils.Matrix((
+        (1 / half_size, 0, 0, 0),
+        (0, 1 / half_size, 0, 0),
+        (0, 0, -2 / (far - near), -(far + near) / (far - near)),
+        (0, 0, 0, 1)))
+
+# distance at which a local light falls below LIGHT_CUTOFF, its shadow map doesn't need to reach further
+def get_light_radius(light):
+    if light.use_custom_distance:
+        return light.cutoff_distance
+    intensity = light.energy * LOCAL_LIGHT_ENERGY_FACTOR * max(light.color)
+    return max(math.sqrt(max(intensity, 0) / LIGHT_CUTOFF), SHADOW_NEAR * 2)
+
+def get_light_direction(light_object):
+    direction = mathutils.Vector((0, 0, 1))
+    direction.rotate(light_object.matrix_world.decompose()[1])
+    return direction
+
+def spheres_intersect(a, b):
+    if a is None or b is None:
+        return True
+    return (a[0] - b[0]).length <= a[1] + b[1]
+
+def get_scene_bounds(casters):
+    if not casters:
+        return mathutils.Vector((0, 0, 0)), 1.0
+    lo = [min(center[i] - radius for center, radius in casters.values()) for i in range(3)]
+    hi = [max(center[i] + radius for center, radius in casters.values()) for i in range(3)]
+    center = (mathutils.Vector(lo) + mathutils.Vector(hi)) * 0.5
+    return center, max((mathutils.Vector(hi) - center).length, 1e-3)
+
+class ShadowMap:
+    __slots__ = ("name", "tiles", "rects", "view_projections", "bounds", "signature", "dirty", "last_used")
+
+    def __init__(self, name):
+        self.name = name
+        self.tiles = []
+        # uv offset and scale of every tile inside the atlas
+        self.rects = []
+        # one per tile
+        self.view_projections = []
+        # sphere the light can cast shadows in, None for sun lights (the whole scene)
+        self.bounds = None
+        self.signature = None
+        self.dirty = True
+        self.last_used = 0
+
+class ShadowCache:
+    # Shadow maps for every shadow casting light, packed as square tiles into a single depth
+    # atlas. A light's tiles are only rendered again when the light changed, or a caster inside
+    # its bounds did according to the depsgraph. Tiles of lights that haven't been drawn for
+    # a while are the first to go when the atlas runs out of space.
+    def __init__(self):
+        self.atlas = None
+        self.framebuffer = None
+        self.clear_batch = None
+        self.atlas_size = 0
+        self.tile_size = 0
+        self.free_tiles = []
+        self.entries = collections.OrderedDict()
+        self.casters = {}
+        self.caster_transforms = {}
+        self.scene_bounds = (mathutils.Vector((0, 0, 0)), 1.0)
+        self.frame = 0
+        # changes whenever a light's tiles or projections do
+        self.version = 0
+        self.stats = collections.Counter()
+
+    # Largest power of two atlas within the budget (4 bytes per texel), at least one tile
+    def configure(self, budget_mb, tile_size):
+        atlas_size = tile_size
+        while (atlas_size * 2) ** 2 * 4 <= budget_mb * 1024 * 1024:
+            atlas_size *= 2
+        if atlas_size == self.atlas_size and tile_size == self.tile_size:
+            return
+        self.clear()
+        self.atlas_size = atlas_size
+        self.tile_size = tile_size
+        tiles_per_row = atlas_size // tile_size
+        self.free_tiles = [(x * tile_size, y * tile_size) for y in range(tiles_per_row) for x in range(tiles_per_row)]
+        self.free_tiles.reverse()
+
+    def get_atlas(self):
+        if self.atlas is None:
+            self.atlas = gpu.types.GPUTexture((self.atlas_size, self.atlas_size), format="DEPTH_COMPONENT24")
+            self.framebuffer = gpu.types.GPUFrameBuffer(depth_slot=self.atlas)
+        return self.atlas
+
+    # Casters are object name -> world space bounding sphere, transforms are object name ->
+    # matrix_world as a tuple of rows. Lights whose bounds touch a caster that moved, turned,
+    # appeared or disappeared are rendered again, a rotation can keep the bounds as they were.
+    def update_casters(self, casters, transforms=None):
+        transforms = transforms or {}
+        changed = []
+        for name, bounds in casters.items():
+            old = self.casters.get(name)
+            if old is None or old[0] != bounds[0] or old[1] != bounds[1] \
+            or transforms.get(name) != self.caster_transforms.get(name):
+                changed.append(bounds)
+                if old is not None:
+                    changed.append(old)
+        for name, old in self.casters.items():
+            if name not in casters:
+                changed.append(old)
+        self.casters = dict(casters)
+        self.caster_transforms = dict(transforms)
+        if changed:
+            self.scene_bounds = get_scene_bounds(self.casters)
+        for entry in self.entries.values():
+            if entry.dirty:
+                continue
+            if any(spheres_intersect(entry.bounds, bounds) for bounds in changed):
+                entry.dirty = True
+
+    # any change to a caster inside its bounds, eg. deformation
+    def invalidate_caster(self, bounds):
+        for entry in self.entries.values():
+            if spheres_intersect(entry.bounds, bounds):
+                entry.dirty = True
+
+    def get_light_signature(self, light_object):
+        light = light_object.data
+        signature = (light.type, tuple(map(tuple, light_object.matrix_world)), self.tile_size)
+        match light.type:
+            case "SUN":
+                signature += (tuple(self.scene_bounds[0]), self.scene_bounds[1])
+            case "SPOT":
+                signature += (light.spot_size, get_light_radius(light))
+            case _:
+                signature += (get_light_radius(light),)
+        return signature
+
+    def allocate_tiles(self, count):
+        if len(self.free_tiles) < count:
+            # least recently drawn first, never the ones drawn this frame
+            for name in list(self.entries.keys()):
+                entry = self.entries[name]
+                if entry.last_used >= self.frame:
+                    continue
+                self.free_tiles.extend(entry.tiles)
+                del self.entries[name]
+                self.stats["evictions"] += 1
+                if len(self.free_tiles) >= count:
+                    break
+        if len(self.free_tiles) < count:
+            return None
+        return [self.free_tiles.pop() for _ in range(count)]
+
+    # Returns the shadow map for light_object, or None if it doesn't fit in the atlas
+    def get(self, light_object):
+        name = light_object.name
+        entry = self.entries.get(name)
+        if entry is None:
+            tile_count = 6 if light_object.data.type == "POINT" else 1
+            tiles = self.allocate_tiles(tile_count)
+            if tiles is None:
+                self.stats["unallocated"] += 1
+                return None
+            entry = ShadowMap(name)
+            entry.tiles = tiles
+            entry.rects = [self.get_tile_rect(tile) for tile in tiles]
+            self.entries[name] = entry
+            self.version += 1
+        self.entries.move_to_end(name)
+        entry.last_used = self.frame
+
+        signature = self.get_light_signature(light_object)
+        if signature != entry.signature:
+            entry.signature = signature
+            entry.dirty = True
+            self.update_projection(entry, light_object)
+            self.version += 1
+        return entry
+
+    def update_projection(self, entry, light_object):
+        light = light_object.data
+        location = light_object.matrix_world.to_translation()
+        match light.type:
+            case "SUN":
+                center, radius = self.scene_bounds
+                direction = get_light_direction(light_object)
+                up = (0, 1, 0) if abs(direction[2]) > 0.99 else (0, 0, 1)
+                view = look_at(center + direction * radius, -direction, up)
+                entry.view_projections = [orthographic(radius, 0, radius * 2) @ view]
+                entry.bounds = None
+            case "SPOT":
+                radius = get_light_radius(light)
+                direction = -get_light_direction(light_object)
+                up = (0, 1, 0) if abs(direction[2]) > 0.99 else (0, 0, 1)
+                projection = perspective(min(light.spot_size, math.pi * 0.99), SHADOW_NEAR, radius)
+                entry.view_projections = [projection @ look_at(location, direction, up)]
+                entry.bounds = (location, radius)
+            case _:
+                radius = get_light_radius(light)
+                projection = perspective(math.pi / 2, SHADOW_NEAR, radius)
+                entry.view_projections = [projection @ look_at(location, direction, up) for direction, up in CUBE_FACES]
+                entry.bounds = (location, radius)
+
+    # uv offset and scale of a tile inside the atlas
+    def get_tile_rect(self, tile):
+        return (tile[0] / self.atlas_size, tile[1] / self.atlas_size,
+            self.tile_size / self.atlas_size, self.tile_size / self.atlas_size)
+
+    # The shadow maps of a frame's lights as light name -> ShadowMap, with tiles and
+    # projections but nothing rendered. Lights that don't fit in the atlas are left out.
+    def allocate(self, light_objects):
+        self.frame += 1
+        shadow_maps = {}
+        for light_object in light_objects:
+            entry = self.get(light_object)
+            if entry is not None:
+                shadow_maps[light_object.name] = entry
+        return shadow_maps
+
+    # Renders every dirty shadow map the lights need. casters is a list of (matrix_world, batch)
+    # with their world space bounding sphere.
+    def render(self, light_objects, casters):
+        shadow_maps = self.allocate(light_objects)
+        shader = SHADERS.get_or_compile(("shadow",), lambda: gpu.types.GPUShader(VERTEX_SHADOW, PIXEL_SHADOW))
+        clear_shader = SHADERS.get_or_compile(("shadow_clear",), lambda: gpu.types.GPUShader(VERTEX_SHADOW_CLEAR, PIXEL_SHADOW_CLEAR))
+        if not shader or not clear_shader:
+            # the programs failed to compile, nothing casts shadows
+            self.get_atlas()
+            with self.framebuffer.bind():
+                self.framebuffer.clear(depth=1.0)
+            return shadow_maps
+        for entry in shadow_maps.values():
+            if entry.dirty:
+                self.render_shadow_map(entry, casters, shader, clear_shader)
+                entry.dirty = False
+        PROFILER.count("shadow_maps", len(shadow_maps))
+        return shadow_maps
+
+    def render_shadow_map(self, entry, casters, shader, clear_shader):
+        self.get_atlas()
+        if not self.clear_batch:
+            self.clear_batch = batch_for_shader(clear_shader, "TRI_FAN", {"pos": ((0, 0), (1, 0), (1, 1), (0, 1))})
+
+        with self.framebuffer.bind(), PROFILER.span("shadow:" + entry.name, gpu=True):
+            viewport = gpu.state.viewport_get()
+            gpu.state.depth_mask_set(True)
+            gpu.state.face_culling_set("NONE")
+            for tile, view_projection in zip(entry.tiles, entry.view_projections):
+                gpu.state.viewport_set(tile[0], tile[1], self.tile_size, self.tile_size)
+                # only this tile, the rest of the atlas is still valid
+                gpu.state.depth_test_set("ALWAYS")
+                clear_shader.bind()
+                self.clear_batch.draw(clear_shader)
+
+                gpu.state.depth_test_set("LESS")
+                shader.bind()
+                shader.uniform_float("mat_view_projection", view_projection)
+                for matrix_world, batch, bounds in casters:
+                    if not spheres_intersect(entry.bounds, bounds):
+                        continue
+                    shader.uniform_float("matrix_world", matrix_world)
+                    batch.draw(shader)
+                    PROFILER.count("shadow_draw_calls")
+            gpu.state.viewport_set(*viewport)
+        self.stats["renders"] += 1
+        PROFILER.count("shadow_updates")
+
+    def get_bytes(self):
+        return self.atlas_size * self.atlas_size * 4 if self.atlas is not None else 0
+
+    def get_stats(self):
+        out = dict(self.stats)
+        out["shadow_maps"] = len(self.entries)
+        out["free_tiles"] = len(self.free_tiles)
+        out["bytes"] = self.get_bytes()
+        return out
+
+    def clear(self):
+        self.atlas = None
+        self.framebuffer = None
+        self.atlas_size = 0
+        self.tile_size = 0
+        self.free_tiles = []
+        self.entries.clear()
+        self.version += 1
@@ -0,0 +1,188 @@
+import collections
+
+import numpy as np
+
+# Static batching: small meshes that can't deform, aren't instanced and aren't being edited
+# are merged per material into a few large batches with their vertices in world space, so set
+# dressing with thousands of unique props takes a few draw calls instead of one per prop.
+# Every batch keeps each member's vertex and triangle range, its world bounding sphere for
+# culling, and the signature the member had when it was merged. A member that changed or
+# moved only has its own range written again, the batch is merged again when members join
+# or leave it or one of them changes its vertex count.
+
+# a batch takes members until it has this many vertices, so one change doesn't merge the
+# whole scene again
+BATCH_VERTICES = 1 << 18
+
+class StaticBatch:
+    __slots__ = ("key", "signatures", "vertices", "draw", "dirty", "changed")
+
+    def __init__(self, key):
+        self.key = key
+        # member name -> signature, in merge order
+        self.signatures = {}
+        self.vertices = 0
+        self.draw = None
+        self.dirty = True
+        # member name -> signature it was merged or last patched with
+        self.changed = {}
+
+    def add(self, name, vertices, signature):
+        self.signatures[name] = signature
+        self.vertices += vertices
+        self.dirty = True
+
+    def remove(self, name, vertices):
+        del self.signatures[name]
+        self.changed.pop(name, None)
+        self.vertices -= vertices
+        self.dirty = True
+
+    # same vertex count, keeps its place in the batch
+    def change(self, name, signature):
+        self.changed.setdefault(name, self.signatures[name])
+        self.signatures[name] = signature
+
+class StaticBatcher:
+    # The batches of one engine, the draws they're merged from are shared through SCENE
+    def __init__(self):
+        self.batches = []
+        # member name -> (batch, vertices)
+        self.members = {}
+        self.stats = collections.Counter()
+
+    # candidates: name -> (batch key, vertex count, signature) of every object that can be
+    # batched. build(key, names) merges the named objects into a draw. patch(draw, names,
+    # changed) writes the members in changed (name -> previous signature) into the draw
+    # merged from names again, or returns False if it can't and the batch has to be merged.
+    def sync(self, candidates, build, patch):
+        for name, (batch, vertices) in list(self.members.items()):
+            candidate = candidates.get(name)
+            if candidate is None or candidate[0] != batch.key:
+                batch.remove(name, vertices)
+                del self.members[name]
+            elif candidate[1] != vertices:
+                # its range changes size, merged again in the same batch
+                batch.remove(name, vertices)
+                batch.add(name, candidate[1], candidate[2])
+                self.members[name] = (batch, candidate[1])
+            elif candidate[2] != batch.signatures[name]:
+                batch.change(name, candidate[2])
+
+        for name, (key, vertices, signature) in candidates.items():
+            if name in self.members:
+                continue
+            batch = next((batch for batch in self.batches
+                if batch.key == key and batch.vertices + vertices <= BATCH_VERTICES), None)
+            if batch is None:
+                batch = StaticBatch(key)
+                self.batches.append(batch)
+            batch.add(name, vertices, signature)
+            self.members[name] = (batch, vertices)
+
+        self.batches = [batch for batch in self.batches if batch.signatures]
+        for batch in self.batches:
+            if batch.changed and not batch.dirty:
+                if patch(batch.draw, list(batch.signatures), batch.changed):
+                    self.stats["patches"] += 1
+                else:
+                    batch.dirty = True
+            batch.changed = {}
+            if batch.dirty:
+                batch.draw = build(batch.key, list(batch.signatures))
+                batch.dirty = False
+                self.stats["rebuilds"] += 1
+
+    def get_bytes(self):
+        return sum(batch.draw.get_bytes() for batch in self.batches)
+
+    def get_stats(self):
+        out = dict(self.stats)
+        out["batches"] = len(self.batches)
+        out["objects"] = len(self.members)
+        return out
+
+    def clear(self):
+        self.batches = []
+        self.members = {}
+
+# Concatenates the members' loop attributes, with positions, normals and tangents moved to
+# world space by their object's matrix the way the vertex shader would have. Every vertex
+# gets its member's matrix, so the whole batch is transformed at once. Returns the merged
+# draw arrays and each member's vertex and triangle range and world bounding sphere.
+def merge_meshes(draws, matrices):
+    vertex_counts = np.array([len(draw.positions) for draw in draws])
+    triangle_counts = np.array([len(draw.indices) for draw in draws])
+    transforms = np.array(matrices, dtype=np.float32).reshape(-1, 4, 4)
+    member = np.repeat(np.arange(len(draws)), vertex_counts)
+    rotation = transforms[member, :3, :3]
+
+    positions = np.einsum("nij,nj->ni", rotation, np.concatenate([draw.positions for draw in draws]))
+    positions += transforms[member, :3, 3]
+    # not normalized, the vertex shader does that after matrix_world anyway
+    normals = np.einsum("nij,nj->ni", rotation, np.concatenate([draw.normals for draw in draws]))
+    tangents = np.einsum("nij,nj->ni", rotation, np.concatenate([draw.tangents for draw in draws]))
+    static_attributes = {id: np.concatenate([draw.static_attributes[id] for draw in draws])
+        for id in draws[0].static_attributes}
+
+    first_vertices = np.cumsum(vertex_counts) - vertex_counts
+    indices = np.concatenate([draw.indices for draw in draws])
+    indices += np.repeat(first_vertices, triangle_counts).astype(np.uintc)[:, None]
+    first_triangles = np.cumsum(triangle_counts) - triangle_counts
+
+    # like SceneRenderer.get_caster_bounds
+    local_centers = np.array([tuple(draw.bounds_center) for draw in draws], dtype=np.float32).reshape(-1, 3)
+    centers = np.einsum("nij,nj->ni", transforms[:, :3, :3], local_centers) + transforms[:, :3, 3]
+    scales = np.linalg.norm(transforms[:, :3, :3], axis=1).max(axis=1)
+    radii = np.array([draw.bounds_radius for draw in draws], dtype=np.float32) * scales
+
+    return {
+        "first_vertices": first_vertices,
+        "vertex_counts": vertex_counts,
+        "positions": positions.astype(np.float32, copy=False),
+        "normals": normals.astype(np.float32, copy=False),
+        "tangents": tangents.astype(np.float32, copy=False),
+        "static_attributes": static_attributes,
+        "indices": indices,
+        "first_triangles": first_triangles,
+        "triangle_counts": triangle_counts,
+        "centers": centers,
+        "radii": radii,
+    }
+
+# Writes member index of merged (from merge_meshes) again from its draw and matrix, without
+# touching the other members. Only the transformed attributes and the bounding sphere unless
+# geometry is set. False if the member's vertex or triangle count changed, then the batch has
+# to be merged again.
+def patch_member(merged, index, draw, matrix, geometry=True):
+    first, count = merged["first_vertices"][index], merged["vertex_counts"][index]
+    first_triangle, triangles = merged["first_triangles"][index], merged["triangle_counts"][index]
+    if len(draw.positions) != count or len(draw.indices) != triangles:
+        return False
+
+    transform = np.array(matrix, dtype=np.float32).reshape(4, 4)
+    rotation = transform[:3, :3]
+    vertices = slice(first, first + count)
+    merged["positions"][vertices] = np.einsum("ij,nj->ni", rotation, draw.positions) + transform[:3, 3]
+    merged["normals"][vertices] = np.einsum("ij,nj->ni", rotation, draw.normals)
+    merged["tangents"][vertices] = np.einsum("ij,nj->ni", rotation, draw.tangents)
+    if geometry:
+        for id, values in merged["static_attributes"].items():
+            values[vertices] = draw.static_attributes[id]
+        merged["indices"][first_triangle:first_triangle + triangles] = draw.indices + np.uintc(first)
+
+    merged["centers"][index] = rotation @ np.array(tuple(draw.bounds_center), dtype=np.float32) + transform[:3, 3]
+    merged["radii"][index] = draw.bounds_radius * np.linalg.norm(rotation, axis=0).max()
+    return True
+
+# The six planes of view_projection's frustum as (a, b, c, d) rows with unit normals
+# pointing inside (Gribb and Hartmann, "Fast Extraction of Viewing Frustum Planes")
+def get_frustum_planes(view_projection):
+    m = np.array(view_projection, dtype=np.float64)
+    planes = np.stack((m[3] + m[0], m[3] - m[0], m[3] + m[1], m[3] - m[1], m[3] + m[2], m[3] - m[2]))
+    return planes / np.linalg.norm(planes[:, :3], axis=1)[:, None]
+
+# Which of the bounding spheres are at least partly inside the frustum
+def spheres_visible(planes, centers, radii):
+    distances = centers @ planes[:, :3].T + planes[:, 3]
+    return np.all(distances >= -radii[:, None], axis=1)
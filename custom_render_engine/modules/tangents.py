@@ -0,0 +1,103 @@
+import numpy as np
+
+# Tangent space in NumPy, following MikkTSpace (what Mesh.calc_tangents runs) on the loop
+# triangles: every triangle gets a tangent from its UV gradients, corners are welded when
+# their position, normal and UV are the same, and the tangents of a welded corner are summed
+# over its triangles of the same UV orientation, weighted by the corner angle.
+# Only arrays go in, so it runs anywhere, including off the main thread on arrays that were
+# extracted from the mesh before.
+
+# MikkTSpace's NotZero, anything smaller is a degenerate triangle
+EPSILON = 1.1754944e-38
+
+def dot(a, b):
+    return np.einsum("...i,...i->...", a, b)
+
+def normalize(vectors):
+    length = np.sqrt(dot(vectors, vectors))[..., None]
+    return np.divide(vectors, length, out=np.zeros_like(vectors), where=length > EPSILON)
+
+# Index of every row of key among the distinct rows. Sorting 64 bit hashes of the rows is a
+# lot faster than np.unique over the rows, collisions are checked for and fall back to it.
+def weld(key):
+    bits = key.view(np.uint32)
+    hashes = np.full(len(key), 0xcbf29ce484222325, dtype=np.uint64)
+    for column in bits.T:
+        hashes = (hashes ^ column) * np.uint64(0x100000001b3)
+    inverse = np.unique(hashes, return_inverse=True)[1].ravel()
+    first = np.empty(inverse.max() + 1, dtype=np.intp)
+    first[inverse] = np.arange(len(key))
+    if np.array_equal(key[first[inverse]], key):
+        return inverse
+    rows = key.view(np.dtype((np.void, key.dtype.itemsize * key.shape[1]))).ravel()
+    return np.unique(rows, return_inverse=True)[1].ravel()
+
+# Any tangent perpendicular to the normal, for loops without UVs or whose triangles all have
+# degenerate UVs (Duff et al., "Building an Orthonormal Basis, Revisited")
+def get_fallback_tangents(normals):
+    x, y, z = normals[:, 0], normals[:, 1], normals[:, 2]
+    sign = np.where(z >= 0, 1, -1).astype(normals.dtype)
+    a = -1 / (sign + z)
+    b = x * y * a
+    return np.stack((1 + sign * x * x * a, sign * b, -sign * x), axis=1)
+
+# positions, normals (n, 3) and uvs (n, 2) per loop, uvs can be None, triangles (m, 3) loop
+# indices. Returns tangents (n, 3) and bitangent signs (n,) like the loops' tangent and
+# bitangent_sign after calc_tangents. Loops without a usable tangent get one from
+# get_fallback_tangents with a sign of 1.
+def calc_tangents(positions, normals, uvs, triangles):
+    normals = normals.astype(np.float32, copy=False)
+    if uvs is None or not len(triangles):
+        return get_fallback_tangents(normals), np.ones(len(positions), dtype=np.float32)
+
+    triangles = np.asarray(triangles, dtype=np.intp)
+    p = positions[triangles]
+    t = uvs[triangles]
+    d1 = p[:, 1] - p[:, 0]
+    d2 = p[:, 2] - p[:, 0]
+    t21 = t[:, 1] - t[:, 0]
+    t31 = t[:, 2] - t[:, 0]
+    area = t21[:, 0] * t31[:, 1] - t21[:, 1] * t31[:, 0]
+    orient = area > 0
+    tangent = t31[:, 1, None] * d1 - t21[:, 1, None] * d2
+    tangent *= np.where(orient, 1, -1).astype(np.float32)[:, None]
+    tangent = normalize(tangent)
+    degenerate = np.abs(area) <= EPSILON
+
+    # per corner, projected on the corner's normal and weighted by its angle
+    n = normals[triangles]
+    corner = normalize(tangent[:, None] - dot(n, tangent[:, None])[..., None] * n)
+    v1 = p[:, (2, 0, 1)] - p
+    v2 = p[:, (1, 2, 0)] - p
+    v1 = normalize(v1 - dot(n, v1)[..., None] * n)
+    v2 = normalize(v2 - dot(n, v2)[..., None] * n)
+    angle = np.arccos(np.clip(dot(v1, v2), -1, 1))
+    angle[degenerate] = 0
+
+    # welded corners, split by orientation
+    welds = weld(np.ascontiguousarray(np.concatenate((positions, normals, uvs), axis=1), dtype=np.float32))
+    groups = welds[triangles] * 2 + orient[:, None]
+    group_count = (welds.max() + 1) * 2
+    weights = np.bincount(groups.ravel(), weights=angle.ravel(), minlength=group_count)
+    contribution = (corner * angle[..., None]).reshape(-1, 3)
+    summed = np.stack([np.bincount(groups.ravel(), weights=contribution[:, i], minlength=group_count)
+        for i in range(3)], axis=1)
+
+    # triangles with degenerate UVs take the orientation with most weight at each corner
+    corners = welds[triangles[degenerate]]
+    groups[degenerate] = corners * 2 + (weights[corners * 2 + 1] >= weights[corners * 2])
+
+    # loops in more than one triangle (n-gons) are in the same group in all of them, unless
+    # the n-gon's UVs fold over
+    loop_groups = np.full(len(positions), -1, dtype=np.intp)
+    loop_groups[triangles.ravel()] = groups.ravel()
+    tangents = normalize(summed.astype(np.float32))[loop_groups]
+    signs = np.where(loop_groups & 1, 1, -1).astype(np.float32)
+    missing = (loop_groups < 0) | ~np.any(tangents, axis=1)
+    tangents[missing] = get_fallback_tangents(normals[missing])
+    signs[missing] = 1
+    return tangents, signs
+
+# bitangent like the loops' after calc_tangents
+def calc_bitangents(normals, tangents, signs):
+    return signs[:, None] * np.cross(normals, tangents)
@@ -0,0 +1,131 @@
+import time
+
+import gpu
+from gpu_extras.batch import batch_for_shader
+import mathutils
+
+from .profiler import PROFILER
+from .resources import get_shader_source
+from .shader_cache import SHADERS
+
+VERTEX_2D = """
+    in vec2 pos;
+    out vec2 uv;
+
+    void main()
+    {
+        uv = pos;
+        gl_Position = vec4(pos * 2 - 1, 0, 1);
+    }
+"""
+
+def halton(index, base):
+    result = 0.0
+    f = 1.0
+    while index > 0:
+        f /= base
+        result += f * (index % base)
+        index //= base
+    return result
+
+class TemporalAA:
+    # Keeps a history buffer across view_draw calls and blends every new frame into it.
+    # The base pass is rendered with a subpixel jitter so the accumulated history
+    # converges to a supersampled image when the view stands still.
+    def __init__(self, sample_count=8):
+        self.sample_count = sample_count
+        self.batch = None
+        self.history = []
+        self.framebuffers = []
+        self.size = None
+        self.stats = {
+            "resolve_passes": 0,
+            "history_resets": 0,
+            "accumulated_frames": 0,
+            "last_resolve_ms": 0.0,
+        }
+        self.reset()
+
+    # Called on depsgraph changes, the history no longer matches the scene.
+    def reset(self):
+        self.frame_index = 0
+        self.history_valid = False
+        self.current = 0
+        self.prev_view_projection = None
+        self.stats["history_resets"] += 1
+        self.stats["accumulated_frames"] = 0
+
+    @staticmethod
+    def compile_shader():
+        return gpu.types.GPUShader(VERTEX_2D, get_shader_source("TemporalAAPixelShader.glsl"))
+
+    def request_shader(self):
+        SHADERS.request(("taa",), self.compile_shader)
+
+    def ensure_targets(self, size, format):
+        if self.size == size:
+            return
+        self.size = size
+        self.format = format
+        self.history = [gpu.types.GPUTexture(size, format=format) for _ in range(2)]
+        self.framebuffers = [gpu.types.GPUFrameBuffer(color_slots=(tex)) for tex in self.history]
+        self.reset()
+
+    def get_bytes(self):
+        from .gpu_memory import get_texture_bytes
+        return sum(get_texture_bytes(self.size, self.format) for _ in self.history)
+
+    def get_jitter(self):
+        index = self.frame_index % self.sample_count + 1
+        return halton(index, 2) - 0.5, halton(index, 3) - 0.5
+
+    # Offsets the projection by a subpixel amount in NDC, works for both perspective and ortho views.
+    def jitter_projection(self, window_matrix, size):
+        jx, jy = self.get_jitter()
+        offset = mathutils.Matrix.Identity(4)
+        offset[0][3] = jx * 2.0 / size[0]
+        offset[1][3] = jy * 2.0 / size[1]
+        return offset @ window_matrix
+
+    def needs_redraw(self):
+        return self.stats["accumulated_frames"] < self.sample_count
+
+    def resolve(self, tcolor, tdepth, view_projection, feedback):
+        start = time.perf_counter()
+        shader = SHADERS.get(("taa",))
+        if not shader:
+            # still compiling, show the frame as is
+            self.request_shader()
+            return tcolor
+        if not self.batch:
+            self.batch = batch_for_shader(shader, "TRI_FAN", {"pos": ((0, 0), (1, 0), (1, 1), (0, 1))})
+
+        if self.prev_view_projection is not None and self.prev_view_projection != view_projection:
+            # view moved, reprojection keeps the history but it has to converge again
+            self.stats["accumulated_frames"] = 0
+        prev_view_projection = self.prev_view_projection if self.prev_view_projection is not None else view_projection
+
+        history = self.history[self.current]
+        target = self.current ^ 1
+        with self.framebuffers[target].bind():
+            gpu.state.depth_test_set("ALWAYS")
+            gpu.state.blend_set("NONE")
+            shader.bind()
+            shader.uniform_sampler("image", tcolor)
+            shader.uniform_sampler("history", history)
+            shader.uniform_sampler("depth", tdepth)
+            shader.uniform_float("mat_view_projection_inverse", view_projection.inverted())
+            shader.uniform_float("mat_prev_view_projection", prev_view_projection)
+            shader.uniform_float("feedback", feedback)
+            shader.uniform_bool("history_valid", [self.history_valid])
+            PROFILER.count("fullscreen_passes")
+            self.batch.draw(shader)
+
+        self.current = target
+        self.history_valid = True
+        self.prev_view_projection = view_projection.copy()
+        self.frame_index += 1
+        self.stats["accumulated_frames"] += 1
+        self.stats["resolve_passes"] += 1
+        self.stats["last_resolve_ms"] = (time.perf_counter() - start) * 1000.0
+        return self.history[self.current]
@@ -0,0 +1,158 @@
+import collections
+
+import gpu
+
+# mip chain adds about a third on top of the base level
+MIP_FACTOR = 4 / 3
+
+def image_key(image):
+    return image.as_pointer()
+
+# the same image can be cached at full resolution (final renders) and as a proxy (viewport)
+def texture_key(image, max_size=None):
+    from .texture_proxy import needs_proxy
+
+    return image_key(image), (max_size if needs_proxy(image, max_size) else None)
+
+# Changes whenever the image needs to be uploaded again (painted, reloaded, resized, ...)
+def image_signature(image):
+    return (image.name, tuple(image.size), image.is_float, image.is_dirty, image.source, image.filepath_raw)
+
+def estimate_image_bytes(image):
+    width, height = image.size
+    bytes_per_pixel = 16 if image.is_float else 4
+    return int(width * height * bytes_per_pixel * MIP_FACTOR)
+
+class TextureEntry:
+    __slots__ = ("texture", "signature", "bytes", "users", "name")
+
+    def __init__(self, texture, signature, nbytes, name):
+        self.texture = texture
+        self.signature = signature
+        self.bytes = nbytes
+        self.users = 0
+        self.name = name
+
+class TextureCache:
+    # One GPU texture per image datablock, shared by every material using it.
+    # Entries are reference counted, unreferenced ones stay cached (least recently used
+    # first out) until the cache goes over its budget.
+    def __init__(self, budget_mb=2048):
+        self.entries = collections.OrderedDict()
+        self.budget = budget_mb * 1024 * 1024
+        self.fallbacks = {}
+        self.stats = collections.Counter()
+
+    def set_budget(self, budget_mb):
+        self.budget = budget_mb * 1024 * 1024
+        self.evict()
+
+    def get_fallback(self, color):
+        color = tuple(color)
+        texture = self.fallbacks.get(color)
+        if texture is None:
+            texture = gpu.types.GPUTexture((1, 1))
+            texture.clear(format="FLOAT", value=color)
+            self.fallbacks[color] = texture
+        return texture
+
+    def white(self):
+        return self.get_fallback((1, 1, 1, 1))
+
+    def black(self):
+        return self.get_fallback((0, 0, 0, 1))
+
+    # Returns the texture for image, uploading it if it isn't cached or has changed.
+    # With max_size, images larger than that get a downscaled proxy instead.
+    # Every acquire has to be matched by a release of texture_key(image, max_size).
+    def acquire(self, image, max_size=None):
+        key = texture_key(image, max_size)
+        signature = image_signature(image)
+        entry = self.entries.get(key)
+        if entry is not None and entry.signature == signature:
+            self.stats["hits"] += 1
+            self.entries.move_to_end(key)
+        else:
+            self.stats["misses"] += 1
+            users = entry.users if entry else 0
+            if key[1] is not None:
+                from .texture_proxy import create_proxy_texture, estimate_proxy_bytes
+
+                texture = create_proxy_texture(image, key[1])
+                nbytes = estimate_proxy_bytes(image, key[1])
+                self.stats["proxies"] += 1
+            else:
+                texture = gpu.texture.from_image(image)
+                nbytes = estimate_image_bytes(image)
+            entry = TextureEntry(texture, signature, nbytes, image.name)
+            entry.users = users
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            self.stats["uploads"] += 1
+            self.stats["uploaded_bytes"] += nbytes
+        entry.users += 1
+        self.evict()
+        return entry.texture
+
+    def release(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and entry.users > 0:
+            entry.users -= 1
+        self.evict()
+
+    # Called for depsgraph image updates, the next acquire uploads the image again
+    def invalidate(self, image):
+        pointer = image_key(image)
+        for key, entry in self.entries.items():
+            if key[0] == pointer:
+                entry.signature = None
+
+    def evict(self):
+        total = self.get_bytes()
+        if total <= self.budget:
+            return
+        for key in list(self.entries.keys()):
+            entry = self.entries[key]
+            if entry.users > 0:
+                continue
+            total -= entry.bytes
+            del self.entries[key]
+            self.stats["evictions"] += 1
+            self.stats["evicted_bytes"] += entry.bytes
+            if total <= self.budget:
+                break
+
+    # Drops unreferenced textures, least recently used first, until nbytes are freed.
+    # proxies picks downscaled proxies or full resolution textures.
+    def evict_unused(self, nbytes, proxies):
+        freed = 0
+        for key in list(self.entries.keys()):
+            if freed >= nbytes:
+                break
+            entry = self.entries[key]
+            if entry.users > 0 or (key[1] is not None) != proxies:
+                continue
+            freed += entry.bytes
+            del self.entries[key]
+            self.stats["evictions"] += 1
+            self.stats["evicted_bytes"] += entry.bytes
+        return freed
+
+    # proxies=None for all textures, otherwise only proxies or only full resolution ones
+    def get_bytes(self, proxies=None):
+        return sum(entry.bytes for key, entry in self.entries.items() if proxies is None or (key[1] is not None) == proxies)
+
+    def get_stats(self):
+        out = dict(self.stats)
+        out["textures"] = len(self.entries)
+        out["referenced"] = sum(1 for entry in self.entries.values() if entry.users > 0)
+        out["bytes"] = self.get_bytes()
+        out["budget_bytes"] = self.budget
+        return out
+
+    def clear(self):
+        self.entries.clear()
+        self.fallbacks.clear()
+        self.stats.clear()
+
+TEXTURES = TextureCache()
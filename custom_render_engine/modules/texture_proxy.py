@@ -0,0 +1,80 @@
+import hashlib
+import os
+import tempfile
+
+import bpy
+import gpu
+import numpy as np
+
+PROXY_CACHE_DIR = os.path.join(tempfile.gettempdir(), "custom_render_engine", "texture_proxies")
+
+def srgb_to_linear(x):
+    return np.where(x <= 0.04045, x / 12.92, ((x + 0.055) / 1.055) ** 2.4)
+
+def get_proxy_size(width, height, max_size):
+    factor = max(1, -(-max(width, height) // max_size))
+    return factor, -(-width // factor), -(-height // factor)
+
+# Box filter by an integer factor in a single reshape/mean, edges are padded by repeating
+# the last row/column so the output covers the whole image.
+def downscale(pixels, width, height, max_size):
+    factor, out_width, out_height = get_proxy_size(width, height, max_size)
+    pixels = pixels.reshape(height, width, -1)
+    if factor == 1:
+        return pixels
+    pad_y = out_height * factor - height
+    pad_x = out_width * factor - width
+    if pad_x or pad_y:
+        pixels = np.pad(pixels, ((0, pad_y), (0, pad_x), (0, 0)), mode="edge")
+    channels = pixels.shape[2]
+    return pixels.reshape(out_height, factor, out_width, factor, channels).mean(axis=(1, 3), dtype=np.float32)
+
+def get_cache_path(image, max_size):
+    if image.source != "FILE" or image.packed_file or image.is_dirty:
+        return None
+    filepath = bpy.path.abspath(image.filepath_raw, library=image.library)
+    try:
+        mtime = os.path.getmtime(filepath)
+    except OSError:
+        return None
+    key = f"{os.path.normcase(filepath)}|{mtime}|{max_size}|{image.colorspace_settings.name}"
+    return os.path.join(PROXY_CACHE_DIR, hashlib.sha1(key.encode()).hexdigest() + ".npy")
+
+# Returns the downscaled, linear pixels of image as a float16 (height, width, 4) array
+def load_proxy(image, max_size):
+    cache_path = get_cache_path(image, max_size)
+    if cache_path and os.path.exists(cache_path):
+        try:
+            return np.load(cache_path)
+        except (OSError, ValueError):
+            pass
+
+    width, height = image.size
+    pixels = np.empty(width * height * 4, dtype=np.float32)
+    image.pixels.foreach_get(pixels)
+    pixels = pixels.reshape(height, width, 4)
+    # byte images come back still sRGB encoded, filter (and upload) in linear space
+    if not image.is_float and image.colorspace_settings.name == "sRGB":
+        pixels[..., :3] = srgb_to_linear(pixels[..., :3])
+    proxy = downscale(pixels, width, height, max_size).astype(np.float16)
+
+    if cache_path:
+        try:
+            os.makedirs(PROXY_CACHE_DIR, exist_ok=True)
+            np.save(cache_path, proxy)
+        except OSError:
+            pass
+    return proxy
+
+def create_proxy_texture(image, max_size):
+    proxy = load_proxy(image, max_size)
+    height, width = proxy.shape[:2]
+    buffer = gpu.types.Buffer('FLOAT', width * height * 4, proxy.astype("float32").ravel())
+    return gpu.types.GPUTexture((width, height), format="RGBA16F", data=buffer)
+
+def needs_proxy(image, max_size):
+    return max_size is not None and max(image.size) > max_size
+
+def estimate_proxy_bytes(image, max_size):
+    _, width, height = get_proxy_size(image.size[0], image.size[1], max_size)
+    return width * height * 8
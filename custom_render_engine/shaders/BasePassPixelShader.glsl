@@ -22,6 +22,9 @@ uniform int shadingmodel;
 // global parameters
 uniform vec4 outline_color;
 
+// replaced with the generated EvaluateMaterial() for node tree materials
+// NODE_TREE_FUNCTIONS
+
 void main()
 {
 
@@ -33,8 +36,16 @@ void main()
     }
     else
     {
+#ifdef USE_NODE_TREE
+        vec3 NodeBaseColor;
+        vec3 NodeShadowTint;
+        EvaluateMaterial(NodeBaseColor, NodeShadowTint);
+        basecolor = vec4(NodeBaseColor * col_basecolor, 1);
+        shadowcolor = basecolor * vec4(NodeShadowTint, 1);
+#else
         basecolor = vec4(texture(tbasecolor, uv).rgb * col_basecolor, 1);
         shadowcolor = basecolor * vec4(texture(tshadowtint, uv).rgb, 1);
+#endif
         out_shadingmodel = (shadingmodel);
     }
 
@@ -10,24 +10,48 @@ uniform usampler2D tshadingmodel;
 
 out vec4 color;
 
-uniform mat4 mat_view_projection; 
+uniform mat4 mat_view_projection;
 
-#if DIRECTIONAL_LIGHT
-uniform vec3 light_direction;
-#endif
+#define LIGHT_SUN 0
+#define LIGHT_POINT 1
+#define LIGHT_SPOT 2
 
-#if LOCAL_LIGHT
-uniform vec3 light_location;
-uniform float light_radius;
-uniform float light_range;
+// Every light drawn by this pass, packed by light_buffer.py (MAX_LIGHTS and MAX_SHADOW_TILES are
+// defined there). Everything is a vec4 so the std140 layout has no padding to get wrong.
+layout(std140) uniform LightBlock
+{
+    // x: number of lights
+    vec4 light_count;
+    // xyz: location (direction towards the light for suns), w: type
+    vec4 light_position[MAX_LIGHTS];
+    // rgb: color * energy, w: spot size
+    vec4 light_color[MAX_LIGHTS];
+    // xyz: spot direction, w: spot blend
+    vec4 light_spot[MAX_LIGHTS];
+    // x: first shadow tile, y: shadow tile count (0 without shadow map)
+    vec4 light_shadow[MAX_LIGHTS];
+    mat4 shadow_matrix[MAX_SHADOW_TILES];
+    // uv offset and scale of the tile inside the atlas
+    vec4 shadow_rect[MAX_SHADOW_TILES];
+};
 
-uniform vec3 light_spot_direction;
-uniform float light_spot_size;
-uniform float light_spot_blend;
+#if APPLY_SCENE_COLOR
+uniform vec4 scene_color;
 #endif
 
-uniform float energy;
-uniform vec3 light_color;
+#if USE_SHADOW
+#define SHADOW_BIAS 0.0005
+#define SHADOW_NORMAL_OFFSET 0.02
+uniform sampler2D tshadow;
+#endif
+
+// Tiled variants (light_tiles.py) are only drawn on tiles of one class, when that's a single
+// shading model it doesn't have to be read or branched on
+#if defined(TILE_CLASS) && TILE_CLASS == TILE_CLASS_NONE
+#define TILE_SHADINGMODEL SHADINGMODEL_UNLIT
+#elif defined(TILE_CLASS) && TILE_CLASS != TILE_CLASS_MIXED
+#define TILE_SHADINGMODEL TILE_CLASS
+#endif
 
 struct GBufferData
 {
@@ -44,6 +68,7 @@ struct LightData
     float Falloff;
     float Intensity;
     vec3 FinalColor;
+    float Shadow;
 };
 
 float MapRange(float x, float fromMin, float fromMax, float toMin, float toMax)
@@ -58,22 +83,26 @@ float ConeInterp(float x)
 
 float saturate(float x) { return clamp(x, 0.f, 1.f); }
 
-LightData GetLightData(GBufferData GBuffer, vec3 L)
+LightData GetLightData(GBufferData GBuffer, vec3 L, int Index, int Type)
 {
     LightData Out;
-    Out.Color = light_color;
-    Out.Intensity = energy;
-#if POINT_LIGHT || SPOT_LIGHT
-    float Dist = length(light_location - GBuffer.WorldPos);
-    Out.Falloff = 1 / (Dist * Dist);
-    #if SPOT_LIGHT
-        float ConeFalloff = clamp(MapRange(1 - dot(L, light_spot_direction), ConeInterp(light_spot_size), 0, 0, 1), 0, 1);
-        Out.Falloff *= smoothstep(0, light_spot_blend, ConeFalloff);
-    #endif
-#else
-    Out.Falloff = 1;
-#endif
-    Out.FinalColor = light_color * energy * Out.Falloff;
+    Out.Color = light_color[Index].rgb;
+    Out.Intensity = 1;
+    if (Type != LIGHT_SUN)
+    {
+        float Dist = length(light_position[Index].xyz - GBuffer.WorldPos);
+        Out.Falloff = 1 / (Dist * Dist);
+        if (Type == LIGHT_SPOT)
+        {
+            float ConeFalloff = clamp(MapRange(1 - dot(L, light_spot[Index].xyz), ConeInterp(light_color[Index].w), 0, 0, 1), 0, 1);
+            Out.Falloff *= smoothstep(0, light_spot[Index].w, ConeFalloff);
+        }
+    }
+    else
+    {
+        Out.Falloff = 1;
+    }
+    Out.FinalColor = Out.Color * Out.Falloff;
     return Out;
 }
 
@@ -81,7 +110,7 @@ vec3 ScreenToWorldPos(vec2 ScreenCoords)
 {
     vec4 pos;
     pos.w = 1;
-    pos.xy = uv * 2 - 1;
+    pos.xy = ScreenCoords * 2 - 1;
     pos.z = texture(tdepth, ScreenCoords).r * 2 - 1;
     pos = inverse(mat_view_projection) * pos;
     pos /= pos.w;
@@ -95,8 +124,12 @@ GBufferData SampleScreenTextures(vec2 ScreenCoords)
     OutBuffer.ShadowColor = texture(tshadowcolor, ScreenCoords).rgb;
     OutBuffer.WorldNormal = texture(tworldnormal, ScreenCoords).rgb;
     OutBuffer.WorldPos = ScreenToWorldPos(ScreenCoords);
+#ifdef TILE_SHADINGMODEL
+    OutBuffer.ShadingModel = uint(TILE_SHADINGMODEL);
+#else
     uint shadingmodel = texture(tshadingmodel, ScreenCoords).r;
     OutBuffer.ShadingModel = shadingmodel;
+#endif
     return OutBuffer;
 }
 
@@ -108,23 +141,229 @@ vec3 GetDirectLighting(GBufferData GBuffer, float NdotL, LightData Light)
         case SHADINGMODEL_UNLIT:
             return vec3(0);
         case SHADINGMODEL_LAMBERT:
-            return GBuffer.BaseColor * saturate(NdotL) * Light.FinalColor;
+            return GBuffer.BaseColor * saturate(NdotL) * Light.Shadow * Light.FinalColor;
         case SHADINGMODEL_TOON:
-            return mix(GBuffer.ShadowColor, GBuffer.BaseColor, ceil(NdotL)) * Light.FinalColor;
+            // shadowed areas get the shadow color, not black
+            return mix(GBuffer.ShadowColor, GBuffer.BaseColor, saturate(ceil(NdotL)) * Light.Shadow) * Light.FinalColor;
+    }
+}
+
+#if USE_SHADOW
+// 3x3 PCF inside one atlas tile, points outside the tile's frustum are lit
+float SampleShadow(int Tile, vec3 WorldPos)
+{
+    vec4 p = shadow_matrix[Tile] * vec4(WorldPos, 1);
+    p.xyz = p.xyz / p.w * 0.5 + 0.5;
+    if (any(lessThan(p.xyz, vec3(0))) || any(greaterThan(p.xyz, vec3(1))))
+    {
+        return 1;
+    }
+    vec4 Rect = shadow_rect[Tile];
+    vec2 texel = 1.0 / vec2(textureSize(tshadow, 0));
+    vec2 center = Rect.xy + p.xy * Rect.zw;
+    vec2 lo = Rect.xy + texel * 0.5;
+    vec2 hi = Rect.xy + Rect.zw - texel * 0.5;
+    float lit = 0;
+    for (int x = -1; x <= 1; x++)
+    {
+        for (int y = -1; y <= 1; y++)
+        {
+            vec2 coords = clamp(center + vec2(x, y) * texel, lo, hi);
+            lit += (p.z - SHADOW_BIAS > texture(tshadow, coords).r) ? 0.0 : 1.0;
+        }
+    }
+    return lit / 9;
+}
+
+float GetShadow(GBufferData GBuffer, vec3 L, int Index)
+{
+    int TileCount = int(light_shadow[Index].y);
+    if (TileCount == 0)
+    {
+        // no shadows or didn't fit in the shadow atlas
+        return 1;
+    }
+    int Tile = int(light_shadow[Index].x);
+    vec3 WorldPos = GBuffer.WorldPos + GBuffer.WorldNormal * SHADOW_NORMAL_OFFSET;
+    if (TileCount == 6)
+    {
+        // point light, cube face from the major axis of the light to surface vector
+        vec3 D = -L;
+        vec3 A = abs(D);
+        if (A.x >= A.y && A.x >= A.z)
+        {
+            Tile += D.x > 0 ? 0 : 1;
+        }
+        else if (A.y >= A.z)
+        {
+            Tile += D.y > 0 ? 2 : 3;
+        }
+        else
+        {
+            Tile += D.z > 0 ? 4 : 5;
+        }
     }
+    return SampleShadow(Tile, WorldPos);
 }
+#endif
+
+#if APPLY_SCENE_COLOR
+// same as the scene lighting pass, for when it's merged into the lighting pass
+vec3 GetSceneColor(vec2 ScreenCoords)
+{
+    vec4 tex = texture(tbasecolor, ScreenCoords);
+#ifdef TILE_SHADINGMODEL
+    uint shadingmodel = uint(TILE_SHADINGMODEL);
+#else
+    uint shadingmodel = texture(tshadingmodel, ScreenCoords).r;
+#endif
+    if (shadingmodel != SHADINGMODEL_UNLIT)
+    {
+        return tex.rgb * scene_color.rgb;
+    }
+#if BACKGROUND_COLOR
+    return mix(tex.rgb, scene_color.rgb, 1 - tex.a);
+#else
+    return mix(tex.rgb, vec3(.05), 1 - tex.a);
+#endif
+}
+#endif
+
+vec3 GetLighting(GBufferData GBuffer)
+{
+    vec3 Lighting = vec3(0);
+    int LightCount = int(light_count.x);
+    for (int i = 0; i < LightCount; i++)
+    {
+        int Type = int(light_position[i].w);
+        vec3 L;
+        if (Type == LIGHT_SUN)
+        {
+            L = light_position[i].xyz;
+        }
+        else
+        {
+            L = normalize(light_position[i].xyz - GBuffer.WorldPos);
+        }
+        LightData Light = GetLightData(GBuffer, L, i, Type);
+#if USE_SHADOW
+        Light.Shadow = GetShadow(GBuffer, L, i);
+#else
+        Light.Shadow = 1;
+#endif
+        float NdotL = dot(GBuffer.WorldNormal, L);
+        Lighting += GetDirectLighting(GBuffer, NdotL, Light);
+    }
+    return Lighting;
+}
+
+#if UPSAMPLE_LIGHTING
+// Lighting accumulated at 1 / LIGHTING_SCALE resolution, texel j holds the lighting of the full
+// resolution pixel j * LIGHTING_SCALE. upsample_reference() in lighting_upsample.py is the
+// same on the CPU.
+uniform sampler2D tlighting;
+// x, y: [2][2] and [2][3] of the window matrix, z: 1 for perspective views
+uniform vec3 depth_linearize;
+#if !APPLY_SCENE_COLOR
+// 0 for the passes of the other light blocks, they only add to the edges
+uniform int apply_upsampled;
+#endif
+
+float LinearDepth(float Depth)
+{
+    float z = Depth * 2 - 1;
+    return depth_linearize.z > 0 ? depth_linearize.y / (z + depth_linearize.x) : (depth_linearize.y - z) / depth_linearize.x;
+}
+
+// Bilinear weights times how close the low resolution samples are in depth and normal.
+// Returns false where it can't be upsampled: a sample is from another surface or shading
+// model, or the samples differ too much in brightness (toon terminators, shadow edges).
+bool UpsampleLighting(GBufferData GBuffer, ivec2 Pixel, out vec3 Lighting)
+{
+    ivec2 Size = textureSize(tdepth, 0);
+    ivec2 LowSize = textureSize(tlighting, 0);
+    ivec2 Base = Pixel / LIGHTING_SCALE;
+    vec2 f = vec2(Pixel - Base * LIGHTING_SCALE) / float(LIGHTING_SCALE);
+    float Depth = LinearDepth(texelFetch(tdepth, Pixel, 0).r);
+    vec3 Sum = vec3(0);
+    float WeightSum = 0;
+    float LumaMin = 1e10;
+    float LumaMax = 0;
+    Lighting = vec3(0);
+    for (int i = 0; i < 4; i++)
+    {
+        ivec2 Offset = ivec2(i & 1, i >> 1);
+        float Bilinear = (Offset.x == 1 ? f.x : 1 - f.x) * (Offset.y == 1 ? f.y : 1 - f.y);
+        if (Bilinear <= 0)
+        {
+            continue;
+        }
+        ivec2 Low = min(Base + Offset, LowSize - 1);
+        ivec2 Source = min(Low * LIGHTING_SCALE, Size - 1);
+        float SampleDepth = LinearDepth(texelFetch(tdepth, Source, 0).r);
+        vec3 SampleNormal = texelFetch(tworldnormal, Source, 0).rgb;
+        float Weight = max(0, 1 - abs(SampleDepth - Depth) / (UPSAMPLE_DEPTH_TOLERANCE * Depth))
+            * pow(max(dot(SampleNormal, GBuffer.WorldNormal), 0), UPSAMPLE_NORMAL_POWER);
+        if (texelFetch(tshadingmodel, Source, 0).r != GBuffer.ShadingModel || Weight < UPSAMPLE_MIN_WEIGHT)
+        {
+            return false;
+        }
+        vec4 Sample = texelFetch(tlighting, Low, 0);
+        LumaMin = min(LumaMin, Sample.a);
+        LumaMax = max(LumaMax, Sample.a);
+        Sum += Sample.rgb * Bilinear * Weight;
+        WeightSum += Bilinear * Weight;
+    }
+    if (LumaMax - LumaMin > UPSAMPLE_EDGE_CONTRAST * LumaMax + UPSAMPLE_EDGE_BIAS)
+    {
+        return false;
+    }
+    Lighting = Sum / WeightSum;
+    return true;
+}
+#endif
+
+#if defined(LIGHTING_SCALE) && !UPSAMPLE_LIGHTING
+// low resolution pass, each pixel is lit like the full resolution pixel at its corner
+#define SCREEN_COORDS ((floor(gl_FragCoord.xy) * LIGHTING_SCALE + 0.5) / vec2(textureSize(tdepth, 0)))
+#else
+#define SCREEN_COORDS uv
+#endif
 
 void main()
 {
-    GBufferData GBuffer = SampleScreenTextures(uv);
-    float NdotL = 0;
-#if DIRECTIONAL_LIGHT
-    vec3 L = light_direction;
-#elif POINT_LIGHT || SPOT_LIGHT
-    vec3 L = normalize(light_location - GBuffer.WorldPos);
-#endif
-    LightData Light = GetLightData(GBuffer, L);
-    NdotL = dot(GBuffer.WorldNormal, L);
-    color.rgb = GetDirectLighting(GBuffer, NdotL, Light);
-    color.a = 1;
-}
\ No newline at end of file
+    vec2 ScreenCoords = SCREEN_COORDS;
+    color.rgb = vec3(0);
+#if !defined(TILE_SHADINGMODEL) || TILE_SHADINGMODEL != SHADINGMODEL_UNLIT
+    GBufferData GBuffer = SampleScreenTextures(ScreenCoords);
+    if (GBuffer.ShadingModel != SHADINGMODEL_UNLIT)
+    {
+#if UPSAMPLE_LIGHTING
+        vec3 Upsampled;
+        if (UpsampleLighting(GBuffer, ivec2(gl_FragCoord.xy), Upsampled))
+        {
+#if !APPLY_SCENE_COLOR
+            if (apply_upsampled == 0)
+            {
+                // the upsampled lighting of the first pass already has every light
+                discard;
+            }
+#endif
+            color.rgb = Upsampled;
+        }
+        else
+        {
+            // edges are lit at full resolution
+            color.rgb = GetLighting(GBuffer);
+        }
+#else
+        color.rgb = GetLighting(GBuffer);
+#endif
+    }
+#endif
+#if APPLY_SCENE_COLOR
+    color.rgb += GetSceneColor(ScreenCoords);
+#endif
+    // luma is linear, so blending passes additively also accumulates the luma FXAA needs
+    color.a = dot(color.rgb, vec3(0.3, 0.59, 0.11));
+}
@@ -3,6 +3,7 @@
 layout(triangles) in;
 layout(triangle_strip, max_vertices = 6) out;
 
+in vec4 world_position[];
 in vec4 vertex_color[];
 in vec3 world_normal[];
 in vec3 world_tangent[];
@@ -16,6 +17,9 @@ out vec2 uv;
 out vec3 view;
 out float outline;
 
+// the surface keeps the vertex shader's gl_Position, which the depth pre-pass computes the same way
+invariant gl_Position;
+
 uniform mat4 mat_view_projection;
 
 uniform bool render_outlines;
@@ -47,12 +51,12 @@ vec4 offset_vertex(vec4 position, vec3 normal, vec3 tangent, float tangent_sign,
 
 void emit_original_vertex(int index)
 {
-    gl_Position = mat_view_projection * gl_in[index].gl_Position;
+    gl_Position = gl_in[index].gl_Position;
     normal = world_normal[index];
     tangent = world_tangent[index];
     vcolor = vertex_color[index];
     uv = texcoord[index];
-    view = normalize((view_location - gl_in[index].gl_Position).xyz);
+    view = normalize((view_location - world_position[index]).xyz);
     EmitVertex();
 }
 
@@ -67,11 +71,11 @@ void main()
     if (render_outlines)
     {
         outline = 1;
-        gl_Position = mat_view_projection * offset_vertex(gl_in[2].gl_Position, world_normal[2], world_tangent[2], tangent_sign[2], vertex_color[2]);
+        gl_Position = mat_view_projection * offset_vertex(world_position[2], world_normal[2], world_tangent[2], tangent_sign[2], vertex_color[2]);
         EmitVertex();
-        gl_Position = mat_view_projection * offset_vertex(gl_in[1].gl_Position, world_normal[1], world_tangent[1], tangent_sign[1], vertex_color[1]);
+        gl_Position = mat_view_projection * offset_vertex(world_position[1], world_normal[1], world_tangent[1], tangent_sign[1], vertex_color[1]);
         EmitVertex();
-        gl_Position = mat_view_projection * offset_vertex(gl_in[0].gl_Position, world_normal[0], world_tangent[0], tangent_sign[0], vertex_color[0]);
+        gl_Position = mat_view_projection * offset_vertex(world_position[0], world_normal[0], world_tangent[0], tangent_sign[0], vertex_color[0]);
         EmitVertex();
         EndPrimitive();
     }
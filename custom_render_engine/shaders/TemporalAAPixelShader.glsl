@@ -0,0 +1,52 @@
+uniform sampler2D image;
+uniform sampler2D history;
+uniform sampler2D depth;
+in vec2 uv;
+out vec4 color;
+
+// current frame, without jitter
+uniform mat4 mat_view_projection_inverse;
+uniform mat4 mat_prev_view_projection;
+uniform float feedback;
+uniform bool history_valid;
+
+vec2 Reproject(vec2 ScreenCoords)
+{
+    vec4 pos;
+    pos.w = 1;
+    pos.xy = ScreenCoords * 2 - 1;
+    pos.z = texture(depth, ScreenCoords).r * 2 - 1;
+    pos = mat_view_projection_inverse * pos;
+    pos /= pos.w;
+    vec4 prev = mat_prev_view_projection * pos;
+    return prev.xy / prev.w * 0.5 + 0.5;
+}
+
+void main()
+{
+    vec2 texel = 1.0 / vec2(textureSize(image, 0));
+    vec3 current = texture(image, uv).rgb;
+
+    // neighborhood clamping, rejects history that doesn't match what's on screen now
+    vec3 cmin = current;
+    vec3 cmax = current;
+    for (int x = -1; x <= 1; ++x)
+    {
+        for (int y = -1; y <= 1; ++y)
+        {
+            vec3 s = texture(image, uv + vec2(x, y) * texel).rgb;
+            cmin = min(cmin, s);
+            cmax = max(cmax, s);
+        }
+    }
+
+    vec2 prev_uv = Reproject(uv);
+    if (!history_valid || any(lessThan(prev_uv, vec2(0))) || any(greaterThan(prev_uv, vec2(1))))
+    {
+        color = vec4(current, 1);
+        return;
+    }
+
+    vec3 hist = clamp(texture(history, prev_uv).rgb, cmin, cmax);
+    color = vec4(mix(current, hist, feedback), 1);
+}
@@ -7,6 +7,7 @@ in float bitangent_sign;
 in vec4 color;
 in vec2 uv;
 
+out vec4 world_position;
 out vec4 vertex_color;
 out vec3 world_normal;
 out vec3 world_tangent;
@@ -14,10 +15,17 @@ out float tangent_sign;
 out vec2 texcoord;
 
 uniform mat4 matrix_world;
+uniform mat4 mat_view_projection;
+
+// the depth pre-pass (VERTEX_DEPTH) computes the same gl_Position, the geometry shader
+// emits it as is so both passes come to the same depth
+invariant gl_Position;
 
 void main()
 {
-    gl_Position = matrix_world * vec4(position, 1);
+    vec4 world = matrix_world * vec4(position, 1);
+    gl_Position = mat_view_projection * world;
+    world_position = world;
     world_normal = normalize((matrix_world * vec4(normal, 0)).xyz);
     world_tangent = normalize((matrix_world * vec4(tangent, 0)).xyz);
     tangent_sign = bitangent_sign;
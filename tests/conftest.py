@@ -0,0 +1,13 @@
+# The add-on's pure Python and NumPy modules, tested under plain CPython with the benchmark
+# stubs standing in for bpy, gpu and mathutils (see benchmarks/stubs.py)
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from benchmarks.run import import_addon
+
+import_addon()
@@ -0,0 +1,47 @@
+import os
+
+import numpy as np
+
+from benchmarks import golden
+from modules import cpu_raster
+
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks", "golden")
+
+def get_coverage(clip, size):
+    triangles = cpu_raster.setup_triangles(np.asarray(clip, dtype=np.float64), size)
+    coverage = np.zeros((size[1], size[0]), dtype=np.int64)
+    for _, px, py, _, _ in cpu_raster.rasterize(triangles, (0, 0, *size)):
+        np.add.at(coverage, (py, px), 1)
+    return coverage
+
+def test_shared_edges_cover_every_pixel_once():
+    corners = [(-1, -1, 0.5, 1), (1, -1, 0.5, 1), (1, 1, 0.5, 1), (-1, 1, 0.5, 1)]
+    quad = [[corners[0], corners[1], corners[2]], [corners[0], corners[2], corners[3]]]
+    assert np.all(get_coverage(quad, (16, 9)) == 1)
+    # a fan around a vertex in the middle of the image
+    center = (0.1, -0.05, 0.5, 1)
+    fan = [[corners[i], corners[(i + 1) % 4], center] for i in range(4)]
+    assert np.all(get_coverage(fan, (31, 17)) == 1)
+
+def test_back_faces_are_culled():
+    triangle = [[(-1, -1, 0.5, 1), (1, 1, 0.5, 1), (1, -1, 0.5, 1)]]
+    assert not get_coverage(triangle, (8, 8)).any()
+
+def test_triangles_behind_the_near_plane_are_clipped():
+    # one corner behind the camera (w < 0), the rest still covers part of the image
+    triangle = [[(-1, -1, 0.5, 1), (1, -1, 0.5, 1), (0, 1, -2, -1)]]
+    clip, _, source = cpu_raster.clip_near(np.asarray(triangle, dtype=np.float64))
+    assert len(clip) >= 1 and np.all(source == 0)
+    assert np.all(clip[..., 3] > 0)
+
+def test_tiles_cover_the_image():
+    covered = np.zeros((50, 70), dtype=np.int64)
+    for x0, y0, x1, y1 in cpu_raster.get_tiles(70, 50, 16):
+        covered[y0:y1, x0:x1] += 1
+    assert np.all(covered == 1)
+
+def test_golden_images(tmp_path):
+    # the same pixels as the committed images, and with threads and another tile size
+    output = str(tmp_path / "golden.json")
+    assert golden.main(["--check", GOLDEN_DIR, "--scenes", "many_lights", "tilted", "--threads", "2",
+        "--tile-size", "37", "-o", output]) == 0
@@ -0,0 +1,90 @@
+import pytest
+
+from modules.frame_graph import FrameGraph, TexturePool
+
+def make_pool():
+    return TexturePool(allocate=lambda size, format: object(), max_age=1)
+
+def test_framebuffers_are_kept_with_their_targets():
+    pool = make_pool()
+    depth = pool.acquire((4, 4), "DEPTH_COMPONENT24")
+    framebuffer = pool.get_framebuffer(depth_slot=depth)
+    assert pool.get_framebuffer(depth_slot=depth) is framebuffer
+    # the same texture as a color target is another framebuffer
+    assert pool.get_framebuffer(color_slots=(depth,)) is not framebuffer
+    pool.release((4, 4), "DEPTH_COMPONENT24", depth)
+    pool.end_frame()
+    assert pool.acquire((4, 4), "DEPTH_COMPONENT24") is depth
+    assert pool.get_framebuffer(depth_slot=depth) is framebuffer
+
+def test_framebuffers_are_dropped_with_their_targets():
+    pool = make_pool()
+    depth = pool.acquire((4, 4), "DEPTH_COMPONENT24")
+    pool.get_framebuffer(depth_slot=depth)
+    pool.release((4, 4), "DEPTH_COMPONENT24", depth)
+    for _ in range(3):
+        pool.end_frame()
+    assert pool.get_texture_count() == 0
+    assert pool.framebuffers == {}
+
+def make_chain():
+    # a -> b -> c -> viewport, every pass reading the one before
+    graph = FrameGraph()
+    for name in "abc":
+        graph.create_texture(name, (8, 8), "RGBA16F")
+    graph.import_texture("viewport")
+    graph.add_pass("first", writes=("a",))
+    graph.add_pass("second", reads=("a",), writes=("b",))
+    graph.add_pass("third", reads=("b",), writes=("c",))
+    graph.add_pass("present", reads=("c",), writes=("viewport",), side_effect=True)
+    return graph
+
+def test_passes_nothing_reads_are_culled():
+    graph = make_chain()
+    graph.create_texture("debug", (8, 8), "RGBA16F")
+    graph.add_pass("debug", reads=("a",), writes=("debug",))
+    compiled = graph.compile()
+    assert [p.name for p in compiled.passes] == ["first", "second", "third", "present"]
+    assert [p.name for p in compiled.culled] == ["debug"]
+    assert "debug" not in compiled.aliases
+
+def test_disjoint_lifetimes_share_targets():
+    compiled = make_chain().compile()
+    # a ends where c starts, b overlaps both
+    assert compiled.aliases["a"] == compiled.aliases["c"]
+    assert compiled.aliases["a"] != compiled.aliases["b"]
+    assert len(compiled.slots) == 2
+    assert "viewport" not in compiled.aliases
+
+def test_targets_of_other_sizes_and_formats_are_not_shared():
+    graph = FrameGraph()
+    graph.create_texture("a", (8, 8), "RGBA16F")
+    graph.create_texture("b", (8, 8), "R8UI")
+    graph.create_texture("c", (4, 4), "RGBA16F")
+    graph.import_texture("out")
+    graph.add_pass("a", writes=("a",))
+    graph.add_pass("b", reads=("a",), writes=("b",))
+    graph.add_pass("c", reads=("b",), writes=("c",))
+    graph.add_pass("out", reads=("c",), writes=("out",), side_effect=True)
+    assert len(set(graph.compile().aliases.values())) == 3
+
+def test_undeclared_and_duplicate_textures():
+    graph = FrameGraph()
+    graph.create_texture("a", (8, 8), "RGBA16F")
+    with pytest.raises(ValueError):
+        graph.create_texture("a", (8, 8), "RGBA16F")
+    with pytest.raises(ValueError):
+        graph.add_pass("reads", reads=("missing",))
+
+def test_execute_reuses_pooled_targets():
+    pool = make_pool()
+    seen = []
+    for _ in range(2):
+        graph = make_chain()
+        graph.passes[2].execute = lambda res: seen.append((res["a"], res["b"], res["c"]))
+        graph.execute(pool)
+    # the second frame gets the first frame's targets back, in any order
+    assert pool.allocations == 2
+    assert set(map(id, seen[0])) == set(map(id, seen[1]))
+    for a, b, c in seen:
+        assert a is c and a is not b
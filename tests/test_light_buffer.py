@@ -0,0 +1,40 @@
+import numpy as np
+
+from benchmarks import stubs
+from benchmarks.synthetic import FakeLight, FakeObject
+from modules.custom_render_engine import DirectionalLightRendering, LocalLightRendering
+from modules.light_buffer import LightBuffer, MAX_LIGHTS, pack_lights
+
+def make_lights(count):
+    lights = []
+    for i in range(count):
+        type = ("SUN", "POINT", "SPOT")[i % 3]
+        object = FakeObject(f"Light.{i:03d}", "LIGHT", FakeLight(f"Light.{i:03d}", type), stubs.Matrix.Translation((i, 0, 5)))
+        lights.append((DirectionalLightRendering if type == "SUN" else LocalLightRendering)(object))
+    return lights
+
+def test_blocks_hold_max_lights():
+    blocks = pack_lights(make_lights(MAX_LIGHTS + 3), {})
+    assert [int(block["light_count"][0]) for block in blocks] == [MAX_LIGHTS, 3]
+
+def test_unchanged_lights_are_not_packed_again():
+    buffer = LightBuffer()
+    lights = make_lights(3)
+    assert buffer.update(lights, {}, 0)
+    assert not buffer.update(lights, {}, 0)
+    assert buffer.update(lights, {}, 1)
+    assert buffer.update(make_lights(3), {}, 1)
+
+def test_light_settings_are_packed_again():
+    buffer = LightBuffer()
+    lights = make_lights(3)
+    buffer.update(lights, {}, 0)
+    spot = lights[2].object.data
+    spot.energy = 20.0
+    spot.spot_blend = 0.5
+    # the same lights, nothing was created again
+    assert buffer.update(lights, {}, 0)
+    block = buffer.blocks[0]
+    assert np.allclose(block["light_color"][2][:3], 20.0 * lights[2].energy_factor)
+    assert np.isclose(block["light_spot"][2][3], 0.5)
+    assert buffer.get_light_count() == 3
@@ -0,0 +1,46 @@
+import math
+
+import numpy as np
+from mathutils import Matrix, Vector
+
+from modules.lod import projected_size, select_lod, generate_lods
+
+def get_projection(fov=50.0, near=0.1, far=100.0):
+    f = 1.0 / math.tan(math.radians(fov) / 2)
+    return Matrix((
+        (f, 0, 0, 0),
+        (0, f, 0, 0),
+        (0, 0, (far + near) / (near - far), 2 * far * near / (near - far)),
+        (0, 0, -1, 0)))
+
+def test_projected_size_independent_of_view_orientation():
+    projection = get_projection()
+    # top view looking down -Z, and a front view looking down +Y with Z up, both 10 away
+    top = Matrix.Translation((0, 0, -10))
+    front = Matrix(((1, 0, 0, 0), (0, 0, 1, 0), (0, -1, 0, -10), (0, 0, 0, 1)))
+    center = Vector((0, 0, 0))
+    top_size = projected_size(center, 1.0, projection @ top, projection, 1000)
+    front_size = projected_size(center, 1.0, projection @ front, projection, 1000)
+    assert top_size > 0
+    assert math.isclose(top_size, front_size)
+    assert math.isclose(top_size, projection[1][1] / 10 * 1000)
+
+def test_select_lod_halves_per_level():
+    assert select_lod(300, 256, 3) == 0
+    assert select_lod(200, 256, 3) == 1
+    assert select_lod(100, 256, 3) == 2
+    assert select_lod(1, 256, 3) == 3
+
+def test_generate_lods_reduces_triangles():
+    n = 32
+    x, y = np.meshgrid(np.linspace(0, 1, n + 1), np.linspace(0, 1, n + 1))
+    positions = np.stack((x.ravel(), y.ravel(), np.zeros(x.size)), axis=1).astype(np.float32)
+    quads = np.array([(i * (n + 1) + j) for i in range(n) for j in range(n)])
+    indices = np.concatenate((np.stack((quads, quads + 1, quads + n + 2), axis=1),
+        np.stack((quads, quads + n + 2, quads + n + 1), axis=1))).astype(np.uintc)
+    lods = generate_lods(positions, indices, 3)
+    assert lods
+    counts = [len(indices)] + [len(triangles) for triangles in lods]
+    assert counts == sorted(counts, reverse=True) and len(set(counts)) == len(counts)
+    for triangles in lods:
+        assert triangles.dtype == np.uintc and triangles.max() < len(positions)
@@ -0,0 +1,40 @@
+import types
+
+import pytest
+
+from benchmarks import stubs, synthetic
+from modules.custom_render_engine import CustomRenderEngine, CustomRenderEngineSettings
+from modules.material_preview import PREVIEWS
+
+@pytest.fixture(autouse=True)
+def clear_previews():
+    PREVIEWS.clear()
+    yield
+    PREVIEWS.clear()
+
+def make_preview_scene(collection):
+    settings = stubs.settings_from(CustomRenderEngineSettings)
+    scene = synthetic.Scene(2, 2, 1, 0, 4, settings)
+    scene.render.resolution_x = scene.render.resolution_y = 32
+    for object in scene.objects:
+        object.users_collection = [types.SimpleNamespace(name=collection)]
+    return scene
+
+def render_preview(scene):
+    engine = CustomRenderEngine()
+    engine.is_preview = True
+    engine.render(scene.depsgraph())
+    return engine.result
+
+def test_material_previews_are_cached():
+    scene = make_preview_scene("Sphere")
+    render_preview(scene)
+    assert PREVIEWS.get_stats()["previews"] == 1
+    render_preview(scene)
+    assert PREVIEWS.get_stats()["hits"] == 1
+
+def test_light_previews_draw_the_scene():
+    scene = make_preview_scene("Lamp")
+    result = render_preview(scene)
+    assert PREVIEWS.get_stats()["previews"] == 0
+    assert result.layers[0].passes["Combined"].rect.data.size == 32 * 32 * 4
@@ -0,0 +1,20 @@
+import math
+
+import numpy as np
+
+from benchmarks.synthetic import FakeMesh
+from modules.custom_render_engine import BasePassRendering, MeshMaterialShader
+
+def test_deformed_mesh_bounds_follow_the_deformation():
+    mesh = FakeMesh("Grid", 4)
+    draw = BasePassRendering(mesh, MeshMaterialShader(None))
+    assert math.isclose(draw.bounds_center[0], 0.0, abs_tol=1e-6)
+    radius = draw.bounds_radius
+
+    coords = mesh.vertices.arrays["co"]
+    coords[:, 0] += 10.0
+    coords *= 2.0
+    assert draw.update_deformed(mesh)
+    assert math.isclose(draw.bounds_center[0], 20.0, rel_tol=1e-6)
+    assert math.isclose(draw.bounds_radius, radius * 2.0, rel_tol=1e-5)
+    assert np.allclose(draw.positions, coords[draw.loop_vertices])
@@ -0,0 +1,126 @@
+import pytest
+
+from modules.node_compiler import NodeShaderCache, UnsupportedNode, canonicalize, generate_source
+
+class Socket:
+    def __init__(self, identifier, default_value=None):
+        self.identifier = identifier
+        self.default_value = default_value
+        self.links = []
+
+    @property
+    def is_linked(self):
+        return bool(self.links)
+
+class Link:
+    def __init__(self, from_node, from_socket):
+        self.from_node = from_node
+        self.from_socket = from_socket
+        self.is_valid = True
+        self.is_muted = False
+
+class Node:
+    def __init__(self, bl_idname, name, inputs=(), outputs=(), **props):
+        self.bl_idname = bl_idname
+        self.bl_label = bl_idname
+        self.name = name
+        self.inputs = [Socket(identifier, value) for identifier, value in inputs]
+        self.outputs = [Socket(identifier, value) for identifier, value in outputs]
+        self.mute = False
+        self.internal_links = []
+        self.is_active_output = True
+        self.image = None
+        for key, value in props.items():
+            setattr(self, key, value)
+
+    def input(self, identifier):
+        return next(socket for socket in self.inputs if socket.identifier == identifier)
+
+    def output(self, identifier):
+        return next(socket for socket in self.outputs if socket.identifier == identifier)
+
+class Tree:
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+def link(from_node, from_identifier, to_node, to_identifier):
+    to_node.input(to_identifier).links.append(Link(from_node, from_node.output(from_identifier)))
+
+# Material Output <- custom output <- basecolor from an image texture or an RGB node
+def make_tree(color=(1.0, 0.5, 0.25, 1.0), use_image=False, name_prefix=""):
+    output = Node("ShaderNodeOutputMaterial", name_prefix + "Material Output", inputs=[("Surface", None)])
+    custom = Node("CustomShaderNode1", name_prefix + "Custom", inputs=[("basecolor", (1, 1, 1, 1)), ("shadowtint", (0, 0, 0, 1))],
+        outputs=[("BaseColor", None), ("ShadowTint", None)])
+    link(custom, "BaseColor", output, "Surface")
+    nodes = [output, custom]
+    if use_image:
+        image = Node("ShaderNodeTexImage", name_prefix + "Image", inputs=[("Vector", (0.0, 0.0, 0.0))],
+            outputs=[("Color", None), ("Alpha", None)])
+        link(image, "Color", custom, "basecolor")
+        nodes.append(image)
+    else:
+        rgb = Node("ShaderNodeRGB", name_prefix + "RGB", outputs=[("Color", color)])
+        link(rgb, "Color", custom, "basecolor")
+        nodes.append(rgb)
+    return Tree(nodes)
+
+def test_key_ignores_values_and_names():
+    a = canonicalize(make_tree((1.0, 0.0, 0.0, 1.0)))
+    b = canonicalize(make_tree((0.0, 1.0, 0.0, 1.0), name_prefix="Other "))
+    assert a.key == b.key
+    assert a.get_uniform_values() != b.get_uniform_values()
+
+def test_key_changes_with_structure():
+    assert canonicalize(make_tree()).key != canonicalize(make_tree(use_image=True)).key
+
+def test_unlinked_image_vector_uses_uvs():
+    graph = canonicalize(make_tree(use_image=True))
+    source = generate_source(graph)
+    assert "texture(node_t0, vec3(uv, 0.0).xy)" in source
+    # only values with nothing implicit become uniforms
+    assert graph.uniforms == []
+
+def test_unlinked_shadowtint_uses_material_texture():
+    source = generate_source(canonicalize(make_tree()))
+    assert "ShadowTint = texture(tshadowtint, uv).rgb;" in source
+
+def test_constants_are_uniforms():
+    graph = canonicalize(make_tree((0.25, 0.5, 0.75, 1.0)))
+    source = generate_source(graph)
+    assert "uniform vec4 node_u0;" in source
+    assert "vec4 n0_Color = node_u0;" in source
+    assert "BaseColor = n0_Color.rgb;" in source
+    assert graph.get_uniform_values() == [(0.25, 0.5, 0.75, 1.0)]
+
+def test_reroutes_are_looked_through():
+    tree = make_tree()
+    custom, rgb = tree.nodes[1], tree.nodes[2]
+    reroute = Node("NodeReroute", "Reroute", inputs=[("Input", None)], outputs=[("Output", None)])
+    custom.input("basecolor").links = []
+    link(rgb, "Color", reroute, "Input")
+    link(reroute, "Output", custom, "basecolor")
+    tree.nodes.append(reroute)
+    assert canonicalize(tree).key == canonicalize(make_tree()).key
+
+def test_unsupported_node():
+    tree = make_tree()
+    custom = tree.nodes[1]
+    custom.input("basecolor").links = []
+    bsdf = Node("ShaderNodeBsdfPrincipled", "Principled BSDF", outputs=[("BSDF", None)])
+    link(bsdf, "BSDF", custom, "basecolor")
+    with pytest.raises(UnsupportedNode):
+        canonicalize(Tree(tree.nodes + [bsdf]))
+
+def test_trees_without_custom_output():
+    output = Node("ShaderNodeOutputMaterial", "Material Output", inputs=[("Surface", None)])
+    assert canonicalize(Tree([output])) is None
+
+def test_cache_shares_sources(tmp_path):
+    cache = NodeShaderCache(str(tmp_path))
+    graph, source = cache.compile(make_tree((1.0, 0.0, 0.0, 1.0)))
+    assert cache.compile(make_tree((0.0, 0.0, 1.0, 1.0)))[1] is source
+    assert cache.get_stats()["hits"] == 1
+    # read back from disk by a new cache
+    other = NodeShaderCache(str(tmp_path))
+    assert other.compile(make_tree())[1] == source
+    assert other.get_stats()["disk_hits"] == 1
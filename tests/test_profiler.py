@@ -0,0 +1,62 @@
+import threading
+
+from modules.profiler import Profiler
+
+def make_profiler():
+    profiler = Profiler()
+    profiler.enabled = True
+    return profiler
+
+def test_tracks_are_labelled_separately():
+    profiler = make_profiler()
+    with profiler.span("view_draw"):
+        pass
+    with profiler.track("render"):
+        with profiler.span("base_pass"):
+            profiler.count("draw_calls", 4)
+    profiler.end_frame()
+    assert [frame["track"] for frame in profiler.frames] == ["render", "viewport"]
+    summary = profiler.summary()
+    assert list(summary) == ["render: base_pass", "view_draw"]
+    assert summary["view_draw"]["calls_per_frame"] == 1
+    assert profiler.counter_summary() == {"render: draw_calls": 4}
+
+def test_threads_record_their_own_frames():
+    profiler = make_profiler()
+    started, done = threading.Event(), threading.Event()
+    def render():
+        with profiler.track("render"), profiler.span("render"):
+            started.set()
+            done.wait()
+    thread = threading.Thread(target=render)
+    thread.start()
+    started.wait()
+    # a viewport frame while the render thread is inside its span
+    with profiler.span("view_draw"):
+        pass
+    profiler.end_frame()
+    done.set()
+    thread.join()
+    viewport, render = profiler.frames
+    assert [span.name for span in viewport["spans"]] == ["view_draw"]
+    assert [(span.name, span.depth) for span in render["spans"]] == [("render", 0)]
+
+def test_trace_puts_tracks_on_their_own_threads():
+    profiler = make_profiler()
+    with profiler.span("view_draw"):
+        pass
+    profiler.end_frame()
+    with profiler.track("preview"), profiler.span("preview"):
+        pass
+    events = [event for event in profiler.to_chrome_trace()["traceEvents"] if event["ph"] == "X"]
+    assert [(event["name"], event["tid"]) for event in events] == [("view_draw", 0), ("preview", 2)]
+
+def test_only_viewport_spans_get_gpu_timers():
+    profiler = make_profiler()
+    begun = []
+    profiler.gpu_timer = type("Timer", (), {"begin": lambda self, index: begun.append(index) or False})()
+    with profiler.span("lighting", gpu=True):
+        pass
+    with profiler.track("render"), profiler.span("lighting", gpu=True):
+        pass
+    assert begun == [0]
@@ -0,0 +1,43 @@
+import pytest
+
+from modules.scene_cache import SCENE, SceneHandles
+
+@pytest.fixture(autouse=True)
+def clear_scene():
+    SCENE.clear()
+    yield
+    SCENE.clear()
+
+def test_engines_share_entries():
+    a, b = SceneHandles(), SceneHandles()
+    value = a.acquire(("mesh", "Cube"), lambda: ["built"])
+    assert b.acquire(("mesh", "Cube"), lambda: ["again"]) is value
+    assert SCENE.get_stats()["builds"] == 1
+    a.release(("mesh", "Cube"))
+    assert SCENE.entries
+    b.release(("mesh", "Cube"))
+    assert not SCENE.entries
+
+def test_update_applied_once():
+    a, b = SceneHandles(), SceneHandles()
+    a.acquire(("mesh", "Cube"), lambda: [0])
+    b.acquire(("mesh", "Cube"), lambda: [0])
+    def update(value):
+        value[0] += 1
+        return value
+    a.update(("mesh", "Cube"), lambda: [0], update)
+    value = b.update(("mesh", "Cube"), lambda: [0], update)
+    assert value == [1]
+    assert SCENE.get_stats()["skipped_updates"] == 1
+    assert b.get_serial(("mesh", "Cube")) == 1
+
+def test_render_engines_dont_share_with_viewports():
+    viewport, final = SceneHandles(), SceneHandles()
+    final.set_mode("RENDER")
+    viewport_value = viewport.acquire(("mesh", "Cube"), lambda: ["viewport"])
+    render_value = final.acquire(("mesh", "Cube"), lambda: ["render"])
+    assert render_value is not viewport_value
+    final.update(("mesh", "Cube"), lambda: ["render"], lambda value: ["render 2"])
+    assert viewport.acquire(("mesh", "Cube"), lambda: None) == ["viewport"]
+    final.release_all()
+    assert list(SCENE.entries) == [("mesh", "Cube", "VIEWPORT")]
@@ -0,0 +1,46 @@
+import pytest
+
+from benchmarks import stubs, synthetic
+from modules import custom_render_engine
+from modules.custom_render_engine import CustomRenderEngine, CustomRenderEngineSettings
+from modules.shader_cache import SHADERS, ShaderCache
+
+@pytest.fixture(autouse=True)
+def clear_shaders():
+    SHADERS.clear()
+    yield
+    SHADERS.clear()
+
+def fail():
+    raise RuntimeError("syntax error")
+
+def test_failed_programs_are_compiled_once():
+    shaders = ShaderCache()
+    calls = []
+    def builder():
+        calls.append(1)
+        fail()
+    assert shaders.get_or_compile(("broken",), builder) is None
+    assert shaders.get_or_compile(("broken",), builder) is None
+    shaders.request(("broken",), builder)
+    assert shaders.is_ready() and len(calls) == 1
+    assert shaders.pop_errors() == [(("broken",), "syntax error")]
+    assert shaders.pop_errors() == []
+
+def test_frames_skip_passes_without_a_program(monkeypatch):
+    for name in ("compile_depth_prepass_shader", "compile_classify_shader", "compile_present_shader"):
+        monkeypatch.setattr(custom_render_engine, name, lambda *args: fail())
+    settings = stubs.settings_from(CustomRenderEngineSettings)
+    settings.use_depth_prepass = True
+    settings.use_light_tiles = True
+    scene = synthetic.Scene(4, 1, 1, 0, 4, settings)
+    context = synthetic.view_context(scene, 32, 32)
+    engine = CustomRenderEngine()
+    stats = []
+    engine.update_stats = lambda stats_text, info: stats.append(info)
+    engine.view_update(context, scene.depsgraph())
+    for _ in range(2):
+        engine.view_draw(context, scene.depsgraph())
+    errors = [info for info in stats if "failed to compile" in info]
+    assert len(errors) == 1
+    assert "depth_prepass" in errors[0] and "classify_tiles" in errors[0] and "present" in errors[0]
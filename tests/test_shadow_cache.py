@@ -0,0 +1,38 @@
+from benchmarks import stubs
+from benchmarks.synthetic import FakeLight, FakeObject
+from modules.shadow_cache import ShadowCache
+
+def make_cache():
+    shadows = ShadowCache()
+    shadows.configure(1, 64)
+    light = FakeObject("Light", "LIGHT", FakeLight("Light", "POINT"), stubs.Matrix.Translation((0, 0, 3)))
+    return shadows, light
+
+def get_casters(matrix_world):
+    return {"Cube": (matrix_world.to_translation(), 1.0)}, {"Cube": tuple(tuple(row) for row in matrix_world)}
+
+def render(shadows, light):
+    entry = shadows.allocate([light])["Light"]
+    entry.dirty = False
+    return entry
+
+def test_rotation_in_place_draws_the_shadows_again():
+    shadows, light = make_cache()
+    shadows.update_casters(*get_casters(stubs.Matrix.Translation((0, 0, 0))))
+    entry = render(shadows, light)
+
+    shadows.update_casters(*get_casters(stubs.Matrix.Translation((0, 0, 0))))
+    assert not entry.dirty
+
+    # a quarter turn about Z, the bounding sphere doesn't change
+    turned = stubs.Matrix(((0, -1, 0, 0), (1, 0, 0, 0), (0, 0, 1, 0), (0, 0, 0, 1)))
+    shadows.update_casters(*get_casters(turned))
+    assert entry.dirty
+
+def test_casters_out_of_range_are_ignored():
+    shadows, light = make_cache()
+    far = stubs.Matrix.Translation((1000, 0, 0))
+    shadows.update_casters(*get_casters(far))
+    entry = render(shadows, light)
+    shadows.update_casters(*get_casters(far @ stubs.Matrix(((0, -1, 0, 0), (1, 0, 0, 0), (0, 0, 1, 0), (0, 0, 0, 1)))))
+    assert not entry.dirty
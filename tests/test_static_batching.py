@@ -0,0 +1,155 @@
+import types
+
+import numpy as np
+
+from benchmarks import stubs, synthetic
+from modules.static_batching import (StaticBatcher, merge_meshes, patch_member, get_frustum_planes,
+    spheres_visible, BATCH_VERTICES)
+
+def make_draw(vertices, triangles, seed):
+    rng = np.random.default_rng(seed)
+    positions = rng.uniform(-1, 1, (vertices, 3)).astype(np.float32)
+    return types.SimpleNamespace(
+        positions=positions,
+        normals=rng.normal(size=(vertices, 3)).astype(np.float32),
+        tangents=rng.normal(size=(vertices, 3)).astype(np.float32),
+        static_attributes={"uv": rng.uniform(size=(vertices, 2)).astype(np.float32)},
+        indices=rng.integers(0, vertices, (triangles, 3)).astype(np.uintc),
+        bounds_center=(0.0, 0.0, 0.0),
+        bounds_radius=float(np.linalg.norm(positions, axis=1).max()))
+
+def make_matrix(location, scale=1.0):
+    matrix = np.eye(4, dtype=np.float32) * scale
+    matrix[3, 3] = 1
+    matrix[:3, 3] = location
+    return matrix
+
+def test_merge_moves_members_to_world_space():
+    draws = [make_draw(5, 3, 0), make_draw(7, 4, 1)]
+    matrices = [make_matrix((1, 2, 3)), make_matrix((-4, 0, 0), 2.0)]
+    merged = merge_meshes(draws, matrices)
+    assert merged["first_vertices"].tolist() == [0, 5]
+    assert merged["first_triangles"].tolist() == [0, 3]
+    assert np.allclose(merged["positions"][5:], draws[1].positions * 2 + (-4, 0, 0))
+    assert np.array_equal(merged["indices"][3:], draws[1].indices + 5)
+    assert np.array_equal(merged["static_attributes"]["uv"][:5], draws[0].static_attributes["uv"])
+    assert np.allclose(merged["centers"], [(1, 2, 3), (-4, 0, 0)])
+    assert np.allclose(merged["radii"], [draws[0].bounds_radius, draws[1].bounds_radius * 2])
+
+def test_patch_only_writes_the_member():
+    draws = [make_draw(5, 3, 0), make_draw(7, 4, 1), make_draw(6, 2, 2)]
+    matrices = [make_matrix((0, 0, 0)), make_matrix((1, 0, 0)), make_matrix((2, 0, 0))]
+    merged = merge_meshes(draws, matrices)
+    before = {name: np.copy(merged[name]) for name in ("positions", "indices")}
+
+    matrices[1] = make_matrix((0, 5, 0), 3.0)
+    assert patch_member(merged, 1, draws[1], matrices[1], geometry=False)
+    expected = merge_meshes(draws, matrices)
+    for name in ("positions", "normals", "tangents", "centers", "radii"):
+        assert np.allclose(merged[name], expected[name], atol=1e-6)
+    assert np.array_equal(merged["positions"][:5], before["positions"][:5])
+    assert np.array_equal(merged["positions"][12:], before["positions"][12:])
+    assert np.array_equal(merged["indices"], before["indices"])
+
+    changed = make_draw(7, 4, 3)
+    assert patch_member(merged, 1, changed, matrices[1])
+    expected = merge_meshes([draws[0], changed, draws[2]], matrices)
+    assert np.array_equal(merged["indices"], expected["indices"])
+    assert np.array_equal(merged["static_attributes"]["uv"], expected["static_attributes"]["uv"])
+
+def test_patch_needs_the_same_counts():
+    draws = [make_draw(5, 3, 0), make_draw(7, 4, 1)]
+    merged = merge_meshes(draws, [make_matrix((0, 0, 0))] * 2)
+    assert not patch_member(merged, 0, make_draw(5, 4, 2), make_matrix((0, 0, 0)))
+    assert not patch_member(merged, 0, make_draw(6, 3, 2), make_matrix((0, 0, 0)))
+
+def test_spheres_outside_the_frustum_are_culled():
+    # orthographic, the box from -1 to 1
+    planes = get_frustum_planes(np.eye(4))
+    centers = np.array([(0, 0, 0), (1.5, 0, 0), (3, 0, 0), (0, 0, -1.2)], dtype=np.float32)
+    radii = np.array([0.1, 1.0, 1.0, 0.1], dtype=np.float32)
+    assert spheres_visible(planes, centers, radii).tolist() == [True, True, False, False]
+
+class Builder:
+    def __init__(self, patches=True):
+        self.builds = []
+        self.patches = []
+        self.accept = patches
+
+    def build(self, key, names):
+        self.builds.append((key, names))
+        return names
+
+    def patch(self, draw, names, changed):
+        self.patches.append((names, dict(changed)))
+        return self.accept
+
+def sync(batcher, builder, candidates):
+    batcher.sync(candidates, builder.build, builder.patch)
+
+def test_moved_members_are_patched():
+    batcher, builder = StaticBatcher(), Builder()
+    candidates = {"a": ("mat", 10, 1), "b": ("mat", 10, 1), "c": ("other", 10, 1)}
+    sync(batcher, builder, candidates)
+    assert sorted(builder.builds) == [("mat", ["a", "b"]), ("other", ["c"])]
+
+    builder.builds = []
+    sync(batcher, builder, candidates)
+    assert builder.builds == [] and builder.patches == []
+
+    sync(batcher, builder, dict(candidates, b=("mat", 10, 2)))
+    assert builder.builds == []
+    assert builder.patches == [(["a", "b"], {"b": 1})]
+    assert batcher.get_stats()["patches"] == 1
+
+def test_membership_and_size_changes_merge_again():
+    batcher, builder = StaticBatcher(), Builder()
+    sync(batcher, builder, {"a": ("mat", 10, 1), "b": ("mat", 10, 1)})
+    builder.builds = []
+    sync(batcher, builder, {"a": ("mat", 10, 1), "b": ("mat", 12, 2)})
+    assert builder.builds == [("mat", ["a", "b"])] and builder.patches == []
+    builder.builds = []
+    sync(batcher, builder, {"a": ("mat", 10, 1)})
+    assert builder.builds == [("mat", ["a"])]
+    sync(batcher, builder, {})
+    assert batcher.batches == []
+
+def test_failed_patches_merge_again():
+    batcher, builder = StaticBatcher(), Builder(patches=False)
+    sync(batcher, builder, {"a": ("mat", 10, 1)})
+    sync(batcher, builder, {"a": ("mat", 10, 2)})
+    assert builder.builds == [("mat", ["a"]), ("mat", ["a"])]
+    assert len(builder.patches) == 1
+
+def test_batches_are_split_by_vertices():
+    batcher, builder = StaticBatcher(), Builder()
+    half = BATCH_VERTICES // 2
+    sync(batcher, builder, {name: ("mat", half, 1) for name in "abc"})
+    assert len(batcher.batches) == 2
+
+def test_engine_patches_moved_objects_without_evicting_them():
+    from modules.custom_render_engine import CustomRenderEngine, CustomRenderEngineSettings
+
+    settings = stubs.settings_from(CustomRenderEngineSettings)
+    settings.use_static_batching = True
+    scene = synthetic.Scene(20, 2, 1, 0, 4, settings)
+    context = synthetic.view_context(scene, 64, 64)
+    engine = CustomRenderEngine()
+    engine.view_update(context, scene.depsgraph())
+    batcher = engine.static_batches
+    assert batcher.get_stats()["objects"] == 20
+    draws = [batch.draw for batch in batcher.batches]
+
+    object = scene.objects[3]
+    object.matrix_world = stubs.Matrix.Translation((50, 0, 0))
+    engine.view_update(context, scene.depsgraph([synthetic.Update(object, transform=True)]))
+    assert [batch.draw for batch in batcher.batches] == draws
+    assert batcher.get_stats()["patches"] == 1
+
+    batch, _ = batcher.members[object.name]
+    names = list(batch.signatures)
+    index = names.index(object.name)
+    first = batch.draw.merged["first_vertices"][index]
+    member = engine.draw_calls[object.name]
+    assert member.resident
+    assert np.allclose(batch.draw.positions[first:first + len(member.positions)], member.positions + (50, 0, 0))
@@ -0,0 +1,51 @@
+import numpy as np
+
+from modules.tangents import calc_tangents, calc_bitangents
+
+QUAD = np.array([(0, 0, 0), (1, 0, 0), (1, 1, 0), (0, 1, 0)], dtype=np.float32)
+UP = np.tile(np.float32((0, 0, 1)), (4, 1))
+TRIANGLES = np.array([(0, 1, 2), (0, 2, 3)])
+
+def test_tangents_follow_u():
+    tangents, signs = calc_tangents(QUAD, UP, QUAD[:, :2].copy(), TRIANGLES)
+    assert np.allclose(tangents, (1, 0, 0))
+    assert np.array_equal(signs, np.ones(4))
+    assert np.allclose(calc_bitangents(UP, tangents, signs), (0, 1, 0))
+
+def test_mirrored_uvs_flip_the_sign():
+    uvs = QUAD[:, :2] * np.float32((-1, 1))
+    tangents, signs = calc_tangents(QUAD, UP, uvs, TRIANGLES)
+    assert np.allclose(tangents, (-1, 0, 0))
+    assert np.array_equal(signs, -np.ones(4))
+    # the bitangent still follows v
+    assert np.allclose(calc_bitangents(UP, tangents, signs), (0, 1, 0))
+
+def test_loops_without_uvs_get_a_perpendicular_tangent():
+    normals = np.random.default_rng(0).normal(size=(4, 3)).astype(np.float32)
+    normals /= np.linalg.norm(normals, axis=1)[:, None]
+    for uvs in (None, np.zeros((4, 2), dtype=np.float32)):
+        tangents, signs = calc_tangents(QUAD, normals, uvs, TRIANGLES)
+        assert np.allclose(np.linalg.norm(tangents, axis=1), 1, atol=1e-5)
+        assert np.allclose(np.einsum("ij,ij->i", tangents, normals), 0, atol=1e-5)
+        assert np.array_equal(signs, np.ones(4))
+
+def test_welded_corners_share_a_tangent():
+    # two triangles with loops of their own, the shared edge's loops have the same position,
+    # normal and uv. The second triangle's UVs are sheared, so its own tangent differs.
+    positions = np.array([(0, 0, 0), (1, 0, 0), (1, 1, 0), (0, 0, 0), (1, 1, 0), (0, 1, 0)], dtype=np.float32)
+    uvs = np.array([(0, 0), (1, 0), (1, 1), (0, 0), (1, 1), (0, 0.5)], dtype=np.float32)
+    normals = np.tile(np.float32((0, 0, 1)), (6, 1))
+    triangles = np.array([(0, 1, 2), (3, 4, 5)])
+    tangents, _ = calc_tangents(positions, normals, uvs, triangles)
+    assert np.allclose(tangents[0], tangents[3])
+    assert np.allclose(tangents[2], tangents[4])
+    assert not np.allclose(tangents[1], tangents[5])
+
+    # a different normal keeps the corner apart
+    normals[3] = normalize((0.2, 0, 1))
+    tangents, _ = calc_tangents(positions, normals, uvs, triangles)
+    assert not np.allclose(tangents[0], tangents[3])
+
+def normalize(vector):
+    vector = np.array(vector, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
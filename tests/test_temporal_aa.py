@@ -0,0 +1,26 @@
+from benchmarks import stubs, synthetic
+from modules.custom_render_engine import CustomRenderEngine, CustomRenderEngineSettings, get_present_shader_key
+from modules.shader_cache import SHADERS
+
+def make_engine():
+    settings = stubs.settings_from(CustomRenderEngineSettings)
+    settings.use_taa = True
+    scene = synthetic.Scene(4, 1, 1, 0, 4, settings)
+    return CustomRenderEngine(), scene, settings
+
+def test_offscreen_frames_use_fxaa_instead_of_taa():
+    engine, scene, settings = make_engine()
+    depsgraph = scene.depsgraph()
+    context = engine.sync_offscreen(depsgraph, 32, 32)
+    offscreen = stubs.GPUOffScreen(32, 32)
+    engine.draw_offscreen(context, settings, offscreen)
+    # a single frame, nothing to resolve against
+    assert engine.temporal_aa.get_bytes() == 0
+    assert SHADERS.get(get_present_shader_key("SCENELIT", True))
+
+def test_viewport_uses_taa():
+    engine, scene, settings = make_engine()
+    context = synthetic.view_context(scene, 32, 32)
+    engine.view_update(context, scene.depsgraph())
+    engine.view_draw(context, scene.depsgraph())
+    assert engine.temporal_aa.get_bytes() > 0
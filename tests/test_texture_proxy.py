@@ -0,0 +1,53 @@
+import numpy as np
+
+from benchmarks import stubs
+from benchmarks.synthetic import FakeImage
+from modules import texture_proxy
+from modules.texture_proxy import downscale, get_proxy_size, needs_proxy, estimate_proxy_bytes, srgb_to_linear
+
+def test_proxy_size_rounds_up():
+    assert get_proxy_size(2048, 1024, 512) == (4, 512, 256)
+    assert get_proxy_size(1000, 10, 512) == (2, 500, 5)
+    assert get_proxy_size(300, 200, 512) == (1, 300, 200)
+
+def test_downscale_averages_blocks():
+    pixels = np.arange(4 * 4 * 2, dtype=np.float32).reshape(4, 4, 2)
+    out = downscale(pixels, 4, 4, 2)
+    assert out.shape == (2, 2, 2)
+    assert np.allclose(out[0, 0], pixels[:2, :2].mean(axis=(0, 1)))
+    assert np.allclose(out[1, 1], pixels[2:, 2:].mean(axis=(0, 1)))
+
+def test_downscale_pads_with_the_edge():
+    pixels = np.arange(3 * 5, dtype=np.float32).reshape(3, 5, 1)
+    out = downscale(pixels, 5, 3, 3)
+    assert out.shape == (2, 3, 1)
+    # blocks past the edge repeat the last column and row
+    assert np.isclose(out[0, 2, 0], pixels[:2, 4, 0].mean())
+    assert np.isclose(out[1, 0, 0], pixels[2, :2, 0].mean())
+
+def test_small_images_are_kept():
+    pixels = np.ones((2, 3, 4), dtype=np.float32)
+    assert np.array_equal(downscale(pixels, 3, 2, 8), pixels)
+    image = FakeImage("Small", (256, 128))
+    assert not needs_proxy(image, 256) and not needs_proxy(image, None)
+    assert needs_proxy(image, 128)
+    assert estimate_proxy_bytes(image, 128) == 128 * 64 * 8
+
+def test_proxies_are_linear_and_cached(tmp_path, monkeypatch):
+    monkeypatch.setattr(texture_proxy, "PROXY_CACHE_DIR", str(tmp_path / "proxies"))
+    source = tmp_path / "texture.png"
+    source.write_bytes(b"")
+    image = FakeImage("Texture", (64, 32))
+    image.filepath_raw = str(source)
+
+    stubs.STATS.reset()
+    proxy = texture_proxy.load_proxy(image, 16)
+    assert proxy.shape == (8, 16, 4) and proxy.dtype == np.float16
+    # the stub's pixels are all 0.5, sRGB encoded
+    assert np.allclose(proxy[..., :3], srgb_to_linear(0.5), atol=1e-3)
+    assert np.allclose(proxy[..., 3], 0.5)
+
+    assert np.array_equal(texture_proxy.load_proxy(image, 16), proxy)
+    assert stubs.STATS.as_dict()["calls"]["Image.pixels.foreach_get"] == 1
+    # another size is another proxy
+    assert texture_proxy.load_proxy(image, 32).shape == (16, 32, 4)